@@ -0,0 +1,39 @@
+# Pacman Game.  Shared images.
+#
+# Every view wants the same few dozen GIFs from ./assets, each at its own
+# zoom.  We load each file once per process, make each zoom of it the
+# first time a view asks for it, and hand the same PhotoImage to every
+# view that wants it: Tk draws one image in any number of canvas items.
+# Images made from others, like the rotated pacmen and the maze walls,
+# are kept here too.
+
+from tkinter import PhotoImage
+
+ASSET_DIR = "./assets/"
+
+# (name, zoom) -> PhotoImage.  Zoom 1 is the file as loaded.
+images = {}
+
+# key -> whatever make() returned for it
+derived = {}
+
+def image(name, zoom=1):
+    key = (name, zoom)
+    img = images.get(key)
+    if img is None:
+        if zoom == 1:
+            img = PhotoImage(file=ASSET_DIR + name + ".gif")
+        else:
+            img = image(name).zoom(zoom)
+        images[key] = img
+    return img
+
+def images_named(names, zoom=1):
+    return [image(name, zoom) for name in names]
+
+# Images made from other images, by calling make() the first time key is
+# asked for.
+def derived_image(key, make):
+    if key not in derived:
+        derived[key] = make()
+    return derived[key]
@@ -0,0 +1,547 @@
+# Pacman Game.  Batch simulator.
+#
+# Runs N independent single-player games in lockstep.  The state of all
+# the games is held in arrays - one entry per game for pacman, one per
+# game and ghost for the ghosts (flattened, ghost k of game g at g*4 + k)
+# - and each tick advances every game with numpy operations.  It follows
+# the rules in pa_model tick for tick: MovableObject.move and
+# collides_with_wall, the ghosts' distance-field steering, pacman's
+# collisions with ghosts, food, frighten mode, lives and levels.  The
+# differences are:
+#
+#  - There's no other player, so the tunnel takes pacman to the other
+#    end of the same maze rather than onto the other screen.
+#  - Ghosts choose between equally good directions with numpy's random
+#    generator, so a seed doesn't give the same game as pa_headless.
+#    With the choice made the same way on both sides, the games match;
+#    tests/test_batch.py checks that.
+#  - Keys are pressed but never released, as in pa_headless.
+#  - If several ghosts catch pacman in the same tick, he only dies once.
+#
+# Distances come from one table per maze layout, dist[layout, target,
+# square], built with Maze.compute_distances the first time it's needed.
+#
+# Unlike the rest of the game this needs numpy.
+
+import numpy
+from pa_model import Maze, GhostMode, GameMode
+from pa_settings import GRID_SIZE, STARTUP_LIVES, TICK_RATE, Direction
+from pa_headless import START_TIME
+
+UP = int(Direction.UP)
+LEFT = int(Direction.LEFT)
+RIGHT = int(Direction.RIGHT)
+DOWN = int(Direction.DOWN)
+NONE = int(Direction.NONE)
+
+CHASE = GhostMode.CHASE.value
+FRIGHTEN = GhostMode.FRIGHTEN.value
+FRIGHTEN_TRAPPED = GhostMode.FRIGHTEN_TRAPPED.value
+EYES = GhostMode.EYES.value
+
+STARTUP = GameMode.STARTUP.value
+PLAYING = GameMode.CHASE.value
+PLAYING_FRIGHTEN = GameMode.FRIGHTEN.value
+GAME_OVER = GameMode.GAME_OVER.value
+NEXT_LEVEL_WAIT = GameMode.NEXT_LEVEL_WAIT.value
+
+NUM_LAYOUTS = 3
+NUM_GHOSTS = 4
+GHOST_SPEEDS = (0.9, 0.8, 0.8, 0.8)
+
+# pa_model's speed in fixed-timestep mode
+SPEED = 120 / TICK_RATE
+
+# how long each pause lasts, in seconds.  The clock is pa_headless's,
+# and the sums are done the same way, so timers run out on the same tick.
+STARTUP_TIME = 5
+NEXT_LEVEL_TIME = 2
+DEATH_TIME = 2
+FRIGHTEN_TIME = 15
+
+# the layouts: cells[layout] is the starting maze as in Maze.walls,
+# exits[layout] the tunnel exits and dist the distance table
+layouts = None
+
+def load_layouts():
+    global layouts
+    if layouts is not None:
+        return layouts
+    cells = []
+    exits = []
+    dists = []
+    for i in range(0, NUM_LAYOUTS):
+        maze = Maze(i)
+        level = maze.current_level
+        if i > 0 and (maze.width, maze.height) != size:
+            raise ValueError("the mazes must all be the same size")
+        size = (maze.width, maze.height)
+        cells.append(numpy.frombuffer(level.cells, dtype=numpy.uint8))
+        exits.append([exit if exit is not None else (0, 0) for exit in level.tunnel_exits])
+        maze.build_graph()
+        rows = [numpy.frombuffer(maze.compute_distances(sq % maze.width, sq // maze.width),
+                                 dtype=numpy.int16)
+                for sq in range(0, maze.width * maze.height)]
+        dists.append(numpy.stack(rows))
+    layouts = (maze.width, maze.height, numpy.stack(cells),
+               numpy.array(exits, dtype=numpy.int64), numpy.stack(dists))
+    return layouts
+
+# v // GRID_SIZE, as Python does it for floats, but quicker than numpy's
+# floor_divide.  v / GRID_SIZE can round up to a whole number when v is
+# just under a multiple of GRID_SIZE, so check for that.
+def grid_floor(v):
+    q = numpy.floor(v / GRID_SIZE)
+    q -= q * GRID_SIZE > v
+    return q
+
+# The policy for pa_batch is called as policy(sim, tick) and returns an
+# array of N directions to press, with Direction.NONE for no key.  This
+# one presses a random direction in every game every so often.
+def random_policy(n, seed=None, every=40):
+    rng = numpy.random.default_rng(seed)
+    def policy(sim, tick):
+        if tick % every != 0:
+            return None
+        return rng.integers(0, 4, n)
+    return policy
+
+class BatchSim():
+    # mazenum is the starting layout, either one for all the games or
+    # an array of N
+    def __init__(self, n, mazenum=0, seed=None, policy=None):
+        (self.width, self.height, self.layout_cells, self.exits,
+         self.dist) = load_layouts()
+        self.n = n
+        self.rng = numpy.random.default_rng(seed)
+        self.policy = policy
+        self.tick = 0
+        self.now = START_TIME
+        w = self.width
+        self.max_x = self.width - 1
+        self.max_y = self.height - 1
+
+        self.mazenum = numpy.zeros(n, dtype=numpy.int64) + mazenum
+        self.layout = self.mazenum % NUM_LAYOUTS
+        self.cells = numpy.zeros((n, w * self.height), dtype=numpy.uint8)
+        self.food_count = numpy.zeros(n, dtype=numpy.int64)
+        self.mode = numpy.zeros(n, dtype=numpy.int8)
+        self.start_time = numpy.zeros(n)
+        self.level = numpy.ones(n, dtype=numpy.int64)
+        self.lives = numpy.zeros(n, dtype=numpy.int64)
+        self.score = numpy.zeros(n, dtype=numpy.int64)
+        self.deaths = numpy.zeros(n, dtype=numpy.int64)
+        self.ghosts_eaten = numpy.zeros(n, dtype=numpy.int64)
+        self.food_eaten = numpy.zeros(n, dtype=numpy.int64)
+        self.finished = numpy.zeros(n, dtype=bool)
+        self.finish_tick = numpy.zeros(n, dtype=numpy.int64)
+
+        # pacman, one per game
+        self.pac_x = numpy.zeros(n)
+        self.pac_y = numpy.zeros(n)
+        self.pac_dir = numpy.zeros(n, dtype=numpy.int64)
+        self.pac_speed = numpy.zeros(n)
+        self.user_dir = numpy.full(n, NONE, dtype=numpy.int64)
+        self.pac_prev_x = numpy.zeros(n, dtype=numpy.int64)
+        self.pac_prev_y = numpy.zeros(n, dtype=numpy.int64)
+        self.dying = numpy.zeros(n, dtype=bool)
+        self.death_time = numpy.zeros(n)
+
+        # ghosts, NUM_GHOSTS per game.  target_x/y is where the ghost is
+        # heading and field the square its distance field leads to, which
+        # isn't always the same.
+        g = n * NUM_GHOSTS
+        self.ghost_game = numpy.repeat(numpy.arange(n), NUM_GHOSTS)
+        self.ghost_num = numpy.tile(numpy.arange(NUM_GHOSTS), n)
+        self.ghost_base_speed = numpy.array(GHOST_SPEEDS)[self.ghost_num]
+        self.ghost_x = numpy.zeros(g)
+        self.ghost_y = numpy.zeros(g)
+        self.ghost_dir = numpy.zeros(g, dtype=numpy.int64)
+        self.ghost_speed = numpy.zeros(g)
+        self.ghost_mode = numpy.zeros(g, dtype=numpy.int8)
+        self.ghost_frozen = numpy.zeros(g, dtype=bool)
+        self.target_x = numpy.zeros(g, dtype=numpy.int64)
+        self.target_y = numpy.zeros(g, dtype=numpy.int64)
+        self.field = numpy.zeros(g, dtype=numpy.int64)
+        self.scatter_x = (self.ghost_num % 2) * 15 + 6
+        self.scatter_y = (self.ghost_num // 2) * 21 + 5
+
+        everyone = numpy.ones(n, dtype=bool)
+        self.start_level(everyone)
+        start = self.pac_grid_position(numpy.arange(n))
+        self.pac_prev_x, self.pac_prev_y = start
+
+    # Bookkeeping shared with Model: levels, lives and ghosts.
+
+    def start_level(self, games):
+        # Model.reset_level and activate
+        self.cells[games] = self.layout_cells[self.layout[games]]
+        self.food_count[games] = numpy.count_nonzero(
+            (self.cells[games] == 2) | (self.cells[games] == 3), axis=1)
+        self.reset_pacman(games)
+        self.lives[games] = STARTUP_LIVES
+        self.new_ghosts(games)
+        self.mode[games] = STARTUP
+        self.start_time[games] = self.now
+
+    def reset_pacman(self, games):
+        self.pac_x[games] = 14 * GRID_SIZE
+        self.pac_y[games] = 17 * GRID_SIZE
+        self.pac_dir[games] = LEFT
+        self.pac_speed[games] = 1
+        self.user_dir[games] = NONE
+        self.dying[games] = False
+
+    def ghosts_of(self, games):
+        return numpy.nonzero(games[self.ghost_game])[0]
+
+    def new_ghosts(self, games):
+        # Model.create_ghosts
+        g = self.ghosts_of(games)
+        self.ghost_x[g] = 16 * GRID_SIZE
+        self.ghost_y[g] = 15 * GRID_SIZE
+        self.ghost_dir[g] = UP
+        self.ghost_speed[g] = self.ghost_base_speed[g]
+        self.ghost_mode[g] = CHASE
+        self.ghost_frozen[g] = False
+        self.set_scatter_target(g)
+
+    def set_target(self, g, x, y):
+        self.target_x[g] = x
+        self.target_y[g] = y
+        self.field[g] = y * self.width + x
+
+    def set_scatter_target(self, g):
+        self.set_target(g, self.scatter_x[g], self.scatter_y[g])
+
+    def set_ghost_speed(self, g, factor):
+        g = g[~self.ghost_frozen[g]]
+        self.ghost_speed[g] = self.ghost_base_speed[g] * factor
+
+    def new_life(self, games):
+        self.lives[games] -= 1
+        over = games & (self.lives == 0)
+        self.mode[over] = GAME_OVER
+        self.finished[over] = True
+        self.finish_tick[over] = self.tick
+        games = games & ~over
+        self.mode[games] = PLAYING
+        self.reset_pacman(games)
+        self.new_ghosts(games)
+
+    def next_level(self, games):
+        self.level[games] += 1
+        self.layout[games] = (self.level[games] + self.mazenum[games]) % NUM_LAYOUTS
+        self.start_level(games)
+
+    # Movement.  These take an array of the pacmen or ghosts to move,
+    # and the arrays holding their state.
+
+    def grid_position(self, x, y):
+        return grid_floor(x + 0.5 * GRID_SIZE).astype(numpy.int64), \
+            grid_floor(y + 0.5 * GRID_SIZE).astype(numpy.int64)
+
+    def pac_grid_position(self, p):
+        return self.grid_position(self.pac_x[p], self.pac_y[p])
+
+    def centred(self, x, y):
+        return (numpy.abs(x - grid_floor(x) * GRID_SIZE) < GRID_SIZE/10) \
+            & (numpy.abs(y - grid_floor(y) * GRID_SIZE) < GRID_SIZE/10)
+
+    def recentre(self, v):
+        newv = grid_floor(v) * GRID_SIZE
+        return numpy.where(v - newv > GRID_SIZE//2, newv + GRID_SIZE, newv)
+
+    def is_wall(self, games, x, y):
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        squares = numpy.where(inside, y * self.width + x, 0)
+        return ~inside | (self.cells[games, squares] == 1)
+
+    def fix_if_outside_grid(self, xs, ys, i):
+        gx, gy = self.grid_position(xs[i], ys[i])
+        outside = (gx < 0) | (gy < 0) | (gx > self.max_x) | (gy > self.max_y)
+        if outside.any():
+            i = i[outside]
+            xs[i] = numpy.clip(gx[outside], 0, self.max_x) * GRID_SIZE
+            ys[i] = numpy.clip(gy[outside], 0, self.max_y) * GRID_SIZE
+
+    # MovableObject.move.  Returns which of them hit a wall.
+    def move(self, i, games, xs, ys, dirs, speeds):
+        x = xs[i]
+        y = ys[i]
+        d = dirs[i]
+        step = speeds[i] * SPEED
+        nx = x + numpy.where(d == RIGHT, step, numpy.where(d == LEFT, -step, 0.0))
+        ny = y + numpy.where(d == DOWN, step, numpy.where(d == UP, -step, 0.0))
+        crossed = (grid_floor(nx) != grid_floor(x)) | (grid_floor(ny) != grid_floor(y))
+        # collides_with_wall: the square we're moving into
+        wx = numpy.trunc(nx).astype(numpy.int64) // GRID_SIZE + (d == RIGHT)
+        wy = numpy.trunc(ny).astype(numpy.int64) // GRID_SIZE + (d == DOWN)
+        inside = (wx >= 0) & (wx < self.width) & (wy >= 0) & (wy < self.height)
+        squares = numpy.where(inside, wy * self.width + wx, 0)
+        hit = crossed & inside & (self.cells[games, squares] == 1)
+        xs[i] = numpy.where(hit, self.recentre(x), nx)
+        ys[i] = numpy.where(hit, self.recentre(y), ny)
+        speeds[i[hit]] = 0
+        self.fix_if_outside_grid(xs, ys, i[~hit])
+        return hit
+
+    def move_pacmen(self, p):
+        if len(p) == 0:
+            return
+        # Pacman.user_move: reversing is always allowed, turning only
+        # when centred on a square with the way clear
+        want = self.user_dir[p]
+        d = self.pac_dir[p]
+        turn = (want != NONE) & (want != d)
+        reverse = turn & (want == 3 - d)
+        turn &= ~reverse
+        turn &= self.centred(self.pac_x[p], self.pac_y[p])
+        gx, gy = self.pac_grid_position(p)
+        nx = gx + (want == RIGHT) - (want == LEFT)
+        ny = gy + (want == DOWN) - (want == UP)
+        # square_is_empty doesn't check the bounds, so wrap as it would
+        squares = (ny * self.width + nx) % self.cells.shape[1]
+        turn &= self.cells[p, squares] != 1
+        go = reverse | turn
+        self.pac_dir[p[go]] = want[go]
+        self.pac_speed[p[go]] = 1
+        self.move(p, p, self.pac_x, self.pac_y, self.pac_dir, self.pac_speed)
+
+    # Ghost.aim_for_target
+    def aim(self, g):
+        games = self.ghost_game[g]
+        self.fix_if_outside_grid(self.ghost_x, self.ghost_y, g)
+        centred = self.centred(self.ghost_x[g], self.ghost_y[g])
+        g = g[centred]
+        games = games[centred]
+        if len(g) == 0:
+            return
+        x, y = self.grid_position(self.ghost_x[g], self.ghost_y[g])
+        layout = self.layout[games]
+        square = y * self.width + x
+        arrived = self.dist[layout, self.field[g], square] == 0
+        if arrived.any():
+            mode = self.ghost_mode[g]
+            eyes = arrived & (mode == EYES)
+            self.ghost_mode[g[eyes]] = CHASE
+            self.set_scatter_target(g[eyes])
+            # at the target column, go via the top left corner
+            corner = arrived & ~eyes & (x == self.target_x[g])
+            self.field[g[corner]] = 1 * self.width + 1
+            other = arrived & ~eyes & ~corner
+            self.field[g[other]] = self.target_y[g[other]] * self.width + self.target_x[g[other]]
+        field = self.field[g]
+        current = self.dist[layout, field, square]
+        neighbours = numpy.empty((len(g), 4), dtype=numpy.int64)
+        for i, (dx, dy) in enumerate(((0, -1), (-1, 0), (1, 0), (0, 1))):
+            nx = x + dx
+            ny = y + dy
+            inside = (nx >= 0) & (nx <= self.max_x) & (ny >= 0) & (ny <= self.max_y)
+            squares = numpy.where(inside, ny * self.width + nx, 0)
+            neighbours[:, i] = numpy.where(inside, self.dist[layout, field, squares], -1)
+        frightened = (self.ghost_mode[g] == FRIGHTEN)[:, None]
+        current = current[:, None]
+        possible = (neighbours >= 0) & numpy.where(frightened, neighbours > current,
+                                                   neighbours < current)
+        count = possible.sum(axis=1)
+        stuck = count == 0
+        self.set_scatter_target(g[stuck])
+        trapped = stuck & frightened[:, 0]
+        self.ghost_mode[g[trapped]] = FRIGHTEN_TRAPPED
+        ok = ~stuck
+        g = g[ok]
+        choice = self.choose(possible[ok], count[ok])
+        # Direction's values are in the same order as the neighbours
+        changed = choice != self.ghost_dir[g]
+        self.ghost_dir[g] = choice
+        g = g[changed]
+        self.ghost_x[g] = self.recentre(self.ghost_x[g])
+        self.ghost_y[g] = self.recentre(self.ghost_y[g])
+
+    # pick one of the possible directions in each row, at random
+    def choose(self, possible, count):
+        nth = (self.rng.random(len(count)) * count).astype(numpy.int64)
+        return numpy.argmax(numpy.cumsum(possible, axis=1) > nth[:, None], axis=1)
+
+    def move_ghosts(self, g):
+        # Ghost.move: if we hit a wall, aim again and have another go,
+        # and if that fails, head for the ghost house
+        for attempt in range(0, 3):
+            if len(g) == 0:
+                return
+            if attempt == 2:
+                self.set_target(g, 16, 17)
+            self.aim(g)
+            if attempt > 0:
+                scared = numpy.isin(self.ghost_mode[g], (FRIGHTEN, FRIGHTEN_TRAPPED))
+                self.set_ghost_speed(g[scared], 0.5)
+                self.set_ghost_speed(g[~scared], 1.0)
+            hit = self.move(g, self.ghost_game[g], self.ghost_x, self.ghost_y,
+                            self.ghost_dir, self.ghost_speed)
+            g = g[hit]
+
+    # Model.check_collisions
+    def check_collisions(self, p):
+        for k in range(0, NUM_GHOSTS):
+            p = p[~self.dying[p]]
+            if len(p) == 0:
+                return
+            g = p * NUM_GHOSTS + k
+            dx = self.pac_x[p] - self.ghost_x[g]
+            dy = self.pac_y[p] - self.ghost_y[g]
+            close = dx*dx + dy*dy < GRID_SIZE*GRID_SIZE
+            mode = self.ghost_mode[g]
+            # Ghost.mode reports a trapped ghost as FRIGHTEN, so the
+            # model lets pacman eat those too
+            eaten = g[close & ((mode == FRIGHTEN) | (mode == FRIGHTEN_TRAPPED))]
+            self.ghost_mode[eaten] = EYES
+            self.set_target(eaten, 16, 14)
+            self.set_ghost_speed(eaten, 1)
+            self.score[eaten // NUM_GHOSTS] += 200
+            self.ghosts_eaten[eaten // NUM_GHOSTS] += 1
+            caught = p[close & (mode == CHASE)]
+            if len(caught):
+                # Model.died: the ghosts go home and wait
+                home = self.ghosts_of(self.as_mask(caught))
+                self.ghost_x[home] = 16 * GRID_SIZE
+                self.ghost_y[home] = 15 * GRID_SIZE
+                self.ghost_speed[home] = 0
+                self.ghost_frozen[home] = True
+                self.dying[caught] = True
+                self.pac_speed[caught] = 0
+                self.death_time[caught] = self.now
+                self.deaths[caught] += 1
+
+    # Ghost.update_pacman_position, for the ghosts in games p
+    def chase(self, p, px, py):
+        g = (p[:, None] * NUM_GHOSTS + numpy.arange(NUM_GHOSTS)).ravel()
+        px = numpy.repeat(px, NUM_GHOSTS)
+        py = numpy.repeat(py, NUM_GHOSTS)
+        mode = self.ghost_mode[g]
+        num = self.ghost_num[g]
+        gx, gy = self.grid_position(self.ghost_x[g], self.ghost_y[g])
+        near = (px - gx)**2 + (py - gy)**2 < 25
+        trapped = (mode == FRIGHTEN_TRAPPED) & near
+        self.set_ghost_speed(g[trapped], 0.5)
+        self.ghost_mode[g[trapped]] = FRIGHTEN
+        follow = trapped | (mode == FRIGHTEN) | ((mode == CHASE) & (num == 0))
+        self.set_target(g[follow], px[follow], py[follow])
+        # ghost 1 tries to aim ahead of pacman
+        ahead = (mode == CHASE) & (num == 1)
+        g = g[ahead]
+        games = self.ghost_game[g]
+        px = px[ahead]
+        py = py[ahead]
+        d = self.pac_dir[games]
+        tx = px.copy()
+        ty = py.copy()
+        found = numpy.zeros(len(g), dtype=bool)
+        for dist in (4, 5, 3):
+            # next_square, which moves UP by adding to y too
+            nx = px + dist * ((d == RIGHT) | (d == NONE)) - dist * (d == LEFT)
+            ny = py + dist * ((d == UP) | (d == DOWN) | (d == NONE))
+            use = ~found & ~self.is_wall(games, nx, ny)
+            tx[use] = nx[use]
+            ty[use] = ny[use]
+            found |= use
+        self.set_target(g, tx, ty)
+
+    # Model.update_objects, for the games p
+    def update_objects(self, p):
+        revive = p[self.dying[p] & (self.now - self.death_time[p] > DEATH_TIME)]
+        if len(revive):
+            self.new_life(self.as_mask(revive))
+            p = p[~self.finished[p]]
+        self.move_ghosts(self.ghosts_of(self.as_mask(p)))
+        self.move_pacmen(p[~self.dying[p]])
+        self.check_collisions(p)
+
+        gx, gy = self.pac_grid_position(p)
+        new = (gx != self.pac_prev_x[p]) | (gy != self.pac_prev_y[p])
+        p = p[new]
+        gx = gx[new]
+        gy = gy[new]
+        self.pac_prev_x[p] = gx
+        self.pac_prev_y[p] = gy
+        if len(p) == 0:
+            return
+        self.chase(p, gx, gy)
+
+        square = gy * self.width + gx
+        contents = self.cells[p, square]
+        eat = (contents == 2) | (contents == 3)
+        self.cells[p[eat], square[eat]] = 0
+        self.food_count[p[eat]] -= 1
+        self.food_eaten[p[eat]] += 1
+        self.score[p[contents == 2]] += 10
+        pill = contents == 3
+        if pill.any():
+            games = p[pill]
+            self.mode[games] = PLAYING_FRIGHTEN
+            self.start_time[games] = self.now
+            g = self.ghosts_of(self.as_mask(games))
+            self.ghost_mode[g] = FRIGHTEN
+            self.set_target(g, numpy.repeat(gx[pill], NUM_GHOSTS),
+                            numpy.repeat(gy[pill], NUM_GHOSTS))
+            self.set_ghost_speed(g, 0.5)
+        d = self.pac_dir[p]
+        tunnel = ((contents == 4) & (d == LEFT)) | ((contents == 5) & (d == RIGHT))
+        if tunnel.any():
+            games = p[tunnel]
+            exits = self.exits[self.layout[games], 1 - (contents[tunnel] - 4)]
+            self.pac_x[games] = exits[:, 0] * GRID_SIZE
+            self.pac_y[games] = exits[:, 1] * GRID_SIZE
+        done = p[eat & (self.food_count[p] <= 0)]
+        self.mode[done] = NEXT_LEVEL_WAIT
+        self.start_time[done] = self.now
+
+    def as_mask(self, games):
+        mask = numpy.zeros(self.n, dtype=bool)
+        mask[games] = True
+        return mask
+
+    # Model.update, for every game at once
+    def step(self):
+        if self.policy is not None:
+            keys = self.policy(self, self.tick)
+            if keys is not None:
+                keys = numpy.asarray(keys)
+                pressed = keys != NONE
+                self.user_dir[pressed] = keys[pressed]
+        self.tick += 1
+        self.now = START_TIME + self.tick * (1.0 / TICK_RATE)
+        elapsed = self.now - self.start_time
+        startup = (self.mode == STARTUP) & (elapsed > STARTUP_TIME)
+        waiting = (self.mode == NEXT_LEVEL_WAIT) & (elapsed > NEXT_LEVEL_TIME)
+        playing = numpy.nonzero((self.mode == PLAYING) | (self.mode == PLAYING_FRIGHTEN))[0]
+        self.update_objects(playing)
+        playing = playing[self.mode[playing] == PLAYING_FRIGHTEN]
+        over = playing[self.now - self.start_time[playing] > FRIGHTEN_TIME]
+        if len(over):
+            g = self.ghosts_of(self.as_mask(over))
+            # Ghost.end_frighten_mode goes by Ghost.mode as well, so
+            # trapped ghosts go back to chasing with the rest
+            g = g[numpy.isin(self.ghost_mode[g], (FRIGHTEN, FRIGHTEN_TRAPPED))]
+            self.ghost_mode[g] = CHASE
+            self.set_scatter_target(g)
+        self.mode[startup] = PLAYING
+        if waiting.any():
+            self.next_level(waiting)
+
+    # Play until every game is over or max_ticks have gone by.  Returns
+    # the number of ticks played.
+    def run(self, max_ticks):
+        start = self.tick
+        while not self.finished.all() and self.tick - start < max_ticks:
+            self.step()
+        return self.tick - start
+
+    # a dict of arrays, one entry per game; games still going have
+    # played all the ticks so far
+    def results(self):
+        ticks = numpy.where(self.finished, self.finish_tick, self.tick)
+        return {"score": self.score.copy(), "level": self.level.copy(),
+                "deaths": self.deaths.copy(), "ghosts_eaten": self.ghosts_eaten.copy(),
+                "food_eaten": self.food_eaten.copy(), "ticks": ticks,
+                "finished": self.finished.copy()}
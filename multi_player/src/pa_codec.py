@@ -0,0 +1,343 @@
+import struct
+import pickle
+from pa_settings import CANVAS_WIDTH, CANVAS_HEIGHT, GRID_SIZE, Direction
+from pa_model import Maze, GhostMode, GameMode
+
+# Binary encoding of the messages in Pacman_Protocol_Specification.py.
+#
+# Every message starts with a 4 bit type field in the top of the first
+# byte.  The type alone tells the receiver how long the message is
+# (MAZE_UPDATE carries its own grid size), so there's no length prefix
+# and any number of messages can be sent back to back in one packet.
+#
+# encode() takes the same ["name", payload] lists the network code has
+# always built, and decode() hands the same lists back, so Network only
+# has to choose between pickle and this codec in one place.
+#
+# Types 12 and 13 aren't in the spec; they set up the UDP channel that
+# carries PACMAN_UPDATE and GHOST_UPDATE (see Network.open_udp).
+# Type 14, STATE_DELTA, replaces those two on TCP: it only carries the
+# fields that changed since the previous one for the same pacman or
+# ghost, in fixed point.
+
+# 1 = length-prefixed pickle, 2 = this codec, 3 = pacman and ghost
+# updates also go over UDP, 4 = STATE_DELTA on TCP
+PROTOCOL_VERSION = 4
+
+MAZE_UPDATE = 0
+PACMAN_ARRIVED = 1
+PACMAN_LEFT = 2
+PACMAN_DIED = 3
+PACMAN_GO_HOME = 4
+FOREIGN_PACMAN_ATE_GHOST = 5
+EAT = 6
+SCORE_UPDATE = 7
+LIVES_UPDATE = 8
+STATUS_UPDATE = 9
+PACMAN_UPDATE = 10
+GHOST_UPDATE = 11
+UDP_PORT = 12
+UDP_OK = 13
+STATE_DELTA = 14
+
+MSG_TYPES = {"maze": MAZE_UPDATE,
+             "newpacman": PACMAN_ARRIVED,
+             "pacmanleft": PACMAN_LEFT,
+             "pacmandied": PACMAN_DIED,
+             "pacmanhome": PACMAN_GO_HOME,
+             "ghosteaten": FOREIGN_PACMAN_ATE_GHOST,
+             "eat": EAT,
+             "score": SCORE_UPDATE,
+             "lives": LIVES_UPDATE,
+             "status": STATUS_UPDATE,
+             "pacman": PACMAN_UPDATE,
+             "ghost": GHOST_UPDATE,
+             "udpport": UDP_PORT,
+             "udpok": UDP_OK,
+             "delta": STATE_DELTA}
+MSG_NAMES = {msgtype: name for name, msgtype in MSG_TYPES.items()}
+
+SEQ_MASK = 0xffffff  # sequence numbers are 24 bits
+
+# Precompiled layouts, all in network byte order.
+BYTE = struct.Struct(">B")          # T | flags | U
+MAZE_HEADER = struct.Struct(">BHBB")  # T | level, food count, width, height
+EAT_MSG = struct.Struct(">Bff")     # T | F | P | U, x, y
+SCORE_MSG = struct.Struct(">I")     # T | score (28 bits)
+PACMAN_MSG = struct.Struct(">Ifff") # T | dir | U | seq, x, y, speed
+# The spec's GHOST_UPDATE has no ghost number and only a 1 bit mode,
+# which can't express EYES, so we add one byte for them after the
+# sequence number.
+GHOST_MSG = struct.Struct(">IBfff") # T | dir | U | seq, ghost | mode | U, x, y, speed
+PORT_MSG = struct.Struct(">BH")     # T | U, port
+DELTA_HEADER = struct.Struct(">IB") # T | entity | U | seq, field mask
+COORD = struct.Struct(">h")
+SPEED = struct.Struct(">H")
+
+# STATE_DELTA entities: ghosts are 0-3
+PACMAN_ENTITY = 4
+
+# STATE_DELTA field mask bits; fields follow the header in this order
+DELTA_X = 0x80      # 16 bits, fixed point
+DELTA_Y = 0x40      # 16 bits, fixed point
+DELTA_DIRMODE = 0x20  # 8 bits, direction | ghost mode
+DELTA_SPEED = 0x10  # 16 bits, fixed point
+DELTA_ALL = DELTA_X | DELTA_Y | DELTA_DIRMODE | DELTA_SPEED
+
+# Coordinates and speeds are sent in 1/256ths of a grid square (a speed
+# of 1 is 256).  That's well under a pixel at both zoom levels.
+FIXED_POINT = 256
+
+# size of each fixed format message, indexed by type
+MSG_SIZES = [None, 1, 1, 1, 1, 1, EAT_MSG.size, SCORE_MSG.size, 1, 1,
+             PACMAN_MSG.size, GHOST_MSG.size, PORT_MSG.size, 1]
+
+MAX_SPEED = GRID_SIZE
+MAX_SCORE = (1 << 28) - 1
+
+def version_frame(name, version):
+    # The version messages are legacy (pickle) frames, so a peer that
+    # predates this codec just reports them as unknown messages.  We only
+    # ever compare them against these precomputed bytes, never unpickle them.
+    payload = pickle.dumps([name, [version]], protocol=2)
+    return len(payload).to_bytes(2, byteorder='big') + payload
+
+# "version" announces the highest version we speak, and "versionok" the
+# version we're going to use, once we've heard theirs
+def hello_frame(version):
+    return version_frame("version", version)
+
+def confirm_frame(version):
+    return version_frame("versionok", version)
+
+HELLO_FRAMES = {hello_frame(version)[2:]: version for version in range(1, 256)}
+CONFIRM_FRAMES = {confirm_frame(version)[2:]: version for version in range(1, 256)}
+
+def valid_position(x, y):
+    return -GRID_SIZE <= x <= CANVAS_WIDTH and -GRID_SIZE <= y <= CANVAS_HEIGHT
+
+def valid_speed(speed):
+    return 0 <= speed <= MAX_SPEED
+
+def quantize_state(pos, dirn, speed, mode):
+    """Fixed point (x, y, direction|mode, speed) tuple for STATE_DELTA.
+    mode is None for a pacman."""
+    x, y = pos
+    dirmode = int(dirn) << 4
+    if mode is not None:
+        dirmode |= mode.value
+    return (int(round(x * FIXED_POINT / GRID_SIZE)),
+            int(round(y * FIXED_POINT / GRID_SIZE)),
+            dirmode,
+            int(round(speed * FIXED_POINT)))
+
+def unquantize_pos(state):
+    return (state[0] * GRID_SIZE / FIXED_POINT, state[1] * GRID_SIZE / FIXED_POINT)
+
+def unquantize_speed(state):
+    return state[3] / FIXED_POINT
+
+def check_field(name, value, bits, signed=False):
+    """Return value, raising ValueError if it doesn't fit in a field of
+    the given number of bits.  Fields share bytes with the type and each
+    other, so one that overflowed would turn into a different message."""
+    if signed:
+        low, high = -(1 << bits - 1), (1 << bits - 1) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+    if not low <= value <= high:
+        raise ValueError("%s %r doesn't fit in %d bits" % (name, value, bits))
+    return value
+
+def encode_delta(entity, seq, mask, state):
+    if not 0 <= entity <= PACMAN_ENTITY:
+        raise ValueError("bad STATE_DELTA entity " + str(entity))
+    parts = [DELTA_HEADER.pack(STATE_DELTA << 28 | entity << 25 | (seq & SEQ_MASK),
+                               check_field("field mask", mask, 8))]
+    if mask & DELTA_X:
+        parts.append(COORD.pack(check_field("x", state[0], 16, True)))
+    if mask & DELTA_Y:
+        parts.append(COORD.pack(check_field("y", state[1], 16, True)))
+    if mask & DELTA_DIRMODE:
+        parts.append(BYTE.pack(check_field("direction and mode", state[2], 8)))
+    if mask & DELTA_SPEED:
+        parts.append(SPEED.pack(check_field("speed", state[3], 16)))
+    return b"".join(parts)
+
+def encode(msg, seq=0):
+    """Encode a ["name", payload] message.  seq is only used by the
+    PACMAN_UPDATE and GHOST_UPDATE messages.  Raises ValueError if a
+    field is out of range for its place in the message."""
+    name, payload = msg
+    msgtype = MSG_TYPES[name]
+    if msgtype == PACMAN_UPDATE:
+        (x, y), dirn, speed = payload
+        return PACMAN_MSG.pack(msgtype << 28 | check_field("direction", int(dirn), 3) << 25
+                               | (seq & SEQ_MASK), x, y, speed)
+    elif msgtype == GHOST_UPDATE:
+        ghostnum, (x, y), dirn, speed, mode = payload
+        return GHOST_MSG.pack(msgtype << 28 | check_field("direction", int(dirn), 3) << 25
+                              | (seq & SEQ_MASK),
+                              check_field("ghost number", ghostnum, 2) << 6
+                              | check_field("ghost mode", mode.value, 3) << 3,
+                              x, y, speed)
+    elif msgtype == EAT:
+        (x, y), is_foreign, is_powerpill = payload
+        return EAT_MSG.pack(msgtype << 4 | bool(is_foreign) << 3 | bool(is_powerpill) << 2,
+                            x, y)
+    elif msgtype == SCORE_UPDATE:
+        # a score too big for the field just stops going up
+        score = check_field("score", min(payload[0], MAX_SCORE), 28)
+        return SCORE_MSG.pack(msgtype << 28 | score)
+    elif msgtype == LIVES_UPDATE:
+        return BYTE.pack(msgtype << 4 | check_field("lives", payload[0], 3) << 1)
+    elif msgtype == STATUS_UPDATE:
+        return BYTE.pack(msgtype << 4 | check_field("status", payload[0].value, 3) << 1)
+    elif msgtype == FOREIGN_PACMAN_ATE_GHOST:
+        return BYTE.pack(msgtype << 4 | check_field("ghost number", payload[0], 2) << 2)
+    elif msgtype == MAZE_UPDATE:
+        return encode_maze(payload)
+    elif msgtype == UDP_PORT:
+        return PORT_MSG.pack(msgtype << 4, check_field("port", payload[0], 16))
+    else:
+        # PACMAN_ARRIVED, PACMAN_LEFT, PACMAN_DIED, PACMAN_GO_HOME:
+        # the event happened, so the flag bit is always set
+        return BYTE.pack(msgtype << 4 | 1 << 3)
+
+def encode_maze(maze):
+    width = maze.width
+    height = maze.height
+    header = MAZE_HEADER.pack(MAZE_UPDATE << 4 | check_field("level", maze.use_level, 4),
+                              check_field("food count", maze.food_count, 16),
+                              check_field("width", width, 8),
+                              check_field("height", height, 8))
+    # grid squares are 0-5, so pack two to a byte
+    cells = maze.walls
+    if len(cells) % 2:
+        cells = cells + b"\0"
+    packed = bytes(cells[i] << 4 | cells[i+1] for i in range(0, len(cells), 2))
+    return header + packed
+
+def msg_size(buf, offset):
+    """Return the length of the message starting at offset, or 0 if not
+    enough of it has arrived to tell.  Raises ValueError if the type field
+    is invalid, as we can't then find the start of the next message."""
+    if offset >= len(buf):
+        return 0
+    msgtype = buf[offset] >> 4
+    if msgtype == MAZE_UPDATE:
+        if len(buf) - offset < MAZE_HEADER.size:
+            return 0
+        first, food, width, height = MAZE_HEADER.unpack_from(buf, offset)
+        return MAZE_HEADER.size + (width * height + 1) // 2
+    if msgtype == STATE_DELTA:
+        if len(buf) - offset < DELTA_HEADER.size:
+            return 0
+        mask = buf[offset + DELTA_HEADER.size - 1]
+        size = DELTA_HEADER.size
+        if mask & DELTA_X:
+            size += COORD.size
+        if mask & DELTA_Y:
+            size += COORD.size
+        if mask & DELTA_DIRMODE:
+            size += 1
+        if mask & DELTA_SPEED:
+            size += SPEED.size
+        return size
+    if msgtype >= len(MSG_SIZES):
+        raise ValueError("bad message type " + str(msgtype))
+    return MSG_SIZES[msgtype]
+
+def msg_seq(buf, offset=0):
+    """Sequence number of the PACMAN_UPDATE or GHOST_UPDATE at offset."""
+    return int.from_bytes(buf[offset+1:offset+4], byteorder='big')
+
+def decode(buf, offset=0):
+    """Decode the message starting at offset.  Returns (msg, size): msg
+    is None if it failed validation and must be discarded; size is 0 if
+    the message hasn't completely arrived yet."""
+    size = msg_size(buf, offset)
+    if size == 0 or len(buf) - offset < size:
+        return None, 0
+    msgtype = buf[offset] >> 4
+    if msgtype == PACMAN_UPDATE:
+        first, x, y, speed = PACMAN_MSG.unpack_from(buf, offset)
+        dirn = first >> 25 & 0x7
+        if dirn > Direction.NONE or not valid_position(x, y) or not valid_speed(speed):
+            return None, size
+        return ["pacman", [(x, y), Direction(dirn), speed]], size
+    elif msgtype == GHOST_UPDATE:
+        first, second, x, y, speed = GHOST_MSG.unpack_from(buf, offset)
+        dirn = first >> 25 & 0x7
+        mode = second >> 3 & 0x7
+        if dirn > Direction.NONE or mode > GhostMode.EYES.value \
+           or not valid_position(x, y) or not valid_speed(speed):
+            return None, size
+        return ["ghost", [second >> 6, (x, y), Direction(dirn), speed, GhostMode(mode)]], size
+    elif msgtype == EAT:
+        first, x, y = EAT_MSG.unpack_from(buf, offset)
+        if not valid_position(x * GRID_SIZE, y * GRID_SIZE):
+            return None, size
+        # food positions are grid squares
+        pos = (int(round(x)), int(round(y)))
+        return ["eat", [pos, bool(first & 0x8), bool(first & 0x4)]], size
+    elif msgtype == SCORE_UPDATE:
+        score, = SCORE_MSG.unpack_from(buf, offset)
+        return ["score", [score & MAX_SCORE]], size
+    elif msgtype == LIVES_UPDATE:
+        return ["lives", [buf[offset] >> 1 & 0x7]], size
+    elif msgtype == STATUS_UPDATE:
+        status = buf[offset] >> 1 & 0x7
+        if status > GameMode.READY_TO_RESTART.value:
+            return None, size
+        return ["status", [GameMode(status)]], size
+    elif msgtype == FOREIGN_PACMAN_ATE_GHOST:
+        return ["ghosteaten", [buf[offset] >> 2 & 0x3]], size
+    elif msgtype == MAZE_UPDATE:
+        return decode_maze(buf, offset), size
+    elif msgtype == UDP_PORT:
+        first, port = PORT_MSG.unpack_from(buf, offset)
+        return ["udpport", [port]], size
+    elif msgtype == STATE_DELTA:
+        return decode_delta(buf, offset), size
+    else:
+        return [MSG_NAMES[msgtype], []], size
+
+def decode_maze(buf, offset):
+    first, food_count, width, height = MAZE_HEADER.unpack_from(buf, offset)
+    level = first & 0xf
+    start = offset + MAZE_HEADER.size
+    cells = []
+    for byte in buf[start:start + (width * height + 1) // 2]:
+        cells.append(byte >> 4)
+        cells.append(byte & 0xf)
+    if max(cells) > 5:
+        return None
+    maze = Maze(level)
+    if maze.height != height or maze.width != width:
+        return None
+    maze.restore_walls(bytearray(cells[:width * height]), food_count)
+    return ["maze", maze]
+
+def decode_delta(buf, offset):
+    # the fields that weren't sent are None
+    first, mask = DELTA_HEADER.unpack_from(buf, offset)
+    entity = first >> 25 & 0x7
+    if entity > PACMAN_ENTITY:
+        return None
+    state = [None, None, None, None]
+    offset += DELTA_HEADER.size
+    if mask & DELTA_X:
+        state[0], = COORD.unpack_from(buf, offset)
+        offset += COORD.size
+    if mask & DELTA_Y:
+        state[1], = COORD.unpack_from(buf, offset)
+        offset += COORD.size
+    if mask & DELTA_DIRMODE:
+        state[2] = buf[offset]
+        offset += 1
+        if state[2] >> 4 > Direction.NONE or state[2] & 0xf > GhostMode.EYES.value:
+            return None
+    if mask & DELTA_SPEED:
+        state[3], = SPEED.unpack_from(buf, offset)
+    return ["delta", [entity, state]]
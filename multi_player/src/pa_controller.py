@@ -3,7 +3,8 @@
 from tkinter import *
 from pa_model import Model, Status
 from pa_view import View
-from pa_settings import Direction, LOGTIME
+from pa_settings import Direction, LOGTIME, FIXED_TIMESTEP, TICK_RATE, \
+    MAX_TICKS_PER_FRAME
 from pa_network import Network
 from sys import argv
 from getopt import getopt, GetoptError
@@ -29,13 +30,17 @@ class Controller():
         self.powerpill_coords = [[],[]]
         self.mylives = 0
         self.theirlives = 0
+        # goes up whenever the score, level or lives change (the model
+        # reports the score every tick, changed or not), so the views
+        # know when to redraw them
+        self.hud_version = 0
         self.maze = [None,None]
         self.net = None
         self.model = Model(self, self.mazenum);
         self.add_view(View(self.root, self, "local", 2), 0)
         if self.multiview:
             self.add_view(View(self.root, self, "remote", 1), 1)
-        self.net = Network(self, self.passwd)
+        self.net = Network(self, self.passwd, self.legacy)
         self.local_ip = self.net.get_local_ip_addr()
         if self.serv:
             self.views[0].display_msg("Waiting for Player 2 to connect\nIP addr: " + self.local_ip)
@@ -51,15 +56,16 @@ class Controller():
         """Initialise the attributes according to the command line arguments."""
         try:
             if "pacman.py" in argv[0]:
-                opts, args = getopt(argv[1:], "srm:c:p:", ["remote", "mazenum=", "server", "connect=", "passwd="])
+                opts, args = getopt(argv[1:], "srm:c:p:l", ["remote", "mazenum=", "server", "connect=", "passwd=", "legacy"])
             else:
-                opts, args = getopt(argv, "srm:c:p:", ["remote", "mazenum=", "server", "connect=", "passwd="])
+                opts, args = getopt(argv, "srm:c:p:l", ["remote", "mazenum=", "server", "connect=", "passwd=", "legacy"])
         except GetoptError:
             self.usage()
         self.passwd = "000000"
         self.serv = False
         self.multiview = False
         self.connect_to = "127.0.0.1"
+        self.legacy = False
         random = Random(time.time())
         self.mazenum=random.randrange(3)
         for opt, arg in opts:
@@ -73,6 +79,9 @@ class Controller():
                 self.connect_to = arg
             elif opt in ("-p", "--passwd"):
                 self.passwd = arg
+            elif opt in ("-l", "--legacy"):
+                # let an old client that only speaks pickle connect
+                self.legacy = True
             else:
                 self.usage()
         if self.serv:
@@ -88,7 +97,7 @@ class Controller():
             self.net.client(self.connect_to, 9872)
     # Prompt the user how to use the program
     def usage(self):
-        print("pacman.py [-s | --server] [-c <ip address> | --connect=<ip address>] \n          [-p <password> | --passwd=<password>]")
+        print("pacman.py [-s | --server] [-c <ip address> | --connect=<ip address>] \n          [-p <password> | --passwd=<password>] [-l | --legacy]")
         sys.exit(2)
 
     def display_msg(self, msg, screen):
@@ -160,12 +169,16 @@ class Controller():
     #some helper functions to hide the controller implementation from
     #the model and the controller
     def update_score(self, score):
-        self.score = score
+        if score != self.score:
+            self.score = score
+            self.hud_version += 1
         if self.net is not None:
             self.net.send_score_update(score)
 
     def update_remote_score(self, remote_score):
-        self.remote_score = remote_score
+        if remote_score != self.remote_score:
+            self.remote_score = remote_score
+            self.hud_version += 1
 
     def get_scores(self):
         return self.score, self.remote_score
@@ -179,7 +192,9 @@ class Controller():
             self.views[screen].update_maze(maze)
         
     def update_level(self, level, screen):
-        self.level = level
+        if level != self.level:
+            self.level = level
+            self.hud_version += 1
         if self.views[screen] is not None:
             self.views[screen].reset_level()
 
@@ -187,12 +202,16 @@ class Controller():
         return self.level
 
     def update_lives(self, mylives):
-        self.mylives = mylives
+        if mylives != self.mylives:
+            self.mylives = mylives
+            self.hud_version += 1
         if self.net is not None:
             self.net.send_lives_update(mylives)
 
     def update_remote_lives(self, remote_lives):
-        self.theirlives = remote_lives
+        if remote_lives != self.theirlives:
+            self.theirlives = remote_lives
+            self.hud_version += 1
 
     def get_lives(self):
         return self.mylives,self.theirlives
@@ -309,17 +328,43 @@ class Controller():
     def remote_status_update(self, status):
         self.model.remote_status_update(status)
 
+    # Run the model for every tick that's due by now, each at exactly
+    # its own time so the game plays the same however fast we redraw.
+    def run_ticks(self, now):
+        ticks = 0
+        while now >= self.next_tick:
+            if ticks == MAX_TICKS_PER_FRAME:
+                # too far behind to catch up; just carry on from now
+                self.next_tick = now + self.tick
+                return
+            self.model.update(self.next_tick)
+            self.next_tick += self.tick
+            ticks += 1
+
+    def sleep_until(self, deadline):
+        # oversleeping only makes the next tick run a little late; it
+        # still runs with its own time
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
     def run(self):
         t_count = 0
         t = [0.0,0.0,0.0,0.0]
         t_mean = [0.0,0.0,0.0,0.0]
         t_max = [0.0,0.0,0.0,0.0]
+        self.tick = 1.0 / TICK_RATE
+        self.next_tick = time.time()
         while self.running:
             now = time.time()
             self.net.check_for_messages(now)
             if LOGTIME:
                 now2 = time.time()
-            self.model.update(now)
+            if FIXED_TIMESTEP:
+                # we wake up when a tick is due, run it, and draw what it did
+                self.run_ticks(now)
+            else:
+                self.model.update(now)
             if LOGTIME:
                 now3 = time.time()
             for view in self.views:
@@ -328,8 +373,12 @@ class Controller():
             if LOGTIME:
                 now4 = time.time()
             self.root.update()
+            # everything the model queued for the other player this frame
+            self.net.flush()
             if LOGTIME:
                 now5 = time.time()
+            if FIXED_TIMESTEP:
+                self.sleep_until(self.next_tick)
             if LOGTIME:
                 t[0] = now2 - now
                 t[1] = now3 - now2
@@ -353,5 +402,7 @@ class Controller():
                     t_mean = [0.0,0.0,0.0,0.0]
                     t_max = [0.0,0.0,0.0,0.0]
                     t_count = 0
-                        
+
+        # anything queued on the last time round the loop still goes
+        self.net.flush()
         self.root.destroy()
@@ -0,0 +1,190 @@
+# Pacman Game.  Headless controller.
+#
+# Drives the Model with no Tk, views, audio or network, as fast as the
+# CPU allows, for load tests and regression checks.  It answers the same
+# callbacks as Controller: the screen ones just keep count of what
+# happened, and the network ones go nowhere.  The other player's maze is
+# a copy of ours with nobody in it, so our pacman still has somewhere to
+# go when it takes the tunnel.
+#
+# The model runs on a simulated clock in fixed ticks of 1/TICK_RATE
+# seconds, so a game depends only on the maze, the seed and the policy.
+
+import pickle
+from pa_model import Model
+from pa_settings import TICK_RATE
+
+# the simulated clock starts here rather than at zero, because the
+# model uses a time of zero to mean "never"
+START_TIME = 1000.0
+
+class HeadlessController():
+    # policy, if given, is called as policy(controller, tick) every tick
+    # and returns a Direction to press, or None to leave the keys alone.
+    # If record is True, every callback is kept in self.events as
+    # (tick, name, args).
+    def __init__(self, mazenum, seed=None, policy=None, record=False):
+        self.mazenum = mazenum
+        self.policy = policy
+        self.events = [] if record else None
+        self.ticks = 0
+        self.tick = 1.0 / TICK_RATE
+        self.now = START_TIME
+
+        self.score = 0
+        self.remote_score = 0
+        self.level = -1
+        self.mylives = 0
+        self.theirlives = 0
+        self.deaths = 0
+        self.ghosts_eaten = 0
+        self.food_eaten = 0
+        self.powerpills_eaten = 0
+        self.finished = False
+        self.last_msg = None
+        self.pacmen = [[], []]
+        self.ghosts = [[], []]
+        self.maze = [None, None]
+
+        self.model = None
+        self.model = Model(self, mazenum, self.time, seed)
+        self.model.activate()
+
+    def time(self):
+        return self.now
+
+    def log(self, name, *args):
+        if self.events is not None:
+            self.events.append((self.ticks, name, args))
+
+    # Advance the game by one tick.
+    def step(self):
+        if self.policy is not None:
+            direction = self.policy(self, self.ticks)
+            if direction is not None:
+                self.model.key_press(direction)
+        self.ticks += 1
+        self.now = START_TIME + self.ticks * self.tick
+        self.model.update(self.now)
+
+    # Play until the game is over or max_ticks have gone by.  Returns
+    # the number of ticks played.
+    def run(self, max_ticks):
+        start = self.ticks
+        while not self.finished and self.ticks - start < max_ticks:
+            self.step()
+        return self.ticks - start
+
+    # Callbacks from the model, as in Controller.
+
+    def display_msg(self, msg, screen):
+        self.last_msg = msg
+        self.log("display_msg", msg, screen)
+
+    def unregister_objects(self):
+        self.ghosts[0].clear()
+        self.ghosts[1].clear()
+
+    def register_pacman(self, pacman, screen):
+        self.pacmen[screen].append(pacman)
+
+    def unregister_pacman(self, pacman, screen):
+        if pacman in self.pacmen[screen]:
+            self.pacmen[screen].remove(pacman)
+
+    def register_ghost(self, ghost, screen):
+        self.ghosts[screen].append(ghost)
+
+    def unregister_ghosts(self):
+        pass
+
+    def register_food(self, coordlist, screen):
+        pass
+
+    def register_powerpills(self, coordlist, screen):
+        pass
+
+    def eat(self, coords, is_powerpill, screen):
+        if is_powerpill:
+            self.powerpills_eaten += 1
+        else:
+            self.food_eaten += 1
+        self.log("eat", coords, is_powerpill, screen)
+
+    def ghost_died(self, screen):
+        self.ghosts_eaten += 1
+        self.log("ghost_died", screen)
+
+    def update_score(self, score):
+        self.score = score
+
+    def update_remote_score(self, remote_score):
+        self.remote_score = remote_score
+
+    def get_scores(self):
+        return self.score, self.remote_score
+
+    def update_maze(self, maze, screen):
+        self.maze[screen] = maze
+
+    def update_level(self, level, screen):
+        self.level = level
+        self.log("update_level", level, screen)
+
+    def get_level(self):
+        return self.level
+
+    def update_lives(self, mylives):
+        self.mylives = mylives
+
+    def update_remote_lives(self, remote_lives):
+        self.theirlives = remote_lives
+
+    def get_lives(self):
+        return self.mylives, self.theirlives
+
+    def died(self, pacman, clear_ghosts, screen):
+        if pacman.name == "Pacman1":
+            self.deaths += 1
+        self.log("died", pacman.name, screen)
+
+    def game_over(self):
+        self.finished = True
+        self.log("game_over")
+
+    # What Controller would send to the other player.  There isn't one,
+    # except that our maze goes to our own copy of "their" screen.
+
+    def send_maze(self, maze):
+        if self.model is not None:
+            self.model.received_maze(pickle.loads(pickle.dumps(maze)))
+
+    def send_foreign_pacman_arrived(self):
+        pass
+
+    def send_foreign_pacman_left(self):
+        pass
+
+    def send_pacman_go_home(self):
+        pass
+
+    def send_foreign_pacman_died(self):
+        pass
+
+    def send_pacman_update(self, pos, dir, speed):
+        pass
+
+    def send_foreign_pacman_ate_ghost(self, ghostnum):
+        pass
+
+    def send_ghost_update(self, ghostnum, pos, dir, speed, mode):
+        pass
+
+    def send_eat(self, pos, is_powerpill):
+        pass
+
+    def send_foreign_eat(self, pos, is_powerpill):
+        pass
+
+    def send_status_update(self, status):
+        self.log("send_status_update", status)
@@ -0,0 +1,178 @@
+# Pacman Game.  Compiled maze files.
+#
+# The mazeN.txt files describe each square with a 3-character glyph.
+# Parsing them means a long chain of string comparisons in both the
+# model and the view, so we do it once and cache the result in mazeN.bin
+# next to the text file.  The cache records the text file's mtime, size
+# and SHA-1 hash: if the mtime and size still match we trust it without
+# reading the text at all, if they don't but the hash does (the file was
+# touched or copied) we just update the mtime, and otherwise we compile
+# the text again.
+#
+# mazeN.bin layout, all integers big-endian:
+#   HEADER         magic, format version, mtime_ns, size, sha1,
+#                  width, height, food count, number of wall segments
+#   TUNNELS        x, y of tunnel exits A and B (NO_TUNNEL if absent)
+#   cells          width*height square types, as used by Maze.walls
+#   segments       3 bytes per wall segment to draw: glyph, x, y
+#   text           the original maze file, utf-8 (size bytes)
+
+import os
+import struct
+import hashlib
+import tempfile
+
+# glyph codes.  The walls the view draws come first.
+CORNER_TOP_LEFT = 0      # " /-"
+CORNER_BOTTOM_RIGHT = 1  # "-/ "
+HORIZONTAL = 2           # "---"
+CORNER_TOP_RIGHT = 3     # "-\ "
+CORNER_BOTTOM_LEFT = 4   # " \-"
+VERTICAL = 5             # " | "
+SOLID = 6                # "###"
+EMPTY = 7                # "   "
+FOOD = 8                 # " . "
+POWERPILL = 9            # " * "
+TUNNEL_A = 10            # " A "
+TUNNEL_B = 11            # " B "
+
+GLYPHS = {" /-": CORNER_TOP_LEFT, "-/ ": CORNER_BOTTOM_RIGHT, "---": HORIZONTAL,
+          "-\\ ": CORNER_TOP_RIGHT, " \\-": CORNER_BOTTOM_LEFT, " | ": VERTICAL,
+          "###": SOLID, "   ": EMPTY, " . ": FOOD, " * ": POWERPILL,
+          " A ": TUNNEL_A, " B ": TUNNEL_B}
+
+# the Maze.walls square type for each glyph
+SQUARE_TYPES = (1, 1, 1, 1, 1, 1, 1, 0, 2, 3, 4, 5)
+
+MAGIC = b"PMAZ"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">4sBqQ20sBBHH")
+TUNNELS = struct.Struct(">BBBB")
+SEGMENT = struct.Struct(">BBB")
+NO_TUNNEL = 255
+
+class MazeFile():
+    def __init__(self, width, height, cells, food_count, tunnel_exits, segments, lines):
+        self.width = width
+        self.height = height
+        self.cells = cells                # bytes, indexed by y*width + x
+        self.food_count = food_count
+        self.tunnel_exits = tunnel_exits  # [(x, y) of A, (x, y) of B]
+        self.segments = segments          # [(glyph, x, y)] of walls to draw
+        self.lines = lines                # the text, as read from the file
+
+def compile_lines(lines):
+    cells = bytearray()
+    segments = []
+    food_count = 0
+    tunnel_exits = [None, None]
+    for y, row in enumerate(lines):
+        for x in range(0, len(row)//3):
+            c = row[x*3:(x+1)*3]
+            glyph = GLYPHS.get(c)
+            if glyph is None:
+                raise ValueError("bad maze glyph %r at %d,%d" % (c, x, y))
+            cells.append(SQUARE_TYPES[glyph])
+            if glyph <= VERTICAL:
+                segments.append((glyph, x, y))
+            elif glyph == FOOD or glyph == POWERPILL:
+                food_count += 1
+            elif glyph == TUNNEL_A:
+                tunnel_exits[0] = (x, y)
+            elif glyph == TUNNEL_B:
+                tunnel_exits[1] = (x, y)
+    width = len(lines[0])//3
+    return MazeFile(width, len(lines), bytes(cells), food_count, tunnel_exits,
+                    segments, list(lines))
+
+def pack(maze, mtime_ns, size, sha1):
+    tunnels = []
+    for exit in maze.tunnel_exits:
+        tunnels.extend(exit if exit is not None else (NO_TUNNEL, NO_TUNNEL))
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, mtime_ns, size, sha1, maze.width,
+                         maze.height, maze.food_count, len(maze.segments)),
+             TUNNELS.pack(*tunnels), maze.cells]
+    parts.extend(SEGMENT.pack(*segment) for segment in maze.segments)
+    parts.append("".join(maze.lines).encode())
+    return b"".join(parts)
+
+def unpack(data):
+    # the maze in a cache, or None if the cache is cut short (another
+    # process was part way through writing it) or otherwise inconsistent
+    (magic, version, mtime_ns, size, sha1, width, height, food_count,
+     nsegments) = HEADER.unpack_from(data, 0)
+    if len(data) != (HEADER.size + TUNNELS.size + width * height
+                     + nsegments * SEGMENT.size + size):
+        return None
+    offset = HEADER.size
+    ax, ay, bx, by = TUNNELS.unpack_from(data, offset)
+    offset += TUNNELS.size
+    tunnel_exits = [(ax, ay) if ax != NO_TUNNEL else None,
+                    (bx, by) if bx != NO_TUNNEL else None]
+    cells = data[offset:offset + width * height]
+    offset += width * height
+    end = offset + nsegments * SEGMENT.size
+    segments = list(SEGMENT.iter_unpack(data[offset:end]))
+    try:
+        lines = data[end:].decode().splitlines(keepends=True)
+    except UnicodeDecodeError:
+        return None
+    return MazeFile(width, height, cells, food_count, tunnel_exits, segments, lines)
+
+def cache_header(data):
+    # (mtime_ns, size, sha1) of the text the cache was made from, or
+    # None if it isn't a cache we understand
+    if len(data) < HEADER.size:
+        return None
+    header = HEADER.unpack_from(data, 0)
+    if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+        return None
+    return header[2:5]
+
+def write_cache(cachename, data):
+    # it's only a cache, so if we can't write it, never mind.  Several
+    # runner workers may compile the same maze at once, so each writes
+    # its own temporary file and renames it into place.
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(cachename) or ".",
+                                       prefix=os.path.basename(cachename) + ".")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, cachename)
+    except OSError:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+
+# mazes already loaded by this process, indexed by filename
+loaded = {}
+
+def load_maze(filename):
+    if filename in loaded:
+        return loaded[filename]
+    cachename = os.path.splitext(filename)[0] + ".bin"
+    st = os.stat(filename)
+    try:
+        with open(cachename, "rb") as f:
+            data = f.read()
+    except OSError:
+        data = b""
+    header = cache_header(data)
+    maze = None
+    if header is not None and header[0] == st.st_mtime_ns and header[1] == st.st_size:
+        maze = unpack(data)
+    if maze is None:
+        with open(filename, "rb") as f:
+            text = f.read()
+        sha1 = hashlib.sha1(text).digest()
+        if header is not None and header[2] == sha1:
+            maze = unpack(data)
+        if maze is None:
+            maze = compile_lines(text.decode().splitlines(keepends=True))
+        write_cache(cachename, pack(maze, st.st_mtime_ns, st.st_size, sha1))
+    loaded[filename] = maze
+    return maze
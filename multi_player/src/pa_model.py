@@ -2,11 +2,33 @@
 
 from random import *
 from enum import Enum
+from array import array
+from collections import OrderedDict
 import time
-from pa_settings import CANVAS_WIDTH, CANVAS_HEIGHT, GRID_SIZE, STARTUP_LIVES, DONT_DIE, Direction, PAUSETIME, LOGTIME
+from pa_settings import CANVAS_WIDTH, CANVAS_HEIGHT, GRID_SIZE, STARTUP_LIVES, DONT_DIE, Direction, PAUSETIME, LOGTIME, \
+    FIXED_TIMESTEP, TICK_RATE
+from pa_mazefile import load_maze, compile_lines
 import sys
+try:
+    import numpy
+except ImportError:
+    # only used to speed up whole-grid operations
+    numpy = None
 
 speed = 0.0
+if FIXED_TIMESTEP:
+    # objects move move_speed * speed pixels per tick, and checkspeed
+    # settles on 2.0 at 60 fps
+    speed = 120 / TICK_RATE
+
+# distance to a square the BFS hasn't reached (yet)
+UNKNOWN_DIST = 1000
+
+# A level's full distance table takes width*height shorts per open
+# square.  If that's more than DIST_TABLE_MAX_BYTES we do without it, and
+# just keep the last DIST_CACHE_SIZE distance fields the ghosts asked for.
+DIST_TABLE_MAX_BYTES = 4 * 1024 * 1024
+DIST_CACHE_SIZE = 64
 
 def closer_than(pos1, pos2, thresh):
     x1, y1 = pos1
@@ -44,6 +66,18 @@ class Status(Enum):
     REMOTE_DYING = 6   # foreign object dying there
 
 class MovableObject():
+    # Fields live in slots rather than a per-object dict: it's smaller,
+    # and move() and friends read them every tick.  Subclasses add their
+    # own.
+    #
+    # version goes up whenever something a view draws changes (position,
+    # direction, status, and a ghost's mode), so views can skip objects
+    # that haven't changed since they last drew them.  Setting a field to
+    # the value it already has doesn't count.
+    __slots__ = ("__x", "__y", "__start_position", "__width",
+                 "__height", "__direction", "move_speed", "__frozen",
+                 "__original_speed", "__status", "__name", "version")
+
     def __init__(self, x, y, width, height, direction, speed, status, name):
         self.__x = x
         self.__y = y
@@ -56,6 +90,7 @@ class MovableObject():
         self.__original_speed = speed
         self.__status = status
         self.__name = name
+        self.version = 0
 
     @property
     def name(self):
@@ -71,8 +106,11 @@ class MovableObject():
 
     @position.setter
     def position(self, value):
-        self.__x = value[0]
-        self.__y = value[1]
+        x, y = value
+        if x != self.__x or y != self.__y:
+            self.__x = x
+            self.__y = y
+            self.version += 1
 
     def reset_position(self):
         self.position = self.__start_position
@@ -93,8 +131,9 @@ class MovableObject():
     # we shouldn't need this; needing it is a sign of some other bug.
     # This will hopefully allow that bug to be tracked down.
     def fix_if_outside_grid(self, tag):
-        gx, gy = self.grid_position
-        if gx >= 0 and gy >= 0 and gx <= max_x and gy <= max_y:
+        gx = int((self.__x + 0.5 * GRID_SIZE) // GRID_SIZE)
+        gy = int((self.__y + 0.5 * GRID_SIZE) // GRID_SIZE)
+        if 0 <= gx <= max_x and 0 <= gy <= max_y:
             return
         #print(tag, self.__name, "Outside grid at position", self.__x, self.__y, "grid position", gx, gy)
         if gx < 0:
@@ -105,13 +144,14 @@ class MovableObject():
             gx = max_x
         if gy > max_y:
             gy = max_y
-        self.grid_position = gx, gy
+        self.__x = gx * GRID_SIZE
+        self.__y = gy * GRID_SIZE
+        self.version += 1
     
 
     @grid_position.setter
     def grid_position(self, value):
-        self.__x = value[0] * GRID_SIZE
-        self.__y = value[1] * GRID_SIZE
+        self.position = (value[0] * GRID_SIZE, value[1] * GRID_SIZE)
 
     @property
     def direction(self):
@@ -119,7 +159,9 @@ class MovableObject():
 
     @direction.setter
     def direction(self, direction):
-        self.__direction = direction
+        if direction != self.__direction:
+            self.__direction = direction
+            self.version += 1
 
     @property
     def status(self):
@@ -127,7 +169,9 @@ class MovableObject():
 
     @status.setter
     def status(self, value):
-        self.__status = value
+        if value != self.__status:
+            self.__status = value
+            self.version += 1
 
     @property
     def on_our_screen(self):
@@ -153,41 +197,35 @@ class MovableObject():
             self.move_speed = self.__original_speed * speed_factor
 
     def move(self, maze):
-        global speed
-        prevx = self.__x
-        prevy = self.__y
-        if self.__direction == Direction.RIGHT:
-            self.__x = self.__x + self.move_speed * speed
-            if self.__x // GRID_SIZE != prevx // GRID_SIZE:
-                if self.collides_with_wall(maze):
-                    self.position = prevx, prevy
-                    self.recentre()
-                    self.stop()
-                    return True
-        elif self.__direction == Direction.LEFT:
-            self.__x = self.__x - self.move_speed * speed
-            if self.__x // GRID_SIZE != prevx // GRID_SIZE:
-                if self.collides_with_wall(maze):
-                    self.position = prevx, prevy
-                    self.recentre()
-                    self.stop()
-                    return True
-        elif self.__direction == Direction.UP:
-            self.__y = self.__y - self.move_speed * speed
-            if self.__y // GRID_SIZE != prevy // GRID_SIZE:
-                if self.collides_with_wall(maze):
-                    self.position = prevx, prevy
-                    self.recentre()
-                    self.stop()
-                    return True
-        elif self.__direction == Direction.DOWN:
-            self.__y = self.__y + self.move_speed * speed
-            if self.__y // GRID_SIZE != prevy // GRID_SIZE:
-                if self.collides_with_wall(maze):
-                    self.position = prevx, prevy
-                    self.recentre()
-                    self.stop()
-                    return True
+        x = self.__x
+        y = self.__y
+        step = self.move_speed * speed
+        direction = self.__direction
+        # only check for walls when we cross into a new square
+        if direction == Direction.RIGHT:
+            self.__x = x + step
+            crossed = self.__x // GRID_SIZE != x // GRID_SIZE
+        elif direction == Direction.LEFT:
+            self.__x = x - step
+            crossed = self.__x // GRID_SIZE != x // GRID_SIZE
+        elif direction == Direction.UP:
+            self.__y = y - step
+            crossed = self.__y // GRID_SIZE != y // GRID_SIZE
+        elif direction == Direction.DOWN:
+            self.__y = y + step
+            crossed = self.__y // GRID_SIZE != y // GRID_SIZE
+        else:
+            # Direction.NONE: nothing moves
+            crossed = False
+            step = 0
+        if crossed and self.collides_with_wall(maze):
+            self.__x = x
+            self.__y = y
+            self.recentre()
+            self.move_speed = 0
+            return True
+        if step:
+            self.version += 1
         self.fix_if_outside_grid("move")
         return False
 
@@ -198,8 +236,7 @@ class MovableObject():
         newy = (self.__y // GRID_SIZE) * GRID_SIZE
         if self.__y - newy > GRID_SIZE//2:
             newy += GRID_SIZE
-        self.__x = newx
-        self.__y = newy
+        self.position = (newx, newy)
 
     def centred(self):
         newx = (self.__x // GRID_SIZE) * GRID_SIZE
@@ -211,9 +248,9 @@ class MovableObject():
     def collides_with_wall(self, maze):
         x = int(self.__x) // GRID_SIZE
         y = int(self.__y) // GRID_SIZE
-        if self.direction == Direction.RIGHT:
+        if self.__direction == Direction.RIGHT:
             x += 1
-        if self.direction == Direction.DOWN:
+        elif self.__direction == Direction.DOWN:
             y += 1
         if maze.collides(x, y):
             return True
@@ -232,12 +269,17 @@ class MovableObject():
             
 #logs and turtles are both river objects - they move and act mostly the same
 class Pacman(MovableObject):
+    __slots__ = ("__previous_grid_position", "__user_direction", "__key_up_time",
+                 "time_of_death")
+
     def __init__(self, grid_x, grid_y, width, height, direction, speed, status, name):
         x = GRID_SIZE * grid_x
         y = GRID_SIZE * grid_y
         MovableObject.__init__(self, x, y, width, height, direction, speed, status, name)
         self.__previous_grid_position = self.grid_position
         self.__user_direction = Direction.NONE
+        self.__key_up_time = 0
+        self.time_of_death = 0
 
     def reset_position(self):
         MovableObject.reset_position(self)
@@ -281,45 +323,49 @@ class Pacman(MovableObject):
         self.__user_direction = direction
         self.__key_up_time = 0
 
-    def key_release(self):
-        self.__key_up_time = time.time()
+    # now is the model's time, not the wall clock
+    def key_release(self, now):
+        self.__key_up_time = now
         #self.__user_direction = Direction.NONE
 
+    def check_key_release(self, now):
+        # allow key press to register for half a second
+        if self.is_dying:
+            return
+        if self.__key_up_time != 0 and now - self.__key_up_time > 0.5:
+            self.__user_direction = Direction.NONE
+
     def move(self, maze):
         if self.is_dying:
             return   # can't move while dying
         if self.__user_direction != Direction.NONE:
-            # allow key press to register for half a second
-            if self.__key_up_time != 0 and time.time() - self.__key_up_time > 0.5:
-                self.__user_direction = Direction.NONE
-            else:
-                self.user_move(maze)
+            self.user_move(maze)
         result = MovableObject.move(self, maze)
         if result:
             self.stop()
 
     def in_new_square(self):
-        if self.grid_position != self.__previous_grid_position:
-            self.__previous_grid_position = self.grid_position
+        pos = self.grid_position
+        if pos != self.__previous_grid_position:
+            self.__previous_grid_position = pos
             return True
         return False
 
     def collides_with_ghost(self, ghost):
         return closer_than(self.position, ghost.position, GRID_SIZE)
 
-    def died(self):
+    def died(self, now):
         if self.status == Status.LOCAL:
             self.status = Status.LOCAL_DYING
         elif self.status == Status.AWAY:
             self.status = Status.AWAY_DYING
-        self.time_of_death = time.time()
+        self.time_of_death = now
         self.stop()
 
     @property
     def is_dying(self):
-        if self.status == Status.LOCAL_DYING or self.status == Status.AWAY_DYING:
-            return True
-        return False
+        status = self.status
+        return status == Status.LOCAL_DYING or status == Status.AWAY_DYING
         
 class GhostMode(Enum):
     SCATTER = 0
@@ -329,12 +375,17 @@ class GhostMode(Enum):
     EYES = 4
         
 class Ghost(MovableObject):
-    
-    def __init__(self, x, y, width, height, direction, speed, ghostnum, maze, status):
+    __slots__ = ("__ghostnum", "__maze", "__status", "__mode", "frighten_ending",
+                 "__remote", "grid_target_x", "grid_target_y", "target_x", "target_y",
+                 "shortest_paths", "__rand")
+
+    # rand is the model's random number generator
+    def __init__(self, x, y, width, height, direction, speed, ghostnum, maze, status, rand):
         name = "Ghost" + str(ghostnum)
         MovableObject.__init__(self, x, y, width, height, direction, speed, status, name)
         self.__ghostnum = ghostnum
         self.__maze = maze
+        self.__rand = rand
         self.__status = status
         self.__mode = GhostMode.CHASE
         self.frighten_ending = False
@@ -352,7 +403,9 @@ class Ghost(MovableObject):
 
     @mode.setter
     def mode(self, value):
-        self.__mode = value
+        if value != self.__mode:
+            self.__mode = value
+            self.version += 1
 
     @property
     def ghostnum(self):
@@ -360,12 +413,14 @@ class Ghost(MovableObject):
 
     def start_frighten_mode(self, x, y):
         assert(not self.__remote)
-        self.__mode = GhostMode.FRIGHTEN
+        self.mode = GhostMode.FRIGHTEN
+        if self.frighten_ending:
+            self.frighten_ending = False
+            self.version += 1
         self.grid_target_x = x
         self.grid_target_y = y
         self.set_speed(0.5)
         self.shortest_path()
-        self.frighten_ending = False
 
     def end_frighten_mode(self):
         assert(not self.__remote)
@@ -373,14 +428,16 @@ class Ghost(MovableObject):
             self.__mode = GhostMode.CHASE
             self.set_scatter_target()
             self.frighten_ending = False
+            self.version += 1
 
     def warn_frighten_ending(self):
         assert(not self.__remote)
-        if self.mode == GhostMode.FRIGHTEN:
+        if self.mode == GhostMode.FRIGHTEN and not self.frighten_ending:
             self.frighten_ending = True
+            self.version += 1
 
     def died(self):
-        self.__mode = GhostMode.EYES
+        self.mode = GhostMode.EYES
         self.grid_target_x = 16
         self.grid_target_y = 14
         self.shortest_path()
@@ -403,9 +460,10 @@ class Ghost(MovableObject):
 
     def print_shortest_path(self):
         s = "Ghost " + str(self.__ghostnum) + "\n"
-        for row in self.shortest_paths:
-            for sq in row:
-                if sq == 1000:
+        width = self.__maze.width
+        for y in range(0, len(self.shortest_paths)//width):
+            for sq in self.shortest_paths[y*width:(y+1)*width]:
+                if sq == UNKNOWN_DIST:
                     s += " ? "
                 elif sq == -1:
                     s += "###"
@@ -421,7 +479,7 @@ class Ghost(MovableObject):
     def get_current_dist(self, x, y, tag):
         current_dist = 0
         try:
-            current_dist = self.shortest_paths[y][x]
+            current_dist = self.shortest_paths[y * self.__maze.width + x]
         except IndexError as e:
             print("ERROR: ", self.name, "outside grid?", e)
             print("x, y =", x, y)
@@ -438,7 +496,7 @@ class Ghost(MovableObject):
             return
         current_dist = self.get_current_dist(x, y, "1")
         if current_dist == 0:
-            if self.mode == GhostMode.EYES:
+            if self.__mode == GhostMode.EYES:
                 self.mode = GhostMode.CHASE
                 self.set_scatter_target()
                 self.shortest_path()
@@ -451,26 +509,31 @@ class Ghost(MovableObject):
         olddir = self.direction
         directions = (Direction.UP, Direction.LEFT, Direction.RIGHT, Direction.DOWN)
         possible = []
+        # the neighbours are checked against the grid first, so we can
+        # index the distances directly rather than via get_current_dist
+        paths = self.shortest_paths
+        width = self.__maze.width
+        frightened = self.__mode == GhostMode.FRIGHTEN
         for i in range(0,4):
             nx, ny = neighbours[i]
             if nx < 0 or nx > max_x or ny < 0 or ny > max_y:
-                neighbour_dist = -1  # can happen near tunnel
-            else:
-                neighbour_dist = self.get_current_dist(nx, ny, "3")
-            if self.__mode == GhostMode.FRIGHTEN:
+                continue  # can happen near tunnel
+            neighbour_dist = paths[ny * width + nx]
+            if neighbour_dist < 0:
+                continue
+            if frightened:
                 # run away, run away!
-                if neighbour_dist >= 0 and neighbour_dist > current_dist:
-                    possible.append(i)
-            else:
-                if neighbour_dist >= 0 and neighbour_dist < current_dist:
+                if neighbour_dist > current_dist:
                     possible.append(i)
+            elif neighbour_dist < current_dist:
+                possible.append(i)
         if len(possible) == 0:
             # do anything
             self.set_scatter_target()
             if self.__mode == GhostMode.FRIGHTEN:
                 self.__mode = GhostMode.FRIGHTEN_TRAPPED
             return
-        randi = possible[rand.randint(0, len(possible)-1)]
+        randi = possible[self.__rand.randint(0, len(possible)-1)]
         self.direction = directions[randi]
         if self.direction != olddir:
             self.recentre()
@@ -555,13 +618,10 @@ class Ghost(MovableObject):
         
 class Maze():
     def __init__(self, mazenum):
+        # compiled once per process, and cached on disk between runs
         self.__levels = []
         for i in range(0,3):
-            leveltxt = []
-            with open("maze" + str(i) + ".txt", "rt") as f:
-                for line in f:
-                    leveltxt.append(line)
-            self.__levels.append(leveltxt)
+            self.__levels.append(load_maze("maze" + str(i) + ".txt"))
 
         #XXX
         #if serv:
@@ -569,6 +629,8 @@ class Maze():
         self.__current_level = mazenum
         self.__tunnel_exits = [None, None]
         self.__food_count = 0
+        self.__dist_hits = 0
+        self.__dist_misses = 0
         self.process_current_level()
 
     def reload(self, level):
@@ -577,56 +639,58 @@ class Maze():
         self.process_current_level()
 
     def process_current_level(self):
-        global max_x, max_y
         self.use_level = self.__current_level % len(self.__levels)
         level = self.__levels[self.use_level]
-        self.walls = []
-        self.__tunnel_exits = [None, None]
-        y = 0
-        for row in level:
-            rowwalls = []
-            for x in range(0, len(row)//3):
-                c = row[x*3:(x+1)*3]
-                if c == " /-":
-                    rowwalls.append(1)
-                elif c == "-/ ":
-                    rowwalls.append(1)
-                elif c == "---":
-                    rowwalls.append(1)
-                elif c == "-\\ ":
-                    rowwalls.append(1)
-                elif c == " \\-":
-                    rowwalls.append(1)
-                elif c == " | ":
-                    rowwalls.append(1)
-                elif c == "###":
-                    rowwalls.append(1)
-                elif c == "   ":
-                    rowwalls.append(0)
-                elif c == " . ":
-                    self.__food_count += 1
-                    rowwalls.append(2)
-                elif c == " * ":
-                    self.__food_count += 1
-                    rowwalls.append(3)
-                elif c == " A ":
-                    rowwalls.append(4)
-                    self.__tunnel_exits[0] = (x,y)
-                elif c == " B ":
-                    rowwalls.append(5)
-                    self.__tunnel_exits[1] = (x,y)
-                else:
-                    print(c)
-                    assert(False)
-            self.walls.append(rowwalls)
-            y += 1
-        max_y = len(self.walls) - 1
-        max_x = len(self.walls[0]) - 1
+        self.__tunnel_exits = list(level.tunnel_exits)
+        self.__food_count = level.food_count
+        self.set_walls(bytearray(level.cells), level.width, level.height)
+
+    # The grid is held as one bytearray of width*height squares, indexed
+    # by y*width + x: 0 empty, 1 wall, 2 food, 3 powerpill, 4 and 5 the
+    # tunnel exits.  If we have numpy, walls_array is a 2D (y, x) view of
+    # the same memory for whole-grid operations; single squares are
+    # quicker to look up in the bytearray.
+    def set_walls(self, walls, width, height):
+        global max_x, max_y
+        self.walls = walls
+        self.__width = width
+        self.__height = height
+        if numpy is not None:
+            self.walls_array = numpy.frombuffer(walls, dtype=numpy.uint8).reshape(height, width)
+        else:
+            self.walls_array = None
+        max_y = height - 1
+        max_x = width - 1
+        self.clear_distances()
+
+    # The derived state isn't pickled (a legacy peer gets the maze as a
+    # pickle), and the grid and levels go as lists of rows and lines, as
+    # they always used to.
+    def __getstate__(self):
+        width = self.__width
+        state = {"_Maze__levels": [level.lines for level in self.__levels],
+                 "_Maze__current_level": self.__current_level,
+                 "_Maze__tunnel_exits": self.__tunnel_exits,
+                 "_Maze__food_count": self.__food_count,
+                 "use_level": self.use_level,
+                 "walls": [list(self.walls[y*width:(y+1)*width])
+                           for y in range(0, self.__height)]}
+        return state
+
+    def __setstate__(self, state):
+        rows = state.pop("walls")
+        state["_Maze__levels"] = [compile_lines(lines) for lines in state["_Maze__levels"]]
+        self.__dict__.update(state)
+        self.__dist_hits = 0
+        self.__dist_misses = 0
+        self.set_walls(bytearray(square for row in rows for square in row),
+                       len(rows[0]), len(rows))
 
     def print_walls(self):
         s = ""
-        for row in self.walls:
-            for square in row:
+        width = self.__width
+        for y in range(0, self.__height):
+            for square in self.walls[y*width:(y+1)*width]:
                 if square == 0:
                     s += " "
                 elif square == 1:
@@ -642,112 +706,189 @@ class Maze():
             s += "\n"
         print(s)
 
+    # the compiled maze file, for the view to draw
     @property
     def current_level(self):
         return self.__levels[self.use_level]
 
+    @property
+    def food_count(self):
+        return self.__food_count
+
+    # replace the grid with a copy received from the remote player,
+    # which may already have had some food eaten
+    def restore_walls(self, walls, food_count):
+        self.set_walls(walls, self.__width, self.__height)
+        self.__food_count = food_count
+
+    @property
+    def width(self):
+        return self.__width
+
+    @property
+    def height(self):
+        return self.__height
+
     def collides(self, grid_x, grid_y):
-        if grid_x < 0 or grid_y < 0 or grid_x > max_x or grid_y > max_y:
-            return False
-        square = self.walls[grid_y][grid_x]
-        if square == 1:
-            return True
+        if 0 <= grid_x < self.__width and 0 <= grid_y < self.__height:
+            return self.walls[grid_y * self.__width + grid_x] == 1
         return False
 
     def create_food(self):
+        if self.walls_array is not None:
+            ys, xs = numpy.nonzero(self.walls_array == 2)
+            food_coords = list(zip(xs.tolist(), ys.tolist()))
+            ys, xs = numpy.nonzero(self.walls_array == 3)
+            powerpill_coords = list(zip(xs.tolist(), ys.tolist()))
+            return food_coords, powerpill_coords
+        width = self.__width
         food_coords = []
         powerpill_coords = []
-        y =0
-        for row in self.walls:
-            x = 0
-            for square in row:
-                if square == 2:
-                    food_coords.append((x,y))
-                elif square == 3:
-                    powerpill_coords.append((x, y))
-                x += 1
-            y += 1
+        for i, square in enumerate(self.walls):
+            if square == 2:
+                food_coords.append((i % width, i // width))
+            elif square == 3:
+                powerpill_coords.append((i % width, i // width))
         return food_coords, powerpill_coords
 
     def is_food(self, coords):
         grid_x, grid_y = coords
-        if self.walls[grid_y][grid_x] == 2:
-            return True
-        return False
+        return self.walls[grid_y * self.__width + grid_x] == 2
     
     def is_powerpill(self, coords):
         grid_x, grid_y = coords
-        if self.walls[grid_y][grid_x] == 3:
-            return True
-        return False
+        return self.walls[grid_y * self.__width + grid_x] == 3
 
     def is_tunnel(self, coords, direction):
         grid_x, grid_y = coords
-        if (self.walls[grid_y][grid_x] == 4 and direction == Direction.LEFT) \
-           or (self.walls[grid_y][grid_x] == 5 and direction == Direction.RIGHT) :
+        square = self.walls[grid_y * self.__width + grid_x]
+        if (square == 4 and direction == Direction.LEFT) \
+           or (square == 5 and direction == Direction.RIGHT) :
             return True
         return False
 
     def is_wall(self, coords):
         grid_x, grid_y = coords
-        if grid_x < 0 or grid_x > max_x or grid_y < 0 or grid_y > max_y:
-            return True
-        if self.walls[grid_y][grid_x] == 1:
-            return True
-        return False
+        if 0 <= grid_x < self.__width and 0 <= grid_y < self.__height:
+            return self.walls[grid_y * self.__width + grid_x] == 1
+        return True
     
     def eat_food(self, coords):
         grid_x, grid_y = coords
-        if self.walls[grid_y][grid_x] == 2 or self.walls[grid_y][grid_x] == 3:
-            self.walls[grid_y][grid_x] = 0
+        i = grid_y * self.__width + grid_x
+        if self.walls[i] == 2 or self.walls[i] == 3:
+            self.walls[i] = 0
             self.__food_count -= 1
         if self.__food_count <= 0:
             return True
         return False
 
-    def shortest_path(self, target_x, target_y):
-        dists = []
-        y = 0
-        for row in self.walls:
-            rowdists = []
-            x = 0
-            for square in row:
-                if square == 1 or square == 4 or square == 5:
-                    rowdists.append(-1) #it's a wall, so unreachable (or a tunnel)
-                elif square == 0 or square == 2 or square == 3:
-                    rowdists.append(1000) # large number, dist not yet known
-                x += 1
-            dists.append(rowdists)
-            y += 1
-        if target_x < 0 or target_y < 0 or target_x > max_x or target_y > max_y:
-            print(target_x, target_y, max_x, max_y)
-        dists[target_y][target_x] = 0
-        path_squares = []
-        self.add_neighbours_to_path(target_x, target_y, path_squares, dists, 1)
-        self.explore_paths(path_squares, dists, 1)
-        assert(len(dists) - 1 == max_y)
-        return dists
+    # Distances depend on the layout, so start again.  Nothing is computed
+    # until a ghost first asks, as there's no point doing so for the remote
+    # maze, which only gets displayed.
+    def clear_distances(self):
+        self.__dist_table = None
+        self.__dist_cache = None
+
+    def prepare_distances(self):
+        self.build_graph()
+        self.__dist_cache = OrderedDict()
+        open_squares = self.__dist_template.count(UNKNOWN_DIST)
+        if open_squares * len(self.__dist_template) * 2 <= DIST_TABLE_MAX_BYTES:
+            self.compute_distance_table()
+
+    # hits are distance fields found in the table or the cache, misses
+    # are the ones that needed a BFS
+    @property
+    def dist_hits(self):
+        return self.__dist_hits
 
+    @property
+    def dist_misses(self):
+        return self.__dist_misses
+
+    # Distances from every open square to every square in the maze,
+    # computed once per level.  The table holds one row of width*height
+    # shorts per open square, and __dist_rows says where each square's row
+    # starts.  Ghosts get a slice of the table, indexed by y*width + x,
+    # so changing target is just a lookup.
+    def compute_distance_table(self):
+        self.__dist_rows = {}
+        table = array('h')
+        width = self.__width
+        for i, square in enumerate(self.walls):
+            if square == 0 or square == 2 or square == 3:
+                self.__dist_rows[(i % width, i // width)] = len(table)
+                table.extend(self.compute_distances(i % width, i // width))
+        self.__dist_table = memoryview(table)
 
-    def explore_paths(self, path_squares, dists, current_dist):
-        new_path_squares = []
-        for sx,sy in path_squares:
-            if dists[sy][sx] > current_dist:
-                dists[sy][sx] = current_dist
-                self.add_neighbours_to_path(sx, sy, new_path_squares, dists, current_dist+1)
-        if len(new_path_squares) > 0:
-            self.explore_paths(new_path_squares, dists, current_dist+1)
+    def shortest_path(self, target_x, target_y):
+        if self.__dist_cache is None:
+            self.prepare_distances()
+        target = (target_x, target_y)
+        if self.__dist_table is not None:
+            start = self.__dist_rows.get(target)
+            if start is not None:
+                self.__dist_hits += 1
+                return self.__dist_table[start:start + len(self.__dist_template)]
+        # no table, or a wall or tunnel square, which isn't in it.  All
+        # the ghosts share this cache, so a corner one ghost has been to
+        # is already there for the next.
+        dists = self.__dist_cache.get(target)
+        if dists is not None:
+            self.__dist_hits += 1
+            self.__dist_cache.move_to_end(target)
+            return dists
+        self.__dist_misses += 1
+        dists = self.compute_distances(target_x, target_y)
+        self.__dist_cache[target] = dists
+        if len(self.__dist_cache) > DIST_CACHE_SIZE:
+            self.__dist_cache.popitem(last=False)
+        return dists
 
-    def add_neighbours_to_path(self, x, y, path_squares, dists, mindist):
-        neighbours = ((x, y-1), (x-1, y), (x+1, y), (x, y+1))
-        for nx,ny in neighbours:
-            if nx > 0 and nx < 28 and self.walls[ny][nx] != 1 and dists[ny][nx] >= mindist:
-                path_squares.append((nx,ny))
+    # The maze as a graph for the BFS: squares are numbered y*width + x,
+    # and neighbours[i] lists the squares a ghost can step to from square
+    # i.  Tunnels take Pacman to the other player's screen, so ghosts
+    # never path through them - they're blocked like walls, and so is
+    # the leftmost column.  dist_template holds the distances before the
+    # BFS starts: -1 for walls and tunnels, UNKNOWN_DIST for the rest.
+    def build_graph(self):
+        width = self.__width
+        height = self.__height
+        self.__dist_template = [-1 if square == 1 or square == 4 or square == 5
+                                else UNKNOWN_DIST for square in self.walls]
+        self.__neighbours = []
+        for i in range(0, width * height):
+            x = i % width
+            y = i // width
+            neighbours = []
+            for offset, ok in ((-width, y > 0), (-1, x > 1), (1, x < width - 1),
+                               (width, y < height - 1)):
+                if ok and self.__dist_template[i + offset] == UNKNOWN_DIST:
+                    neighbours.append(i + offset)
+            self.__neighbours.append(tuple(neighbours))
+
+    def compute_distances(self, target_x, target_y):
+        if target_x < 0 or target_y < 0 or target_x > max_x or target_y > max_y:
+            print(target_x, target_y, max_x, max_y)
+        # the work is done on lists, which are quicker to index than
+        # arrays, and only the result is packed into shorts
+        dists = self.__dist_template[:]
+        neighbours = self.__neighbours
+        target = target_y * self.__width + target_x
+        dists[target] = 0
+        queue = [target]
+        # iterating over the queue also visits the squares appended to it
+        for square in queue:
+            dist = dists[square] + 1
+            for n in neighbours[square]:
+                if dists[n] > dist:
+                    dists[n] = dist
+                    queue.append(n)
+        return array('h', dists)
 
     def square_is_empty(self, x, y):
-        if self.walls[y][x] != 1:
-            return True
-        return False
+        return self.walls[y * self.__width + x] != 1
 
     def tunnel_exit(self, pos):
         for i in range(0,2):
@@ -767,12 +908,17 @@ class GameMode(Enum):
     READY_TO_RESTART = 6
 
 class Model():
-    def __init__(self, controller, mazenum):
-        global rand
+    # clock is where the model gets the time from before its first tick;
+    # anything driving it faster or slower than real time (pa_headless)
+    # passes its own.  If seed is given, the ghosts' random choices are
+    # seeded with it from the start.  Each model has its own clock and
+    # random numbers, so any number of them can run in one process.
+    def __init__(self, controller, mazenum, clock=time.time, seed=None):
+        self.rand = Random(seed)
         self.controller = controller
+        self.clock = clock
         self.mylives = STARTUP_LIVES
         self.init_score()
-        rand = Random()
         self.__mazenum = mazenum
         self.__maze = Maze(mazenum)
         self.__remote_maze = None
@@ -796,10 +942,15 @@ class Model():
         self.controller.update_lives(self.mylives)
         self.controller.update_maze(self.__maze.current_level, 0)
 
+        # The model's time: the time of the tick being run, or of the last
+        # one.  Timers started between ticks (key releases, messages from
+        # the other player) use it too, so they go by ticks, not by when
+        # Tk or the network got round to us.
+        self.now = self.clock()
+
         # initialized speed measurement (see checkspeed for use)
-        now = time.time()
-        self.lastframe = now
-        self.start_time = now
+        self.lastframe = self.now
+        self.start_time = self.now
         self.framecount = 0
         self.dont_update_speed = True
 
@@ -836,12 +987,12 @@ class Model():
             x = sx * GRID_SIZE
             y = sy * GRID_SIZE
             direction = Direction.UP
-            ghost = Ghost(x, y, GRID_SIZE, GRID_SIZE, direction, speeds[ghostnum], ghostnum, self.__maze, Status.LOCAL)
+            ghost = Ghost(x, y, GRID_SIZE, GRID_SIZE, direction, speeds[ghostnum], ghostnum, self.__maze, Status.LOCAL, self.rand)
             self.ghosts.append(ghost)
             self.movables.append(ghost)
             self.controller.register_ghost(ghost, 0)
 
-            remote_ghost = Ghost(x, y, GRID_SIZE, GRID_SIZE, direction, speeds[ghostnum], ghostnum, self.__maze, Status.REMOTE)
+            remote_ghost = Ghost(x, y, GRID_SIZE, GRID_SIZE, direction, speeds[ghostnum], ghostnum, self.__maze, Status.REMOTE, self.rand)
             self.remote_ghosts.append(remote_ghost)
             self.controller.register_ghost(remote_ghost, 1)
 
@@ -874,7 +1025,7 @@ class Model():
         else:
             clear_ghosts = False
             screen = 1
-        self.pacman.died()
+        self.pacman.died(self.now)
         self.pacman.move_speed = 0
         self.controller.died(self.pacman, clear_ghosts, screen)
 
@@ -890,9 +1041,9 @@ class Model():
         elif mode == GameMode.CHASE:
             self.pause_end()
         elif mode == GameMode.STARTUP:
-            self.start_time = time.time()
+            self.start_time = self.now
         elif mode == GameMode.FRIGHTEN:
-            self.start_time = time.time()
+            self.start_time = self.now
             self.start_frighten_mode()
         self.__game_mode = mode
 
@@ -910,7 +1061,7 @@ class Model():
             ghost.end_frighten_mode()
 
     def pause_start(self):
-        self.start_time = time.time()
+        self.start_time = self.now
         self.pause_speedcheck()
 
     def pause_end(self):
@@ -1008,6 +1159,7 @@ class Model():
                 self.new_life()
         
         level_finished = False
+        self.pacman.check_key_release(now)
         for obj in self.movables:
             if obj.on_our_screen:
                 obj.move(self.__maze)
@@ -1131,7 +1283,7 @@ class Model():
         '''move_pacman is called when the user requests the pacman moves in a
            particular direction
         '''
-        self.pacman.key_release()
+        self.pacman.key_release(self.now)
 
     def received_maze(self, maze):
         self.__remote_maze = maze
@@ -1164,7 +1316,7 @@ class Model():
         else:
             screen = 1
         self.foreign_pacman.speed = 0
-        self.foreign_pacman.died()
+        self.foreign_pacman.died(self.now)
         clear_ghosts = False
         self.controller.died(self.foreign_pacman, clear_ghosts,screen)
         self.foreign_pacman.status = Status.REMOTE_DYING
@@ -1201,7 +1353,7 @@ class Model():
     def remote_ghost_update(self, ghostnum, pos, dir, speed, mode):
         ghost = self.remote_ghosts[ghostnum]
         ghost.position = pos
-        ghost.directon = dir
+        ghost.direction = dir
         ghost.speed = speed
         ghost.mode = mode
 
@@ -1222,6 +1374,9 @@ class Model():
     ''' adjust game speed so it's more or less the same on different machines '''
     def checkspeed(self, now):
         global speed
+        if FIXED_TIMESTEP:
+            # speed is fixed, and the controller does the waiting
+            return
         self.framecount = self.framecount + 1
         # only check every ten frames                                                        
         if self.framecount == 10:
@@ -1274,9 +1429,10 @@ class Model():
         global speed
         speed = self.previous_speed
         self.framecount = 0
-        self.lastframe = time.time()
-        
+        self.lastframe = self.now
+
     def update(self, now):
+        self.now = now
         if self.__game_mode == GameMode.CHASE or self.__game_mode == GameMode.FRIGHTEN:
             self.update_objects(now)
             self.controller.update_score(self.score)
@@ -2,12 +2,47 @@ import socket
 import sys
 import pickle # serializes and deserializes a Python object structure
 import select
+import time
 from time import sleep
+from pa_codec import PROTOCOL_VERSION, HELLO_FRAMES, CONFIRM_FRAMES, SEQ_MASK, PACMAN_ENTITY, DELTA_ALL, \
+     DELTA_X, DELTA_Y, DELTA_DIRMODE, DELTA_SPEED, hello_frame, confirm_frame, encode, decode, msg_seq, \
+     encode_delta, quantize_state, unquantize_pos, unquantize_speed, valid_position
+from pa_settings import Direction
+from pa_model import GhostMode
+
+# how long to wait for each step of agreeing a protocol version
+HELLO_TIMEOUT = 5.0
+
+# high rate state messages, sent over UDP once we know it gets through
+STATE_MSGS = ("pacman", "ghost", "delta")
+# Until the other side confirms it hears our datagrams, updates go over
+# TCP and only an occasional copy is sent over UDP to test the path.
+# Through the relay server UDP never gets through, so give up eventually.
+UDP_PROBE_INTERVAL = 0.5
+UDP_MAX_PROBES = 20
+
+# With STATE_DELTA, a pacman or ghost that hasn't changed isn't sent at
+# all, but we still send everything about it this often, in case the
+# other side has recreated its copy since.
+KEYFRAME_INTERVAL = 1.0
+
+# events where a newer message makes an older one pointless
+LATEST_ONLY_MSGS = ("score", "lives")
+
+# Received bytes go into one reusable buffer and are parsed where they
+# lie; unparsed bytes are only moved down to the start when there's less
+# than RECV_MIN_SPACE left at the end.
+RECV_BUF_SIZE = 32768
+RECV_MIN_SPACE = 4096
 
 class Network():
-    def __init__(self, controller, password):
+    # allow_legacy lets us fall back to pickle for a peer that doesn't
+    # announce a protocol version.  Unpickling runs whatever the other
+    # side sends, so it's off unless asked for.
+    def __init__(self, controller, password, allow_legacy=False):
         self.__controller = controller
         self.__password = password
+        self.__allow_legacy = allow_legacy
         self.__server = False
         self.__connected = False
         # Create a new socket using IPv4 addressing and TCP protocol
@@ -17,7 +52,26 @@ class Network():
             print("socket creation failed with error %s" %(err))
             sys.exit()
 
-        self.__recv_buf = bytes()
+        self.__recv_buf = bytearray(RECV_BUF_SIZE)
+        self.__recv_start = 0 # first byte not yet parsed
+        self.__recv_end = 0 # end of the bytes received so far
+        self.__protocol = 1 # pickle until we've heard the other side can do better
+        self.__seq = 0 # sequence number for pacman and ghost updates
+        self.__last_seq = {} # newest update seen from each pacman/ghost
+        self.__udp_sock = None
+        self.__peer_ip = None
+        self.__udp_peer = None # where to send datagrams, once we know
+        self.__udp_ok = False # the other side has heard our datagrams
+        self.__udp_heard = False # we've heard theirs
+        self.__udp_probes = 0
+        self.__event_msgs = [] # queued until the end of the frame
+        self.__queued_at = {} # index in __event_msgs, for LATEST_ONLY_MSGS
+        self.__last_sent = {} # last value sent, for LATEST_ONLY_MSGS
+        self.__sent_state = {} # last pacman/ghost state sent, by entity
+        self.__keyframe_time = {} # when we last sent all of it
+        self.__remote_state = {} # their pacman/ghost state, rebuilt from deltas
+        self.__state_msgs = {} # newest pacman/ghost updates, indexed by ghostnum or "pacman"
+        self.__last_probe = 0
         self.get_local_ip_addr()
 
 
@@ -58,6 +112,7 @@ class Network():
  
         self.__sock = c_sock
         self.__connected = True
+        self.negotiate_version()
             
 
     def client(self, ip, port):
@@ -67,9 +122,90 @@ class Network():
         txt = msg.decode()
         if txt == "OK\n":
             self.__connected = True
+            self.negotiate_version()
         else:
             print("handshake failed\n")
 
+    def negotiate_version(self):
+        # Both sides announce the highest protocol version they speak,
+        # and on hearing the other's, confirm the lower of the two.
+        # Neither side switches until it has heard the other's
+        # confirmation, so they can't end up reading each other's
+        # messages in different formats.
+        #
+        # An old peer never announces anything.  If the first message we
+        # get isn't a version announcement, we haven't confirmed anything,
+        # so the peer can't have switched either: we stay with pickle if
+        # that's allowed, and leave the message in the buffer for
+        # check_for_messages.  Once we've sent a confirmation there's no
+        # falling back; if theirs doesn't come, we give up.
+        self.__sock.send(hello_frame(PROTOCOL_VERSION))
+        frame, size = self.read_legacy_frame(time.time() + HELLO_TIMEOUT)
+        version = HELLO_FRAMES.get(frame)
+        if version is None:
+            if not self.__allow_legacy:
+                self.negotiation_failed("the other player didn't announce a protocol version")
+            print("using protocol version", self.__protocol)
+            return
+        self.__recv_start += size
+        version = min(version, PROTOCOL_VERSION)
+        if version < 2 and not self.__allow_legacy:
+            self.negotiation_failed("the other player only speaks the pickle protocol")
+        self.__sock.send(confirm_frame(version))
+        frame, size = self.read_legacy_frame(time.time() + HELLO_TIMEOUT)
+        if CONFIRM_FRAMES.get(frame) != version:
+            self.negotiation_failed("the other player didn't confirm protocol version "
+                                    + str(version))
+        self.__recv_start += size
+        if self.__recv_start == self.__recv_end:
+            self.__recv_start = 0
+            self.__recv_end = 0
+        self.__protocol = version
+        print("using protocol version", self.__protocol)
+        if self.__protocol >= 3:
+            self.open_udp()
+
+    def read_legacy_frame(self, deadline):
+        """Wait until deadline for the next complete length-prefixed
+        frame.  Returns its payload and its size including the prefix,
+        leaving it in the buffer, or (None, 0) if it didn't come."""
+        while True:
+            unparsed = self.__recv_end - self.__recv_start
+            if unparsed >= 2:
+                start = self.__recv_start + 2
+                recv_len = int.from_bytes(self.__recv_buf[start-2:start], byteorder='big')
+                if unparsed - 2 >= recv_len:
+                    return bytes(self.__recv_buf[start:start+recv_len]), recv_len + 2
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None, 0
+            rd, wd, ed = select.select([self.__sock],[],[],timeout)
+            if rd:
+                if self.recv_into_buf() == 0:
+                    return None, 0
+
+    def negotiation_failed(self, reason):
+        print("Can't agree a protocol version:", reason)
+        self.__sock.close()
+        self.__connected = False
+        sys.exit()
+
+    def open_udp(self):
+        # Pacman and ghost updates are frequent and only the latest one
+        # matters, so a lost packet shouldn't hold up the ones behind it
+        # as it would on TCP.  Tell the other side which port to use.
+        self.__peer_ip = self.__sock.getpeername()[0]
+        try:
+            self.__udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__udp_sock.bind(('', 0))
+        except OSError as err:
+            print("UDP disabled:", err)
+            self.__udp_sock = None
+            return
+        self.__udp_sock.setblocking(False)
+        self.__dgram_buf = bytearray(2048)
+        self.send(["udpport", [self.__udp_sock.getsockname()[1]]])
+
     def get_local_ip_addr(self):
         # ugly hacky way to find our IP address
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -87,9 +223,72 @@ class Network():
         return self.__connected
      
     
+    @property
+    def protocol(self):
+        """The protocol version agreed with the other player."""
+        return self.__protocol
+
     def send(self, msg):
-        """Rewrite the send() method."""
-        print(msg)
+        """Rewrite the send() method.
+
+        Messages are queued and go out together when flush() is called at
+        the end of the frame.  Pacman and ghost updates replace any
+        earlier one for the same pacman or ghost still in the queue, as
+        only the newest position matters, and likewise for score and
+        lives."""
+        if msg[0] == "pacman":
+            self.__state_msgs[PACMAN_ENTITY] = msg
+        elif msg[0] == "ghost":
+            self.__state_msgs[msg[1][0]] = msg
+        elif msg[0] in LATEST_ONLY_MSGS and msg[0] in self.__queued_at:
+            self.__event_msgs[self.__queued_at[msg[0]]] = msg
+        else:
+            if msg[0] in LATEST_ONLY_MSGS:
+                self.__queued_at[msg[0]] = len(self.__event_msgs)
+            self.__event_msgs.append(msg)
+
+    def flush(self):
+        """Send everything queued this frame with one sendall (and at most
+        one datagram)."""
+        if not self.__event_msgs and not self.__state_msgs:
+            return
+        send_bytes = []
+        for msg in self.__event_msgs:
+            if msg[0] in LATEST_ONLY_MSGS:
+                # the model reports the score every frame; only send changes
+                if self.__last_sent.get(msg[0]) == msg[1]:
+                    continue
+                self.__last_sent[msg[0]] = msg[1]
+            send_bytes.append(self.encode_msg(msg))
+        # updates go after the events, which may have been queued after
+        # them but could change how they're handled (e.g. pacmanleft)
+        state_msgs = list(self.__state_msgs.values())
+        self.__event_msgs.clear()
+        self.__queued_at.clear()
+        self.__state_msgs.clear()
+        state_bytes = []
+        if self.__udp_ok:
+            # every datagram stands alone, so no deltas here
+            self.send_datagram([self.encode_msg(msg) for msg in state_msgs])
+        else:
+            if self.__protocol >= 4:
+                now = time.time()
+                for msg in state_msgs:
+                    delta = self.encode_state_delta(msg, now)
+                    if delta is not None:
+                        state_bytes.append(delta)
+            else:
+                state_bytes = [self.encode_msg(msg) for msg in state_msgs]
+            if self.__udp_peer is not None and state_msgs and self.udp_probe_due():
+                self.send_datagram([self.encode_msg(msg) for msg in state_msgs])
+        if send_bytes or state_bytes:
+            self.__sock.sendall(b"".join(send_bytes + state_bytes))
+
+    def encode_msg(self, msg):
+        if self.__protocol >= 2:
+            # binary messages are self-delimiting, no length prefix needed
+            self.__seq += 1
+            return encode(msg, self.__seq)
         send_bytes = pickle.dumps(msg)
         lenbytes = len(send_bytes).to_bytes(2, byteorder='big')
         # len() return the number of bytes in the argument
@@ -100,7 +299,7 @@ class Network():
         #     -'little': least significant -> most significant
         #  return: a bytes object
   
-        self.__sock.send(lenbytes + send_bytes)
+        return lenbytes + send_bytes
     """
     pickle.dumps(): Serialize the object into a bytes stream.
         parameter: a object of string, tuple, list, dictionary,etc.
@@ -117,6 +316,53 @@ class Network():
 
 
 
+    def encode_state_delta(self, msg, now):
+        # TCP delivers everything in order, so whatever we last sent for
+        # this pacman or ghost is what the other side has; only send the
+        # fields that differ from it.
+        if msg[0] == "pacman":
+            entity = PACMAN_ENTITY
+            pos, dirn, speed = msg[1]
+            mode = None
+        else:
+            entity, pos, dirn, speed, mode = msg[1]
+        state = quantize_state(pos, dirn, speed, mode)
+        last = self.__sent_state.get(entity)
+        if last is None or now - self.__keyframe_time.get(entity, 0) > KEYFRAME_INTERVAL:
+            mask = DELTA_ALL
+            self.__keyframe_time[entity] = now
+        else:
+            mask = 0
+            if state[0] != last[0]:
+                mask |= DELTA_X
+            if state[1] != last[1]:
+                mask |= DELTA_Y
+            if state[2] != last[2]:
+                mask |= DELTA_DIRMODE
+            if state[3] != last[3]:
+                mask |= DELTA_SPEED
+            if mask == 0:
+                return None
+        self.__sent_state[entity] = state
+        self.__seq += 1
+        return encode_delta(entity, self.__seq, mask, state)
+
+    def udp_probe_due(self):
+        now = time.time()
+        if self.__udp_probes >= UDP_MAX_PROBES \
+           or now - self.__last_probe < UDP_PROBE_INTERVAL:
+            return False
+        self.__udp_probes += 1
+        self.__last_probe = now
+        return True
+
+    def send_datagram(self, msgs):
+        # several updates can share one datagram
+        try:
+            self.__udp_sock.sendto(b"".join(msgs), self.__udp_peer)
+        except OSError:
+            pass   # best effort, the next update will replace it
+
     def send_maze(self, maze):
         msg = ["maze", maze]
         self.send(msg)
@@ -131,40 +377,131 @@ class Network():
             pass
         else:
             try:
-                recv_bytes = self.__sock.recv(10000)
+                self.recv_into_buf()
             except ConnectionResetError as e:
                 print("Remote game has quit: ", e)
                 sys.exit()
 
-            self.__recv_buf += recv_bytes  # concat onto whatever is left from prev receive
-            # the first 2 bytes of __recv_buf is the length of the message, represented in bytes
-
-
-            recv_len = int.from_bytes(self.__recv_buf[0:2], byteorder='big')  
+            # parse the messages in place, without copying them out of the buffer
+            with memoryview(self.__recv_buf) as view:
+                with view[self.__recv_start:self.__recv_end] as unparsed:
+                    if self.__protocol >= 2:
+                        used = self.parse_binary_msgs(unparsed)
+                    else:
+                        used = self.parse_legacy_msgs(unparsed)
+            self.__recv_start += used
+            if self.__recv_start == self.__recv_end:
+                # the usual case: everything was parsed, start again at the front
+                self.__recv_start = 0
+                self.__recv_end = 0
+
+        if self.__udp_sock is not None:
+            # after the TCP messages, so the events sent before an update
+            # get handled before it
+            self.check_for_datagrams()
+
+    def recv_into_buf(self):
+        """Receive onto the end of whatever is left from the previous
+        receive, returning the number of bytes received."""
+        if len(self.__recv_buf) - self.__recv_end < RECV_MIN_SPACE:
+            self.compact_recv_buf()
+        with memoryview(self.__recv_buf) as view:
+            with view[self.__recv_end:] as space:
+                recv_len = self.__sock.recv_into(space)
+        self.__recv_end += recv_len
+        return recv_len
+
+    def compact_recv_buf(self):
+        # move the unparsed bytes (a partial message) down to the start
+        # of the buffer, and grow it if it's still short of space
+        # (a maze message can be bigger than the buffer)
+        unparsed = self.__recv_end - self.__recv_start
+        if self.__recv_start > 0:
+            self.__recv_buf[0:unparsed] = self.__recv_buf[self.__recv_start:self.__recv_end]
+            self.__recv_start = 0
+            self.__recv_end = unparsed
+        if len(self.__recv_buf) - self.__recv_end < RECV_MIN_SPACE:
+            self.__recv_buf.extend(bytes(len(self.__recv_buf)))
+
+    def check_for_datagrams(self):
+        while True:
+            try:
+                recv_len, addr = self.__udp_sock.recvfrom_into(self.__dgram_buf)
+            except OSError:
+                return   # nothing more to read (or an ICMP error)
+            if addr[0] != self.__peer_ip:
+                continue
+            if not self.__udp_heard:
+                # tell the other side it can stop sending updates over TCP
+                self.__udp_heard = True
+                self.send(["udpok", []])
+            with memoryview(self.__dgram_buf) as view:
+                with view[:recv_len] as dgram:
+                    self.parse_binary_msgs(dgram)
+
+    def parse_binary_msgs(self, buf):
+        """Handle all the complete messages in buf, returning how many
+        bytes were used."""
+        offset = 0
+        while offset < len(buf):
+            try:
+                msg, size = decode(buf, offset)
+            except ValueError as e:
+                # we've lost track of where messages start; nothing
+                # left in the buffer can be trusted
+                print("Corrupt message stream: ", e)
+                return len(buf)
+            if size == 0:
+                break   # wait for the rest of the message
+            if msg is not None and msg[0] in STATE_MSGS \
+               and self.is_stale(msg, msg_seq(buf, offset)):
+                msg = None
+            offset += size
+            if msg is not None:
+                self.handle_msg(msg)
+        return offset
+
+    def is_stale(self, msg, seq):
+        # Pacman and each ghost has its own stream of updates, which can
+        # arrive out of order (or twice) now they travel over UDP as well
+        # as TCP.  Drop anything not newer than what we've already used.
+        if msg[0] == "pacman":
+            key = PACMAN_ENTITY
+        else:
+            key = msg[1][0]   # ghostnum, or the entity of a delta
+        last = self.__last_seq.get(key)
+        if last is not None:
+            diff = (seq - last) & SEQ_MASK
+            if diff == 0 or diff >= (SEQ_MASK + 1) // 2:
+                return True
+        self.__last_seq[key] = seq
+        return False
+
+    def parse_legacy_msgs(self, buf):
+        """Handle all the complete length-prefixed pickle messages in buf,
+        returning how many bytes were used."""
+        offset = 0
+        while len(buf) - offset >= 2:
+            # the first 2 bytes are the length of the message
+            recv_len = int.from_bytes(buf[offset:offset+2], byteorder='big')
             # int.from_bytes(bytes, byteorder): convert bytes to an integer
-            # convert the first 2 bytes of __recv_buf (the length of message) to an integer
-
-            while (len(self.__recv_buf) - 2 >= recv_len):
-                # len(__recv_buf) is the length of the whole message,
-                # 2(used to represent length of this message) + rest (the length of original message)
-                # if true, it means we have a complete message
-
-                self.parse_msg(self.__recv_buf[2:recv_len+2])
-                # use the original message to parse
-
-                self.__recv_buf = self.__recv_buf[recv_len+2:]
-                # remove the original message from __recv_buf, 
-                # and continue to check next message if there ia any l,eft
-                if len(self.__recv_buf) > 2:
-                    # if true: message left in the buffer
+            if len(buf) - offset - 2 < recv_len:
+                break   # wait for the rest of the message
+            payload = buf[offset+2:offset+2+recv_len]
+            offset += recv_len + 2
+            if bytes(payload) in HELLO_FRAMES or bytes(payload) in CONFIRM_FRAMES:
+                # a newer peer's version messages, from before it gave up
+                # waiting for ours
+                continue
+            self.parse_msg(payload)
+        return offset
 
-                    recv_len = int.from_bytes(self.__recv_buf[0:2], byteorder='big')
-                    # continue to parse the next message until the buffer is empty
-                    
-        
     def parse_msg(self, buf):
         msg = pickle.loads(buf)
         # pickle.loads(): Deserialize the bytes stream to a Python object
+        self.handle_msg(msg)
+
+    def handle_msg(self, msg):
 
 ####1-6#############################################################################################################
 
@@ -195,6 +532,9 @@ class Network():
         elif msg[0] == "ghost":
             #A ghost update message
             self.ghost_update(msg[1])
+        elif msg[0] == "delta":
+            #The parts of a pacman or ghost update that changed
+            self.state_delta(msg[1])
 
         elif msg[0] == "ghosteaten":
             #The foreign pacman ate our ghost!
@@ -212,6 +552,14 @@ class Network():
         elif msg[0] == "status":
             #A status update message
             self.status_update(msg[1])
+
+        elif msg[0] == "udpport":
+            #The other side's UDP port for pacman and ghost updates
+            if self.__udp_sock is not None:
+                self.__udp_peer = (self.__peer_ip, msg[1][0])
+        elif msg[0] == "udpok":
+            #The other side is hearing our datagrams
+            self.__udp_ok = True
         else:
             print("Unknown message type: ", msg[0])
 
@@ -276,6 +624,8 @@ class Network():
         pos = msg[0] #position in pixels
         dir = msg[1] #direction enum
         speed = msg[2]
+        # keep our copy up to date in case deltas follow
+        self.__remote_state[PACMAN_ENTITY] = list(quantize_state(pos, dir, speed, None))
         self.__controller.foreign_pacman_update(pos, dir, speed)
 
     def send_pacman_update(self, pos, dir, speed):
@@ -293,6 +643,7 @@ class Network():
         dirn = msg[2] #direction enum
         speed = msg[3] 
         mode = msg[4] 
+        self.__remote_state[ghostnum] = list(quantize_state(pos, dirn, speed, mode))
         self.__controller.remote_ghost_update(ghostnum, pos, dirn, speed, mode)
 
     def send_ghost_update(self, ghostnum, pos, dirn, speed, mode):
@@ -303,6 +654,32 @@ class Network():
 
 
 
+######### "delta"
+##########################################
+    def state_delta(self, msg):
+        entity = msg[0]
+        fields = msg[1] # fixed point; None for the ones that didn't change
+        state = self.__remote_state.get(entity)
+        if state is None:
+            if None in fields:
+                return  # can't use a delta until we've had all of it once
+            state = self.__remote_state[entity] = [0, 0, 0, 0]
+        for i in range(0, 4):
+            if fields[i] is not None:
+                state[i] = fields[i]
+        pos = unquantize_pos(state)
+        if not valid_position(*pos):
+            return
+        dirn = Direction(state[2] >> 4)
+        speed = unquantize_speed(state)
+        if entity == PACMAN_ENTITY:
+            self.__controller.foreign_pacman_update(pos, dirn, speed)
+        else:
+            mode = GhostMode(state[2] & 0xf)
+            self.__controller.remote_ghost_update(entity, pos, dirn, speed, mode)
+
+
+
 ######## "ghosteaten"       
 ################################################################
     def send_foreign_pacman_ate_ghost(self, ghostnum):
@@ -0,0 +1,184 @@
+# Pacman Game.  Parallel headless game runner.
+#
+# Plays a batch of seeded games with pa_headless, spread over a pool of
+# worker processes, and streams each game's result back as it finishes
+# into one aggregated report:
+#
+#   pa_runner.py -g 1000 -j 8 -m 0,1,2 -p random -o results.jsonl
+#
+# Game i of a run uses seed + i, and every pairing of the mazes and
+# policies is handed out in turn, so the same command line always plays
+# the same games however many workers there are.
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+from sys import argv
+from getopt import getopt, GetoptError
+from multiprocessing import Pool
+from pa_settings import Direction
+
+DIRECTIONS = (Direction.UP, Direction.LEFT, Direction.RIGHT, Direction.DOWN)
+
+# Policies play for pacman: make_policy(seed) returns a policy as
+# pa_headless wants it, policy(controller, tick) -> Direction or None.
+
+def random_policy(seed):
+    # a random direction every 40 ticks
+    rand = random.Random(seed)
+    def policy(controller, tick):
+        if tick % 40 == 0:
+            return rand.choice(DIRECTIONS)
+        return None
+    return policy
+
+def idle_policy(seed):
+    # never touch the keys; pacman goes left until he hits a wall
+    return None
+
+POLICIES = {"random": random_policy, "idle": idle_policy}
+
+# Play one game in a worker.  The job is (game, mazenum, level, policy,
+# seed, max_ticks) and the result is a dict, ready for the report.
+def play_game(job):
+    game, mazenum, level, policy, seed, max_ticks = job
+    # imported here so the parent never loads the model
+    from pa_headless import HeadlessController
+    controller = HeadlessController(mazenum, seed, POLICIES[policy](seed))
+    model = controller.model
+    if level > 1:
+        model.level = level - 1
+        model.next_level()
+    start = time.perf_counter()
+    ticks = controller.run(max_ticks)
+    elapsed = time.perf_counter() - start
+    return {"game": game, "maze": mazenum, "start_level": level, "policy": policy,
+            "seed": seed, "score": model.score, "level": model.level,
+            "ticks": ticks, "deaths": controller.deaths,
+            "ghosts_eaten": controller.ghosts_eaten,
+            "food_eaten": controller.food_eaten, "finished": controller.finished,
+            "us_per_tick": elapsed * 1e6 / ticks if ticks else 0.0}
+
+class Report():
+    def __init__(self):
+        self.games = 0
+        self.ticks = 0
+        self.busy_us = 0.0
+        self.groups = {}   # (maze, policy) -> list of results
+
+    def add(self, result):
+        self.games += 1
+        self.ticks += result["ticks"]
+        self.busy_us += result["us_per_tick"] * result["ticks"]
+        key = (result["maze"], result["policy"])
+        self.groups.setdefault(key, []).append(result)
+
+    def print(self, wall_time, workers):
+        print("%d games, %d ticks in %.1fs on %d workers: %.0f ticks/s, %.1f us/tick per worker"
+              % (self.games, self.ticks, wall_time, workers,
+                 self.ticks / wall_time if wall_time else 0.0,
+                 self.busy_us / self.ticks if self.ticks else 0.0))
+        print("maze policy     games  score mean/min/max    level mean/max  deaths  ghosts   ticks  finished")
+        for (maze, policy), results in sorted(self.groups.items()):
+            n = len(results)
+            scores = [r["score"] for r in results]
+            levels = [r["level"] for r in results]
+            print("%4d %-10s %6d  %7.1f %6d %6d  %8.2f %4d  %6.2f  %6.2f  %6.0f  %7d"
+                  % (maze, policy, n, sum(scores) / n, min(scores), max(scores),
+                     sum(levels) / n, max(levels),
+                     sum(r["deaths"] for r in results) / n,
+                     sum(r["ghosts_eaten"] for r in results) / n,
+                     sum(r["ticks"] for r in results) / n,
+                     sum(1 for r in results if r["finished"])))
+
+class Runner():
+    def __init__(self, argv):
+        self.parse_args(argv)
+
+    def parse_args(self, argv):
+        try:
+            if "pa_runner.py" in argv[0]:
+                argv = argv[1:]
+            opts, args = getopt(argv, "g:j:m:l:p:s:t:o:v",
+                                ["games=", "jobs=", "mazes=", "level=", "policies=",
+                                 "seed=", "max-ticks=", "output=", "verbose"])
+        except GetoptError:
+            self.usage()
+        self.num_games = 100
+        self.workers = os.cpu_count() or 1
+        self.mazes = [0, 1, 2]
+        self.level = 1
+        self.policies = ["random"]
+        self.seed = 0
+        self.max_ticks = 60 * 60 * 60   # an hour of play at 60 ticks/s
+        self.output = None
+        self.verbose = False
+        try:
+            for opt, arg in opts:
+                if opt in ("-g", "--games"):
+                    self.num_games = int(arg)
+                elif opt in ("-j", "--jobs"):
+                    self.workers = int(arg)
+                elif opt in ("-m", "--mazes"):
+                    self.mazes = [int(m) for m in arg.split(",")]
+                elif opt in ("-l", "--level"):
+                    self.level = int(arg)
+                elif opt in ("-p", "--policies"):
+                    self.policies = arg.split(",")
+                elif opt in ("-s", "--seed"):
+                    self.seed = int(arg)
+                elif opt in ("-t", "--max-ticks"):
+                    self.max_ticks = int(arg)
+                elif opt in ("-o", "--output"):
+                    self.output = os.path.abspath(arg)
+                elif opt in ("-v", "--verbose"):
+                    self.verbose = True
+        except ValueError:
+            self.usage()
+        for policy in self.policies:
+            if policy not in POLICIES:
+                print("Unknown policy", policy, "- choose from", ", ".join(sorted(POLICIES)))
+                sys.exit(2)
+        if self.workers < 1 or self.level < 1:
+            self.usage()
+
+    def usage(self):
+        print("pa_runner.py [-g <n> | --games=<n>] [-j <n> | --jobs=<n>]")
+        print("             [-m <n,...> | --mazes=<n,...>] [-l <n> | --level=<n>]")
+        print("             [-p <policy,...> | --policies=<policy,...>] [-s <n> | --seed=<n>]")
+        print("             [-t <ticks> | --max-ticks=<ticks>] [-o <file> | --output=<file>]")
+        print("             [-v | --verbose]")
+        sys.exit(2)
+
+    def jobs(self):
+        # every maze with every policy, not maze i with policy i
+        pairings = list(itertools.product(self.mazes, self.policies))
+        for game in range(0, self.num_games):
+            mazenum, policy = pairings[game % len(pairings)]
+            yield (game, mazenum, self.level, policy, self.seed + game, self.max_ticks)
+
+    def run(self):
+        report = Report()
+        out = open(self.output, "w") if self.output else None
+        start = time.perf_counter()
+        with Pool(self.workers) as pool:
+            # results come back in whatever order they finish
+            for result in pool.imap_unordered(play_game, self.jobs(), chunksize=4):
+                report.add(result)
+                if out:
+                    out.write(json.dumps(result) + "\n")
+                if self.verbose:
+                    print("game %(game)d maze %(maze)d %(policy)s: score %(score)d, "
+                          "level %(level)d, %(ticks)d ticks" % result)
+        if out:
+            out.close()
+        report.print(time.perf_counter() - start, self.workers)
+
+if __name__ == "__main__":
+    # the mazes are loaded relative to the game's directory
+    runner = Runner(argv)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    runner.run()
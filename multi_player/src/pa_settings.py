@@ -12,6 +12,17 @@ PAUSETIME = 0
 LOGTIME = False
 PARTIAL_UPDATE = False
 
+# Run the model in fixed ticks of 1/TICK_RATE seconds, however fast Tk
+# manages to redraw, and redraw after each tick (or batch of ticks, if
+# we've fallen behind).  If False, the model moves once per frame and
+# checkspeed scales the speed to the measured frame rate, as it always
+# used to.
+FIXED_TIMESTEP = True
+TICK_RATE = 60
+# if we fall further behind than this (the window was dragged, the
+# machine was suspended) drop the missed ticks rather than catching up
+MAX_TICKS_PER_FRAME = 5
+
 # debugging feature
 DONT_DIE = False
 
@@ -5,101 +5,178 @@ from tkinter import font
 import time
 from pa_settings import CANVAS_WIDTH, CANVAS_HEIGHT, GRID_SIZE, Direction, PARTIAL_UPDATE
 from pa_audio import Audio
+from pa_assets import image, images_named, derived_image
 from pa_model import GhostMode
+from pa_mazefile import CORNER_TOP_LEFT, CORNER_BOTTOM_RIGHT, HORIZONTAL, \
+    CORNER_TOP_RIGHT, CORNER_BOTTOM_LEFT
 
 L_OFF = 50
 T_OFF = 50
 
 '''GameObjectView is a generic view of a game object.  All it does is
-   handle moving of the object - it just saves replicating this code into
-   PacmanView, GhostView, etc.  Everything else needs to be handled by the
-   subclasses themselves.'''
+   handle moving of the object and changing its image - it just saves
+   replicating this code into PacmanView, GhostView, etc.  Everything else
+   needs to be handled by the subclasses themselves.
+
+   Each object has one canvas image item, made the first time it is
+   drawn.  After that we only change the item's image and coords, rather
+   than deleting it and making a new one.'''
 
 class GameObjectView():
     def __init__(self, canvas, zoom):
         self.canvas = canvas
-        self.items = []
+        self.item = None
+        self.image = None
         self.zoom = zoom
         self.div = 2//zoom
         self.x = 0
         self.y = 0
 
+    def set_image(self, image):
+        if self.item is None:
+            self.item = self.canvas.create_image(L_OFF + self.x, T_OFF + self.y,
+                                                 image=image, anchor="c")
+        elif image is not self.image:
+            self.canvas.itemconfig(self.item, image=image)
+        self.image = image
+
     def moveto(self, x, y):
         x = x//self.div
         y = y//self.div
-        for item in self.items:
-            self.canvas.move(item, x - self.x, y - self.y)
+        if x == self.x and y == self.y:
+            return
         self.x = x
         self.y = y
+        if self.item is not None:
+            self.canvas.coords(self.item, L_OFF + x, T_OFF + y)
 
     def cleanup(self):
-        for item in self.items:
-            self.canvas.delete(item)
-
-def get_tuple(x):
-    if type(x) is tuple:
-        return x
-    elif type(x) is str:
-        lst = x.split(" ")
-        t = (int(lst[0]), int(lst[1]), int(lst[2]))
-        return t
-    
-    
+        if self.item is not None:
+            self.canvas.delete(self.item)
+            self.item = None
+            self.image = None
+
+# Rotating and reflecting images.  We read all the pixels in one Tcl
+# call, as rows of "#rrggbb" strings, rearrange them in Python, and write
+# them back in one more, rather than calling get and put for each pixel.
+
+def image_rows(img):
+    tk = img.tk
+    return [tk.splitlist(row) for row in tk.splitlist(tk.call(img, "data"))]
+
+def image_from_rows(rows):
+    img = PhotoImage(width=len(rows[0]), height=len(rows))
+    img.put(tuple(rows))
+    return img
+
+def rotate_image(img):
+    # 90 degrees clockwise
+    return image_from_rows(list(zip(*image_rows(img)[::-1])))
+
+def reflect_image(img):
+    return image_from_rows([row[::-1] for row in image_rows(img)])
+
+# pngs are the frames of pacman facing left.  Returns the frames for
+# each direction, indexed by Direction.
+def rotated_sprites(pngs):
+    sprites = [None, None, None, None]
+    sprites[Direction.LEFT] = pngs
+    prevlist = pngs
+    for dir in [Direction.UP, Direction.RIGHT, Direction.DOWN]:
+        prevlist = [rotate_image(image) for image in prevlist]
+        sprites[dir] = prevlist
+    return sprites
+
+# The maze walls.  Rather than hundreds of canvas lines and arcs, which Tk
+# has to consider every time it redraws, we draw them ourselves into one
+# image per maze and zoom, made the first time any view needs it.  The
+# image's top left corner goes one square up and left of (L_OFF, T_OFF),
+# because walls on the edge squares stick out that far.
+
+WALL_COLOUR = "#0000ff"
+BACKGROUND_COLOUR = "#000000"
+
+# The pixels of a quarter circle of radius r, two pixels thick, relative
+# to its centre.  dx_sign and dy_sign say which quarter.
+def arc_pixels(r, dx_sign, dy_sign):
+    pixels = []
+    for py in range(-r - 1, r + 1):
+        for px in range(-r - 1, r + 1):
+            dx = px + 0.5
+            dy = py + 0.5
+            if dx * dx_sign < 0 or dy * dy_sign < 0:
+                continue
+            d = (dx * dx + dy * dy) ** 0.5
+            if r - 1 <= d < r + 1:
+                pixels.append((px, py))
+    return pixels
+
+def wall_rows(maze, gridsize):
+    width = (maze.width + 2) * gridsize
+    height = (maze.height + 2) * gridsize
+    wall = bytearray(width * height)
+    half = gridsize // 2
+    # glyph -> (centre x, centre y) in half squares, and its pixels
+    arcs = {CORNER_TOP_LEFT: (1, 1, arc_pixels(half, -1, -1)),
+            CORNER_BOTTOM_RIGHT: (-1, -1, arc_pixels(half, 1, 1)),
+            CORNER_TOP_RIGHT: (-1, 1, arc_pixels(half, 1, -1)),
+            CORNER_BOTTOM_LEFT: (1, -1, arc_pixels(half, -1, 1))}
+    for glyph, x, y in maze.segments:
+        # centre of the square, in image pixels
+        cx = (x + 1) * gridsize
+        cy = (y + 1) * gridsize
+        if glyph in arcs:
+            hx, hy, pixels = arcs[glyph]
+            ax = cx + hx * half
+            ay = cy + hy * half
+            for px, py in pixels:
+                wall[(ay + py) * width + ax + px] = 1
+        elif glyph == HORIZONTAL:
+            for py in (cy - 1, cy):
+                wall[py * width + cx - half:py * width + cx + half] = b"\1" * gridsize
+        else:
+            for py in range(cy - half, cy + half):
+                wall[py * width + cx - 1] = 1
+                wall[py * width + cx] = 1
+    colours = (BACKGROUND_COLOUR, WALL_COLOUR)
+    return [tuple(colours[square] for square in wall[y * width:(y + 1) * width])
+            for y in range(0, height)]
+
+# Kept with the other shared images, keyed on the compiled maze segments
+# rather than the maze number, because the remote maze arrives as a copy.
+def maze_image(maze, zoom):
+    # all the pixels go to Tk in one call
+    return derived_image(("maze", tuple(maze.segments), zoom),
+                         lambda: image_from_rows(wall_rows(maze, (GRID_SIZE * zoom)//2)))
+
 class PacmanView(GameObjectView):
+    # pngs are the frames for each direction, from rotated_sprites.  They
+    # belong to the View and are shared by all its pacmen.
     def __init__(self, canvas, pacman, pngs, dying_pngs, zoom):
         GameObjectView.__init__(self, canvas, zoom)
         self.pacman = pacman
-        self.__pngs = [[],[],[],[]]
+        self.__pngs = pngs
         self.__dying_pngs = dying_pngs
-        self.__pngs[Direction.LEFT] = pngs
         self.pointing_direction = Direction.LEFT
-
-        # rotate the image to create a PacMan facing each direction
-        prevlist = pngs
-        for dir in [Direction.UP, Direction.RIGHT, Direction.DOWN]:
-            pnglist = []
-            for image in prevlist:
-                newimage = self.__rotate_image(image, Direction.RIGHT)
-                pnglist.append(newimage)
-            self.__pngs[dir] = pnglist
-            prevlist = pnglist
-            
         self.__pngnum = 0
         self.__pngcounter = 0
         self.__last_change = 0
         self.__dying = False
+        self.__version = -1
+        x, y = self.pacman.position
+        self.moveto(x, y)
         self.draw()
 
-    def __rotate_image(self, img, dir):
-        w, h = img.width(), img.height()
-        if dir in [Direction.LEFT, Direction.RIGHT]:
-            newimg = PhotoImage(width=h, height=w)
-        else: # 180 degree
-            newimg = PhotoImage(width=w, height=h)
-        for x in range(w):
-            for y in range(h):
-                rgb = '#%02x%02x%02x' % get_tuple(img.get(x, y))
-                if dir == Direction.RIGHT: # 90 degrees
-                    newimg.put(rgb, (h-y,x))
-                elif dir == Direction.LEFT: # -90 or 270 degrees
-                    newimg.put(rgb, (y,w-x))
-                else: # 180 degrees
-                    newimg.put(rgb, (w-x,h-y))
-        return newimg
-
     def draw(self):
-        x, y = self.pacman.position
         if self.__dying:
             if self.__pngnum >= len(self.__dying_pngs):
+                # he's finished dying, so there's nothing left to show
+                self.cleanup()
                 return
-            self.moveto(0, 0)
-            image = self.canvas.create_image(L_OFF, T_OFF, image=self.__dying_pngs[self.__pngnum], anchor="c")
+            self.set_image(self.__dying_pngs[self.__pngnum])
         else:
-            self.moveto(0, 0)
             d = self.pointing_direction
-            image = self.canvas.create_image(L_OFF, T_OFF, image=self.__pngs[d][self.__pngnum], anchor="c")
-        self.items.append(image)
-        self.moveto(x, y)
+            self.set_image(self.__pngs[d][self.__pngnum])
 
     def redraw(self, time_now, root):
         #if not self.pacman.on_our_screen:
@@ -109,11 +186,14 @@ class PacmanView(GameObjectView):
         if time_now - self.__last_change > 0.1:
             self.__last_change = time_now
             self.__next_png()
-            self.cleanup()
             self.draw()
-        else:
-            x, y = self.pacman.position
-            self.moveto(x, y)
+        # if he hasn't changed since we last drew him, there's nothing to do
+        pacman = self.pacman
+        if pacman.version == self.__version:
+            return
+        self.__version = pacman.version
+        x, y = pacman.position
+        self.moveto(x, y)
         if PARTIAL_UPDATE:
             root.update_idletasks()
 
@@ -158,13 +238,12 @@ class GhostView(GameObjectView):
         self.__pngs = pngs
         self.__eyes_pngs = eyes_pngs
         self.__scared_pngs = scared_pngs
-        self.__prev_direction = Direction.LEFT
-        self.__prev_mode = self.ghost.mode
+        self.__version = self.ghost.version
+        x, y = self.ghost.position
+        self.moveto(x, y)
         self.draw()
 
     def draw(self):
-        x,y = self.ghost.position
-        self.moveto(0, 0)
         if self.ghost.mode == GhostMode.CHASE:
             png = self.__pngs[self.ghost.direction]
         elif self.ghost.mode == GhostMode.FRIGHTEN:
@@ -178,20 +257,17 @@ class GhostView(GameObjectView):
             png = self.__eyes_pngs[self.ghost.direction]
             print("Fix:", self.ghost.mode)
             assert(False)
-        image = self.canvas.create_image(L_OFF, T_OFF, image=png, anchor="c")
-        self.items.append(image)
-        self.moveto(x, y)
-        self.__prev_mode = self.ghost.mode
+        self.set_image(png)
 
     def redraw(self, time_now, root):
-        if self.ghost.direction == self.__prev_direction \
-           and self.ghost.mode == self.__prev_mode:
-            x, y = self.ghost.position
-            self.moveto(x, y)
-        else:
-            self.cleanup()
-            self.draw()
-            self.__prev_direction = self.ghost.direction
+        ghost = self.ghost
+        if ghost.version == self.__version:
+            return
+        # it has moved, or its direction or mode may have changed
+        self.__version = ghost.version
+        self.draw()
+        x, y = ghost.position
+        self.moveto(x, y)
         if PARTIAL_UPDATE:
             root.update_idletasks()
 
@@ -233,36 +309,32 @@ class View(Frame):
         self.__pacman_views = []
         self.__food = {}  # we use a dict to store food, indexed by grid coordinates
         self.__powerpills = {} # also a dict
-        self.__tags = []
+        self.__maze_item = None
+        self.__hud_version = -1
         self.audio = Audio()
 
-        #Load all the images from files
-        self.__pacman_pngs = [[],[]]
-        for i in range(0, 3):
-            self.__pacman_pngs[0].append(PhotoImage(file = './assets/pacman' + str(i) + '.gif').zoom(self.zoom))
-            self.__pacman_pngs[1].append(PhotoImage(file = './assets/pacman' + str(i) + 'p.gif').zoom(self.zoom))
-        self.__pacman_dying_pngs = [[],[]]
-        for i in range(1, 11):
-            self.__pacman_dying_pngs[0].append(PhotoImage(file = './assets/pacman_dying' + str(i) + '.gif').zoom(self.zoom))
-            self.__pacman_dying_pngs[1].append(PhotoImage(file = './assets/pacman_dying' + str(i) + 'p.gif').zoom(self.zoom))
-        self.__ghost_left_pngs = []
-        for i in range(0, 4):
-            self.__ghost_left_pngs.append(PhotoImage(file = './assets/ghost' + str(i) + '.gif').zoom(self.zoom))
-        self.__ghost_up_pngs = []
-        for i in range(0, 4):
-            self.__ghost_up_pngs.append(PhotoImage(file = './assets/ghost' + str(i) + 'up.gif').zoom(self.zoom))
-        self.__ghost_down_pngs = []
-        for i in range(0, 4):
-            self.__ghost_down_pngs.append(PhotoImage(file = './assets/ghost' + str(i) + 'down.gif').zoom(self.zoom))
-        self.__ghost_scared_pngs = []
-        self.__ghost_scared_pngs.append(PhotoImage(file = './assets/ghostscared.gif').zoom(self.zoom))
-        self.__ghost_scared_pngs.append(PhotoImage(file = './assets/ghostscaredending.gif').zoom(self.zoom))
-        self.__ghost_eyes_pngs = []
-        for i in range(0,4):
-            self.__ghost_eyes_pngs.append(PhotoImage(file = './assets/eyes' + str(i) + '.gif').zoom(self.zoom))
-            
-        self.__food_png = PhotoImage(file = './assets/food.gif').zoom(self.zoom)
-        self.__powerpill_png = PhotoImage(file = './assets/powerpill.gif').zoom(self.zoom)
+        # The images are shared with any other view at the same zoom, and
+        # only loaded from file once (see pa_assets)
+        zoom = self.zoom
+        self.__pacman_pngs = [images_named(["pacman%d" % i for i in range(0, 3)], zoom),
+                              images_named(["pacman%dp" % i for i in range(0, 3)], zoom)]
+        self.__pacman_dying_pngs = [images_named(["pacman_dying%d" % i for i in range(1, 11)], zoom),
+                                    images_named(["pacman_dying%dp" % i for i in range(1, 11)], zoom)]
+        self.__ghost_left_pngs = images_named(["ghost%d" % i for i in range(0, 4)], zoom)
+        self.__ghost_up_pngs = images_named(["ghost%dup" % i for i in range(0, 4)], zoom)
+        self.__ghost_down_pngs = images_named(["ghost%ddown" % i for i in range(0, 4)], zoom)
+        self.__ghost_scared_pngs = images_named(["ghostscared", "ghostscaredending"], zoom)
+        self.__ghost_eyes_pngs = images_named(["eyes%d" % i for i in range(0, 4)], zoom)
+        self.__food_png = image("food", zoom)
+        self.__powerpill_png = image("powerpill", zoom)
+
+        # Pacmen facing every way, and ghosts facing right, are made once
+        # and shared, so registering a pacman or ghost costs nothing.
+        self.__pacman_sprites = [
+            derived_image(("pacman", zoom), lambda: rotated_sprites(self.__pacman_pngs[0])),
+            derived_image(("pacmanp", zoom), lambda: rotated_sprites(self.__pacman_pngs[1]))]
+        self.__ghost_right_pngs = derived_image(
+            ("ghostright", zoom), lambda: [reflect_image(png) for png in self.__ghost_left_pngs])
 
     def __str__(self):
         return "view-"+self.name
@@ -281,88 +353,21 @@ class View(Frame):
             self.canvas.itemconfig(self.__score_text, text="", font=self.__scorefont, fill="white")
 
     def update_maze(self, maze):
-        s = ""
-        y = 0
-        for tag in self.__tags:
-            self.canvas.delete(tag)
-        self.__tags.clear()
+        if self.__maze_item is not None:
+            self.canvas.delete(self.__maze_item)
         gridsize = (GRID_SIZE *self.zoom)//2
-        for row in maze:
-            for x in range(0, len(row)//3):
-                c = row[x*3:(x+1)*3]
-                sx = x + 0.5  # x and y give the middle of the square,
-                              # so sx, sy give the top left corner
-                sy = y - 0.5
-                if c == " /-":
-                    tag = self.canvas.create_arc(L_OFF + x * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  L_OFF + (x+1) * gridsize,
-                                                  T_OFF + (y+1) * gridsize,
-                                                  start=90, extent=90, style=ARC, width=2,
-                                                  outline = "blue")
-                    s += " /-"
-                elif c == "-/ ":
-                    tag = self.canvas.create_arc(L_OFF + (x-1) * gridsize,
-                                                  T_OFF + (y-1) * gridsize,
-                                                  L_OFF + x * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  start=270, extent=90, style=ARC, width=2,
-                                                  outline= "blue")
-                    s += "-/ "
-                elif c == "---":
-                    tag = self.canvas.create_line(L_OFF + (x-0.5) * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  L_OFF + (x+0.5) * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  width = 2, fill= "blue")
-                    s += "---"
-                elif c == "-\\ ":
-                    tag = self.canvas.create_arc(L_OFF + (x-1) * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  L_OFF + x * gridsize,
-                                                  T_OFF + (y+1) * gridsize,
-                                                  start=0, extent=90, style=ARC, width=2,
-                                                  outline= "blue")
-                    s += "-\\ "
-                elif c == " \\-":
-                    tag = self.canvas.create_arc(L_OFF + x * gridsize,
-                                                  T_OFF + (y-1) * gridsize,
-                                                  L_OFF + (x+1) * gridsize,
-                                                  T_OFF + y * gridsize,
-                                                  start=180, extent=90, style=ARC, width=2,
-                                                  outline= "blue")
-                    s += " \\-"
-                elif c == " | ":
-                    tag = self.canvas.create_line(L_OFF + x * gridsize,
-                                                  T_OFF + (y-0.5) * gridsize,
-                                                  L_OFF + x * gridsize,
-                                                  T_OFF + (y+0.5) * gridsize,
-                                                  width = 2, fill= "blue")
-                    s += " | "
-                elif c == "   ":
-                    s += "   "
-                elif c == "###":
-                    s += "   "
-                elif c == " . ":
-                    s += " . "
-                elif c == " * ":
-                    s += " * "
-                elif c == " A ":
-                    s += " A "
-                elif c == " B ":
-                    s += " B "
-                else:
-                    s += "ERROR>>>" + c + "<<<"
-                self.__tags.append(tag)
-            s += "\n"
-            y += 1
+        # the walls are one image, drawn under everything else
+        self.__maze_item = self.canvas.create_image(L_OFF - gridsize, T_OFF - gridsize,
+                                                    image=maze_image(maze, self.zoom),
+                                                    anchor="nw")
+        self.canvas.tag_lower(self.__maze_item)
 
     def register_pacman(self, pacman_model):
         if pacman_model.name == "Pacman1":
             ix = 0
         else:
             ix = 1
-        self.__pacman_views.append(PacmanView(self.canvas, pacman_model, self.__pacman_pngs[ix], self.__pacman_dying_pngs[ix], self.zoom))
+        self.__pacman_views.append(PacmanView(self.canvas, pacman_model, self.__pacman_sprites[ix], self.__pacman_dying_pngs[ix], self.zoom))
 
     def unregister_pacman(self, pacman_model):
         for view in self.__pacman_views:
@@ -376,7 +381,7 @@ class View(Frame):
         pngs = []
         pngs.append(self.__ghost_up_pngs[ghostnum])
         pngs.append(self.__ghost_left_pngs[ghostnum])
-        pngs.append(self.__reflect_image(self.__ghost_left_pngs[ghostnum]))
+        pngs.append(self.__ghost_right_pngs[ghostnum])
         pngs.append(self.__ghost_down_pngs[ghostnum])
         self.__ghost_views.append(GhostView(self.canvas, ghost_model, pngs, self.__ghost_eyes_pngs, self.__ghost_scared_pngs, self, self.zoom))
 
@@ -431,6 +436,9 @@ class View(Frame):
     def display_score(self):
         if self.name == "remote":
             return
+        if self.controller.hud_version == self.__hud_version:
+            return
+        self.__hud_version = self.controller.hud_version
         myscore, theirscore = self.controller.get_scores()
         self.canvas.itemconfig(self.__score_text, text="Level: "
                                + str(self.controller.get_level())
@@ -439,15 +447,6 @@ class View(Frame):
                                font=self.__scorefont)
         self.update_lives()
 
-    def __reflect_image(self, img):
-        w, h = img.width(), img.height()
-        newimg = PhotoImage(width=w, height=h)
-        for x in range(w):
-            for y in range(h):
-                rgb = '#%02x%02x%02x' % get_tuple(img.get(x, y))
-                newimg.put(rgb, (w-x, y))
-        return newimg
-
     def update_lives(self):
         mylives, theirlives = self.controller.get_lives()
         if mylives != self.mylives:
@@ -456,7 +455,8 @@ class View(Frame):
                 pacman_view.cleanup()
             self.mylives_pacmen.clear()
             y = GRID_SIZE * 32  # 16 rows down is where we show the lives remaining
-            life_pngs = [self.__pacman_pngs[0][2]]
+            # the life icons only ever face left, with mouth open
+            life_pngs = [[self.__pacman_pngs[0][2]]] * 4
             for i in range(0, self.mylives - 1):
                 x = 2 * GRID_SIZE * (i + 1)
                 dummy = DummyPacman(x, y)
@@ -467,7 +467,7 @@ class View(Frame):
                 pacman_view.cleanup()
             self.theirlives_pacmen.clear()
             y = (GRID_SIZE + 1) * 32  # 16 rows down is where we show the lives remaining
-            life_pngs = [self.__pacman_pngs[1][2]]
+            life_pngs = [[self.__pacman_pngs[1][2]]] * 4
             for i in range(0, self.theirlives - 1):
                 x = 2 * GRID_SIZE * (i + 1)
                 dummy = DummyPacman(x, y)
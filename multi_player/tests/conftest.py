@@ -0,0 +1,14 @@
+# The game's modules live side by side in src and import each other by
+# name, and read the maze files and assets from the current directory,
+# as they do when pacman.py is run from there.
+
+import os
+import sys
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+@pytest.fixture(autouse=True)
+def in_src(monkeypatch):
+    monkeypatch.chdir(SRC)
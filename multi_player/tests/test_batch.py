@@ -0,0 +1,64 @@
+# BatchSim against the model it copies: the same maze and the same keys,
+# played by pa_headless and by a batch of one, should give the same game.
+# The only randomness left is which of several equally good directions a
+# ghost takes, and the two sides draw those in a different order, so both
+# are made to take the first one.
+
+import random
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from pa_batch import BatchSim
+from pa_headless import HeadlessController
+from pa_model import Status, GhostMode
+from pa_settings import Direction
+
+MAX_TICKS = 6000
+
+def key_schedule(seed, ticks):
+    # a random direction every 40 ticks, as pa_runner's random policy
+    rand = random.Random(seed)
+    return [rand.choice((Direction.UP, Direction.LEFT, Direction.RIGHT, Direction.DOWN))
+            if tick % 40 == 0 else None for tick in range(0, ticks)]
+
+def make_games(mazenum, seed):
+    keys = key_schedule(seed, MAX_TICKS)
+    headless = HeadlessController(mazenum, seed, lambda controller, tick: keys[tick])
+    headless.model.rand.randint = lambda a, b: a
+    def policy(sim, tick):
+        if keys[tick] is None:
+            return None
+        return [int(keys[tick])]
+    sim = BatchSim(1, mazenum, seed, policy)
+    sim.choose = lambda possible, count: numpy.argmax(possible, axis=1)
+    return headless, sim
+
+# These games all run to game over without pacman taking the tunnel,
+# which BatchSim does differently, and all have frightened ghosts that
+# get trapped.
+@pytest.mark.parametrize("mazenum, seed", [(0, 2), (1, 1), (2, 0), (2, 2)])
+def test_batch_matches_headless(mazenum, seed):
+    headless, sim = make_games(mazenum, seed)
+    model = headless.model
+    trapped = 0
+    for tick in range(1, MAX_TICKS + 1):
+        headless.step()
+        sim.step()
+        assert model.pacman.status in (Status.LOCAL, Status.LOCAL_DYING)
+        assert model.pacman.position == (sim.pac_x[0], sim.pac_y[0]), tick
+        for ghost in model.ghosts:
+            k = ghost.ghostnum
+            assert ghost.position == (sim.ghost_x[k], sim.ghost_y[k]), (tick, k)
+            if ghost._Ghost__mode == GhostMode.FRIGHTEN_TRAPPED:
+                trapped += 1
+        assert model.score == sim.score[0], tick
+        assert model.mylives == sim.lives[0], tick
+        assert model.level == sim.level[0], tick
+        assert headless.finished == sim.finished[0], tick
+        if headless.finished:
+            break
+    assert headless.finished
+    assert trapped > 0
+    assert headless.ghosts_eaten == sim.ghosts_eaten[0]
+    assert headless.deaths == sim.deaths[0]
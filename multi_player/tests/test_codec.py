@@ -0,0 +1,77 @@
+# The binary codec: every message type survives encode and decode, and
+# fields that don't fit are refused rather than spilling into the others.
+
+import pytest
+
+from pa_codec import encode, decode, msg_seq, SEQ_MASK, MAX_SCORE
+from pa_model import Maze, GhostMode, GameMode
+from pa_settings import Direction
+
+MESSAGES = [
+    ["newpacman", []],
+    ["pacmanleft", []],
+    ["pacmandied", []],
+    ["pacmanhome", []],
+    ["udpok", []],
+    ["ghosteaten", [3]],
+    ["eat", [(13, 26), True, False]],
+    ["eat", [(1, 1), False, True]],
+    ["score", [123450]],
+    ["lives", [5]],
+    ["status", [GameMode.READY_TO_RESTART]],
+    ["pacman", [(280.0, 340.0), Direction.LEFT, 1.0]],
+    ["pacman", [(-20.0, 0.0), Direction.NONE, 0.0]],
+    ["ghost", [2, (320.0, 300.0), Direction.UP, 0.5, GhostMode.FRIGHTEN]],
+    ["ghost", [0, (120.0, 100.0), Direction.DOWN, 1.0, GhostMode.EYES]],
+    ["udpport", [54321]],
+]
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda msg: msg[0])
+def test_round_trip(msg):
+    data = encode(msg, 77)
+    assert decode(data) == (msg, len(data))
+
+def test_round_trip_maze():
+    maze = Maze(1)
+    maze.eat_food((1, 1))
+    data = encode(["maze", maze])
+    msg, size = decode(data)
+    assert size == len(data)
+    assert msg[0] == "maze"
+    assert msg[1].walls == maze.walls
+    assert msg[1].food_count == maze.food_count
+
+def test_back_to_back():
+    # no length prefixes: each message's type says where the next starts
+    data = b"".join(encode(msg, seq) for seq, msg in enumerate(MESSAGES))
+    offset = 0
+    for msg in MESSAGES:
+        decoded, size = decode(data, offset)
+        assert decoded == msg
+        offset += size
+    assert offset == len(data)
+
+def test_incomplete():
+    data = encode(MESSAGES[-3], 1)
+    for end in range(0, len(data)):
+        assert decode(data[:end]) == (None, 0)
+
+def test_seq():
+    data = encode(["pacman", [(0.0, 0.0), Direction.UP, 1.0]], SEQ_MASK + 6)
+    assert msg_seq(data) == 5
+
+def test_score_clamped():
+    data = encode(["score", [MAX_SCORE + 1000]])
+    assert decode(data)[0] == ["score", [MAX_SCORE]]
+
+@pytest.mark.parametrize("msg", [
+    ["lives", [8]],
+    ["lives", [-1]],
+    ["ghosteaten", [4]],
+    ["score", [-10]],
+    ["udpport", [65536]],
+    ["ghost", [4, (0.0, 0.0), Direction.UP, 1.0, GhostMode.CHASE]],
+], ids=lambda msg: msg[0])
+def test_out_of_range(msg):
+    with pytest.raises(ValueError):
+        encode(msg)
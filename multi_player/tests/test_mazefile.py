@@ -0,0 +1,122 @@
+# The mazeN.bin cache next to each maze file must give the same maze as
+# parsing the text, and must be thrown away when the text changes.
+
+import os
+import shutil
+import pytest
+
+import pa_mazefile
+from pa_mazefile import load_maze, compile_lines, cache_header
+
+def same_maze(a, b):
+    return (a.width == b.width and a.height == b.height
+            and bytes(a.cells) == bytes(b.cells) and a.food_count == b.food_count
+            and list(a.tunnel_exits) == list(b.tunnel_exits)
+            and [tuple(s) for s in a.segments] == [tuple(s) for s in b.segments]
+            and a.lines == b.lines)
+
+def parse(filename):
+    with open(filename, "rb") as f:
+        return compile_lines(f.read().decode().splitlines(keepends=True))
+
+@pytest.fixture
+def maze_txt(tmp_path, monkeypatch):
+    # a private copy of a real maze, and no mazes already loaded
+    filename = str(tmp_path / "maze0.txt")
+    shutil.copy("maze0.txt", filename)
+    monkeypatch.setattr(pa_mazefile, "loaded", {})
+    return filename
+
+def reload(filename):
+    pa_mazefile.loaded.clear()
+    return load_maze(filename)
+
+def cache_of(filename):
+    with open(os.path.splitext(filename)[0] + ".bin", "rb") as f:
+        return f.read()
+
+def forbid_compile(monkeypatch):
+    def compile_lines(lines):
+        raise AssertionError("the cache should have been used")
+    monkeypatch.setattr(pa_mazefile, "compile_lines", compile_lines)
+
+def edit(filename, old, new):
+    # replace the first old glyph with new, and make sure the mtime moves
+    # on even if the filesystem's clock is coarse
+    st = os.stat(filename)
+    with open(filename) as f:
+        text = f.read()
+    assert old in text
+    with open(filename, "w") as f:
+        f.write(text.replace(old, new, 1))
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+def test_cache_hit_matches_text(maze_txt, monkeypatch):
+    first = load_maze(maze_txt)
+    assert same_maze(first, parse(maze_txt))
+    assert os.path.exists(os.path.splitext(maze_txt)[0] + ".bin")
+    forbid_compile(monkeypatch)
+    cached = reload(maze_txt)
+    assert same_maze(cached, parse(maze_txt))
+
+def test_loaded_once_per_process(maze_txt):
+    assert load_maze(maze_txt) is load_maze(maze_txt)
+
+def test_edit_invalidates_cache(maze_txt):
+    before = load_maze(maze_txt)
+    # same size, so only the mtime and hash give the edit away
+    edit(maze_txt, " . ", "   ")
+    after = reload(maze_txt)
+    assert same_maze(after, parse(maze_txt))
+    assert after.food_count == before.food_count - 1
+    mtime_ns, size, sha1 = cache_header(cache_of(maze_txt))
+    assert mtime_ns == os.stat(maze_txt).st_mtime_ns
+    # and the rewritten cache is now a hit
+    assert same_maze(reload(maze_txt), after)
+
+def test_size_change_invalidates_cache(maze_txt):
+    load_maze(maze_txt)
+    st = os.stat(maze_txt)
+    with open(maze_txt) as f:
+        lines = f.read().splitlines(keepends=True)
+    with open(maze_txt, "w") as f:
+        f.write("".join(lines[:-1]))
+    # keep the old mtime, as a copy that preserves timestamps might
+    os.utime(maze_txt, ns=(st.st_atime_ns, st.st_mtime_ns))
+    after = reload(maze_txt)
+    assert after.height == len(lines) - 1
+    assert same_maze(after, parse(maze_txt))
+
+def test_touch_keeps_cache(maze_txt, monkeypatch):
+    first = load_maze(maze_txt)
+    st = os.stat(maze_txt)
+    os.utime(maze_txt, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    # the hash still matches, so the cache is used and its mtime updated
+    forbid_compile(monkeypatch)
+    touched = reload(maze_txt)
+    assert same_maze(touched, first)
+    mtime_ns, size, sha1 = cache_header(cache_of(maze_txt))
+    assert mtime_ns == st.st_mtime_ns + 1000000000
+
+def test_bad_cache_ignored(maze_txt):
+    with open(os.path.splitext(maze_txt)[0] + ".bin", "wb") as f:
+        f.write(b"not a maze cache")
+    assert same_maze(load_maze(maze_txt), parse(maze_txt))
+    assert cache_header(cache_of(maze_txt)) is not None
+
+def test_short_cache_ignored(maze_txt):
+    # a cache cut short by a writer that hadn't finished, with a header
+    # that still matches the text file
+    load_maze(maze_txt)
+    cachename = os.path.splitext(maze_txt)[0] + ".bin"
+    data = cache_of(maze_txt)
+    for length in (len(data) - 1, len(data) - 200, pa_mazefile.HEADER.size + 10):
+        with open(cachename, "wb") as f:
+            f.write(data[:length])
+        assert cache_header(cache_of(maze_txt)) is not None
+        assert same_maze(reload(maze_txt), parse(maze_txt))
+        assert cache_of(maze_txt) == data
+
+def test_write_cache_leaves_no_temporary_files(maze_txt):
+    load_maze(maze_txt)
+    assert sorted(os.listdir(os.path.dirname(maze_txt))) == ["maze0.bin", "maze0.txt"]
@@ -0,0 +1,152 @@
+# MovableObject.version only goes up when something a view draws changes.
+
+import pickle
+import pytest
+
+import pa_model
+from pa_headless import HeadlessController
+from pa_model import Maze, Pacman, Status, GhostMode, UNKNOWN_DIST
+from pa_settings import GRID_SIZE, Direction
+
+def test_remote_ghost_update_unchanged():
+    model = HeadlessController(0, seed=1).model
+    ghost = model.remote_ghosts[0]
+    model.remote_ghost_update(0, (100, 120), Direction.LEFT, 0.8, GhostMode.FRIGHTEN)
+    version = ghost.version
+    model.remote_ghost_update(0, (100, 120), Direction.LEFT, 0.8, GhostMode.FRIGHTEN)
+    assert ghost.version == version
+    model.remote_ghost_update(0, (101, 120), Direction.LEFT, 0.8, GhostMode.FRIGHTEN)
+    assert ghost.version == version + 1
+    model.remote_ghost_update(0, (101, 120), Direction.LEFT, 0.8, GhostMode.EYES)
+    assert ghost.version == version + 2
+
+def test_move_without_moving():
+    maze = Maze(0)
+    pacman = Pacman(14, 17, GRID_SIZE, GRID_SIZE, Direction.NONE, 1, Status.LOCAL, "Pacman1")
+    version = pacman.version
+    pacman.move(maze)
+    assert pacman.version == version
+    # (1, 1) is in the top left corner, with a wall above it
+    pacman.grid_position = (1, 1)
+    pacman.direction = Direction.UP
+    version = pacman.version
+    pacman.move(maze)
+    assert pacman.position == (GRID_SIZE, GRID_SIZE)
+    assert pacman.version == version
+    # hitting the wall stopped him
+    pacman.direction = Direction.RIGHT
+    pacman.speed = 1
+    version = pacman.version
+    pacman.move(maze)
+    assert pacman.position[0] > GRID_SIZE
+    assert pacman.version == version + 1
+
+def reference_distances(maze, target_x, target_y):
+    # a plain BFS over the grid, as the ghosts used to do for each
+    # target: walls and tunnels block, and nothing steps into column 0
+    width, height = maze.width, maze.height
+    blocked = lambda x, y: maze.walls[y * width + x] in (1, 4, 5)
+    dists = [-1 if blocked(i % width, i // width) else UNKNOWN_DIST
+             for i in range(0, width * height)]
+    dists[target_y * width + target_x] = 0
+    queue = [(target_x, target_y)]
+    while queue:
+        x, y = queue.pop(0)
+        dist = dists[y * width + x]
+        for nx, ny in ((x, y - 1), (x - 1, y), (x + 1, y), (x, y + 1)):
+            if 1 <= nx < width and 0 <= ny < height and not blocked(nx, ny) \
+               and dists[ny * width + nx] > dist + 1:
+                dists[ny * width + nx] = dist + 1
+                queue.append((nx, ny))
+    return dists
+
+@pytest.mark.parametrize("mazenum", [0, 1, 2])
+def test_distance_table_matches_bfs(mazenum):
+    maze = Maze(mazenum)
+    maze.shortest_path(1, 1)
+    assert maze._Maze__dist_table is not None
+    checked = 0
+    for y in range(0, maze.height):
+        for x in range(0, maze.width):
+            if maze.walls[y * maze.width + x] not in (0, 2, 3):
+                continue
+            row = list(maze.shortest_path(x, y))
+            assert row == list(maze.compute_distances(x, y))
+            assert row == reference_distances(maze, x, y)
+            checked += 1
+    assert checked > 100
+    assert maze.dist_misses == 0
+
+def open_squares(maze):
+    return [(i % maze.width, i // maze.width) for i, square in enumerate(maze.walls)
+            if square in (0, 2, 3)]
+
+def test_distance_cache_without_table(monkeypatch):
+    # too big for a table, so distance fields come from the LRU cache
+    monkeypatch.setattr(pa_model, "DIST_TABLE_MAX_BYTES", 0)
+    monkeypatch.setattr(pa_model, "DIST_CACHE_SIZE", 4)
+    maze = Maze(0)
+    squares = open_squares(maze)[:6]
+    first = maze.shortest_path(*squares[0])
+    assert maze._Maze__dist_table is None
+    assert list(first) == reference_distances(maze, *squares[0])
+    assert (maze.dist_hits, maze.dist_misses) == (0, 1)
+    assert maze.shortest_path(*squares[0]) is first
+    assert (maze.dist_hits, maze.dist_misses) == (1, 1)
+    for square in squares[1:4]:
+        maze.shortest_path(*square)
+    assert (maze.dist_hits, maze.dist_misses) == (1, 4)
+    # squares[0] was used most recently but one, so a fifth target
+    # evicts squares[1], the least recently used
+    maze.shortest_path(*squares[0])
+    maze.shortest_path(*squares[4])
+    assert (maze.dist_hits, maze.dist_misses) == (2, 5)
+    assert list(maze._Maze__dist_cache) == [squares[2], squares[3], squares[0], squares[4]]
+    maze.shortest_path(*squares[1])
+    assert (maze.dist_hits, maze.dist_misses) == (2, 6)
+    assert squares[2] not in maze._Maze__dist_cache
+    assert len(maze._Maze__dist_cache) == 4
+
+def test_distance_table_lookups_are_hits():
+    maze = Maze(0)
+    for square in open_squares(maze)[:10]:
+        maze.shortest_path(*square)
+    assert maze._Maze__dist_table is not None
+    assert (maze.dist_hits, maze.dist_misses) == (10, 0)
+    assert len(maze._Maze__dist_cache) == 0
+
+def same_squares(a, b):
+    for y in range(0, a.height):
+        for x in range(0, a.width):
+            pos = (x, y)
+            assert a.is_wall(pos) == b.is_wall(pos)
+            assert a.collides(x, y) == b.collides(x, y)
+            assert a.is_food(pos) == b.is_food(pos)
+            assert a.is_powerpill(pos) == b.is_powerpill(pos)
+            assert a.square_is_empty(x, y) == b.square_is_empty(x, y)
+
+@pytest.mark.parametrize("mazenum", [0, 1, 2])
+def test_maze_pickle_round_trip(mazenum):
+    maze = Maze(mazenum)
+    food, powerpills = maze.create_food()
+    maze.eat_food(food[0])
+    maze.shortest_path(*food[1])
+    # a legacy peer gets the grid as a list of rows, as it always did
+    state = maze.__getstate__()
+    assert state["walls"] == [list(maze.walls[y * maze.width:(y + 1) * maze.width])
+                              for y in range(0, maze.height)]
+    copy = pickle.loads(pickle.dumps(maze))
+    assert isinstance(copy.walls, bytearray)
+    assert copy.walls == maze.walls
+    assert (copy.width, copy.height, copy.food_count) == \
+        (maze.width, maze.height, maze.food_count)
+    same_squares(maze, copy)
+    assert copy.create_food() == maze.create_food()
+    assert list(copy.shortest_path(*food[1])) == list(maze.shortest_path(*food[1]))
+    if maze.walls_array is not None:
+        assert copy.walls_array.shape == (maze.height, maze.width)
+        assert (copy.walls_array == maze.walls_array).all()
+        # still a view of the grid, not a copy of it
+        copy.eat_food(food[1])
+        assert copy.walls_array[food[1][1], food[1][0]] == 0
+        assert maze.walls_array[food[1][1], food[1][0]] == 2
@@ -0,0 +1,254 @@
+# Network over a socketpair: no server, no UDP, and no looking up our
+# own address.
+
+import pickle
+import socket
+import threading
+import pytest
+
+import pa_codec
+import pa_network
+from pa_network import Network
+from pa_model import Maze, GhostMode
+from pa_settings import GRID_SIZE, Direction
+
+class Recorder():
+    # stands in for the controller, keeping every callback as (name, args)
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def callback(*args):
+            self.calls.append((name, args))
+        return callback
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setattr(Network, "get_local_ip_addr", lambda self: "127.0.0.1")
+    monkeypatch.setattr(Network, "open_udp", lambda self: None)
+    monkeypatch.setattr(pa_network, "HELLO_TIMEOUT", 0.5)
+
+def make_network(sock, allow_legacy=False):
+    net = Network(Recorder(), "secret", allow_legacy)
+    net._Network__sock = sock
+    return net
+
+def negotiate(*sides):
+    # run each side's function on its end of a socketpair, at the same time
+    socks = socket.socketpair()
+    results = [None, None]
+    def run(i):
+        try:
+            results[i] = sides[i](socks[i])
+        except SystemExit:
+            results[i] = "gave up"
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(0, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, socks
+
+def new_peer(allow_legacy=False):
+    def side(sock):
+        net = make_network(sock, allow_legacy)
+        net.negotiate_version()
+        return net.protocol
+    return side
+
+def old_peer(sock):
+    # says nothing about versions, and starts with a pickled message
+    payload = pickle.dumps(["score", [10]])
+    sock.send(len(payload).to_bytes(2, byteorder='big') + payload)
+    return "old"
+
+def silent_peer(sock):
+    return "silent"
+
+def test_negotiate():
+    results, socks = negotiate(new_peer(), new_peer())
+    assert results == [pa_network.PROTOCOL_VERSION, pa_network.PROTOCOL_VERSION]
+
+def test_no_pickle_unless_allowed():
+    results, socks = negotiate(new_peer(), old_peer)
+    assert results[0] == "gave up"
+    results, socks = negotiate(new_peer(), silent_peer)
+    assert results[0] == "gave up"
+
+def test_legacy_fallback():
+    results, socks = negotiate(new_peer(allow_legacy=True), old_peer)
+    assert results[0] == 1
+
+def test_confirmation_needed():
+    # a peer that announces a version but never confirms one could have
+    # gone either way, so we mustn't pick one for it
+    def hello_only(sock):
+        sock.send(pa_network.hello_frame(pa_network.PROTOCOL_VERSION))
+        return "hello"
+    results, socks = negotiate(new_peer(allow_legacy=True), hello_only)
+    assert results[0] == "gave up"
+
+def binary_network():
+    net = make_network(None)
+    net._Network__protocol = pa_network.PROTOCOL_VERSION
+    return net
+
+def pacman_update(x):
+    return ["pacman", [(x, 340.0), Direction.LEFT, 1.0]]
+
+def test_stale_updates():
+    net = binary_network()
+    assert not net.is_stale(pacman_update(1.0), 100)
+    assert net.is_stale(pacman_update(2.0), 100)    # a duplicate
+    assert net.is_stale(pacman_update(3.0), 99)     # overtaken
+    assert not net.is_stale(pacman_update(4.0), 101)
+    # each ghost has its own sequence
+    ghost = ["ghost", [1, (0.0, 0.0), Direction.UP, 1.0, None]]
+    assert not net.is_stale(ghost, 50)
+
+def test_stale_wraparound():
+    net = binary_network()
+    mask = pa_network.SEQ_MASK
+    assert not net.is_stale(pacman_update(1.0), mask - 1)
+    assert not net.is_stale(pacman_update(2.0), mask)
+    # 0 comes after SEQ_MASK, and everything up to half way round
+    assert not net.is_stale(pacman_update(3.0), 0)
+    assert net.is_stale(pacman_update(4.0), mask)
+    assert not net.is_stale(pacman_update(5.0), (mask + 1) // 2 - 1)
+    assert net.is_stale(pacman_update(6.0), mask)
+
+def test_reordered_updates_dropped():
+    net = binary_network()
+    mask = pa_network.SEQ_MASK
+    data = pa_network.encode(pacman_update(40.0), mask + 2) \
+        + pa_network.encode(pacman_update(20.0), mask) \
+        + pa_network.encode(pacman_update(60.0), mask + 3)
+    assert net.parse_binary_msgs(memoryview(data)) == len(data)
+    updates = [args[0][0] for name, args in net._Network__controller.calls
+               if name == "foreign_pacman_update"]
+    assert updates == [40.0, 60.0]
+
+def feed_in_pieces(net, sock, data, piece):
+    # send data a few bytes at a time, handling whatever has arrived
+    # after each piece, as if the network had split it up
+    for start in range(0, len(data), piece):
+        sock.send(data[start:start + piece])
+        net.check_for_messages(0)
+
+@pytest.mark.parametrize("piece", [1, 3, 7, 64])
+def test_partial_messages(piece):
+    ours, theirs = socket.socketpair()
+    net = make_network(ours)
+    net._Network__protocol = pa_network.PROTOCOL_VERSION
+    msgs = [["score", [1230]], pacman_update(100.0), ["lives", [3]], pacman_update(120.0)]
+    data = b"".join(pa_network.encode(msg, seq) for seq, msg in enumerate(msgs, 1))
+    feed_in_pieces(net, theirs, data, piece)
+    assert net._Network__controller.calls == [
+        ("update_remote_score", (1230,)),
+        ("foreign_pacman_update", ((100.0, 340.0), Direction.LEFT, 1.0)),
+        ("update_remote_lives", (3,)),
+        ("foreign_pacman_update", ((120.0, 340.0), Direction.LEFT, 1.0))]
+
+def test_message_bigger_than_buffer(monkeypatch):
+    # a maze doesn't fit in this buffer, so it has to move its partial
+    # message down to the front and then grow
+    monkeypatch.setattr(pa_network, "RECV_BUF_SIZE", 64)
+    monkeypatch.setattr(pa_network, "RECV_MIN_SPACE", 16)
+    ours, theirs = socket.socketpair()
+    net = make_network(ours)
+    net._Network__protocol = pa_network.PROTOCOL_VERSION
+    maze = Maze(2)
+    data = pa_network.encode(["lives", [4]]) + pa_network.encode(["maze", maze]) \
+        + pa_network.encode(["lives", [2]])
+    feed_in_pieces(net, theirs, data, 50)
+    calls = net._Network__controller.calls
+    assert [name for name, args in calls] == \
+        ["update_remote_lives", "received_maze", "update_remote_lives"]
+    assert calls[1][1][0].walls == maze.walls
+
+@pytest.mark.parametrize("piece", [1, 5, 64])
+def test_partial_legacy_messages(piece):
+    ours, theirs = socket.socketpair()
+    net = make_network(ours, allow_legacy=True)
+    data = b""
+    for msg in (["score", [50]], ["lives", [4]]):
+        payload = pickle.dumps(msg)
+        data += len(payload).to_bytes(2, byteorder='big') + payload
+    feed_in_pieces(net, theirs, data, piece)
+    assert net._Network__controller.calls == [("update_remote_score", (50,)),
+                                              ("update_remote_lives", (4,))]
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+def delta_pair(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(pa_network, "time", clock)
+    ours, theirs = socket.socketpair()
+    theirs.setblocking(False)
+    sender = make_network(ours)
+    sender._Network__protocol = pa_network.PROTOCOL_VERSION
+    return sender, theirs, clock
+
+def sent(sock):
+    try:
+        return sock.recv(4096)
+    except BlockingIOError:
+        return b""
+
+def test_delta_quantization(monkeypatch):
+    sender, theirs, clock = delta_pair(monkeypatch)
+    receiver = binary_network()
+    fixed = pa_codec.FIXED_POINT
+    for x, y, speed in ((123.456, 300.001, 0.9), (-19.99, 649.97, 0.45), (0.0, 0.0, 0.0),
+                        (333.3, 12.34, 1.0)):
+        sender.send_ghost_update(3, (x, y), Direction.RIGHT, speed, GhostMode.EYES)
+        sender.flush()
+        data = sent(theirs)
+        assert data[0] >> 4 == pa_codec.STATE_DELTA
+        receiver.parse_binary_msgs(memoryview(data))
+        name, (ghostnum, pos, dirn, rspeed, mode) = receiver._Network__controller.calls[-1]
+        assert name == "remote_ghost_update"
+        assert (ghostnum, dirn, mode) == (3, Direction.RIGHT, GhostMode.EYES)
+        assert abs(pos[0] - x) <= GRID_SIZE / fixed / 2 + 1e-9
+        assert abs(pos[1] - y) <= GRID_SIZE / fixed / 2 + 1e-9
+        assert abs(rspeed - speed) <= 1 / fixed / 2 + 1e-9
+
+def test_delta_keyframes(monkeypatch):
+    sender, theirs, clock = delta_pair(monkeypatch)
+    header = pa_codec.DELTA_HEADER.size
+    everything = header + 2 + 2 + 1 + 2
+    def update(x):
+        sender.send_pacman_update((x, 340.0), Direction.LEFT, 1.0)
+        sender.flush()
+        clock.now += 1 / 60
+        return sent(theirs)
+    # the first one has everything, and nothing's sent while nothing changes
+    assert len(update(100.0)) == everything
+    assert update(100.0) == b""
+    # then only what's changed
+    data = update(99.0)
+    assert len(data) == header + 2
+    assert data[header - 1] == pa_codec.DELTA_X
+    # and everything again every KEYFRAME_INTERVAL, changed or not
+    clock.now += pa_network.KEYFRAME_INTERVAL
+    assert len(update(99.0)) == everything
+    assert update(99.0) == b""
+
+def test_delta_needs_keyframe():
+    # a delta is no use until we've had all of the state once
+    receiver = binary_network()
+    state = pa_codec.quantize_state((100.0, 340.0), Direction.LEFT, 1.0, None)
+    data = pa_codec.encode_delta(pa_codec.PACMAN_ENTITY, 1, pa_codec.DELTA_X, state)
+    receiver.parse_binary_msgs(memoryview(data))
+    assert receiver._Network__controller.calls == []
+    data = pa_codec.encode_delta(pa_codec.PACMAN_ENTITY, 2, pa_codec.DELTA_ALL, state)
+    data += pa_codec.encode_delta(pa_codec.PACMAN_ENTITY, 3, pa_codec.DELTA_Y,
+                                  (None, state[1] + 256, None, None))
+    receiver.parse_binary_msgs(memoryview(data))
+    positions = [args[0] for name, args in receiver._Network__controller.calls]
+    assert positions == [(100.0, 340.0), (100.0, 360.0)]
@@ -0,0 +1,16 @@
+# pa_runner sweeps every maze with every policy, and the games it hands
+# out depend only on the command line.
+
+from pa_runner import Runner
+
+def test_jobs_cover_every_pairing():
+    runner = Runner(["-g", "8", "-m", "0,1", "-p", "random,idle", "-s", "100"])
+    jobs = list(runner.jobs())
+    assert [(maze, policy) for game, maze, level, policy, seed, ticks in jobs] == \
+        [(0, "random"), (0, "idle"), (1, "random"), (1, "idle")] * 2
+    assert [seed for game, maze, level, policy, seed, ticks in jobs] == list(range(100, 108))
+    assert [game for game, *rest in jobs] == list(range(8))
+
+def test_jobs_single_policy():
+    runner = Runner(["-g", "5", "-m", "0,1,2"])
+    assert [job[1] for job in runner.jobs()] == [0, 1, 2, 0, 1]
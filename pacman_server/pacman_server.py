@@ -1,27 +1,148 @@
 import socket
+import os
+import json
 from sys import argv, exit
-import select
-from time import sleep
+import selectors
+from selectors import EVENT_READ, EVENT_WRITE
+from time import sleep, time, perf_counter
+from bisect import bisect_left
+from heapq import heappush, heappop
 from getopt import getopt, GetoptError
 
+# Each connection has its own queue of bytes waiting to go out, so a slow
+# client only ever holds up its own partner.  Once a queue gets longer
+# than HIGH_WATER we stop reading from the partner that's filling it, and
+# start again when it drains below LOW_WATER.
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+RECV_SIZE = 65536
+
+# On Linux, relayed bytes are spliced from one socket into a pipe and from
+# the pipe into the partner's socket, so they never get copied into
+# Python at all.  Each connection has a pipe holding the bytes on their
+# way to it; while that pipe isn't empty we stop reading from the partner.
+# Elsewhere we recv_into one reusable buffer and only copy whatever the
+# partner's socket won't take straight away into its send queue.
+USE_SPLICE = hasattr(os, "splice")
+if USE_SPLICE:
+    SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+# With --workers, each worker accepts on its own SO_REUSEPORT socket, so
+# the two players of a game may arrive at different workers.  Workers
+# therefore hand every connection that has sent its password to the
+# parent process over a unix socket (passing the file descriptor itself),
+# the parent keeps the table of waiting passwords, and when a password
+# matches it passes both connections back to the worker that delivered
+# the second one, which relays for the pair from then on.  The unix
+# sockets are non-blocking like everything else: handoffs the other end
+# isn't ready for wait in a queue, holding their connections open, so a
+# slow worker (or parent) only delays the games being handed to it.
+HANDOFF_SIZE = 1024
+
+# Upper bounds, in seconds, of the loop latency histogram buckets; the
+# last bucket counts everything slower.  A loop's latency is how long it
+# took to deal with everything one select() returned.
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+                   0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+STATS_INTERVAL = 10.0
+# we answer a stats request once we've seen the end of its headers, or
+# this much of it, whichever comes first
+STATS_REQUEST_MAX = 8192
+
+# Connections that never send a password, never find a partner, or whose
+# game has gone quiet are closed after these many seconds (0 means never).
+# No source IP may have more than MAX_PENDING_PER_IP connections that are
+# still half open or waiting.  Each process counts its own: with --workers,
+# every worker counts the half open connections it accepted and the parent
+# the waiting ones, so one IP can have up to MAX_PENDING_PER_IP at each.
+HALF_OPEN_TIMEOUT = 10.0
+WAITING_TIMEOUT = 600.0
+IDLE_TIMEOUT = 300.0
+MAX_PENDING_PER_IP = 32
+
 class Network():
     def __init__(self):
         self.port = 9872
-        self.active_socks = []
+        # epoll (or kqueue), so the cost of each loop depends on how many
+        # sockets are busy, not how many are open
+        self.selector = selectors.DefaultSelector()
+        self.events = {}  #events we're registered for, indexed by socket
         self.half_open_socks = {}
         self.waiting_socks = {}  #socket, indexed by password
         self.waiting_passwords = {} #password, indexed by socket
         self.sock_pairs = {}
+        self.send_queues = {} #bytes not yet sent, indexed by socket
+        self.paused_socks = set() #not reading these until their partner's queue drains
+        self.pipes = {} #(read fd, write fd) of the pipe to each socket, if splicing
+        self.pipe_bytes = {} #bytes in that pipe, indexed by socket
+        self.recv_buf = bytearray(RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.num_workers = 1
+        self.worker_socks = [] #parent's end of each worker's rendezvous socket
+        self.rendezvous_sock = None #worker's end, None if not a worker
+        self.handoff_queues = {} #(message, sockets) not yet sent, by rendezvous socket
+        self.listening_sock = None
+        self.worker_num = None
+        # traffic accounting.  pair_stats holds [bytes, messages] relayed
+        # from each paired socket to its partner, and when the pair was
+        # made; a "message" is one read from the socket, since the relay
+        # doesn't look inside the stream.
+        self.start_time = time()
+        self.stats = {"connections_accepted": 0, "pairs_made": 0, "pairs_closed": 0,
+                      "bytes_relayed": 0, "messages_relayed": 0}
+        self.pair_stats = {}
+        self.pair_start = {}
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.stats_port = None
+        self.stats_sock = None
+        self.stats_clients = {} #request read so far, indexed by socket
+        self.stats_file = None
+        self.stats_interval = STATS_INTERVAL
+        self.next_stats_dump = None
+        self.stats.update({"reaped_half_open": 0, "reaped_waiting": 0,
+                           "reaped_idle": 0, "rejected_pending": 0})
+        # deadlines are kept in a heap of (deadline, seq, sock).  Entries
+        # aren't removed when they stop applying; a popped entry is only
+        # acted on if it still matches deadlines[sock].
+        self.half_open_timeout = HALF_OPEN_TIMEOUT
+        self.waiting_timeout = WAITING_TIMEOUT
+        self.idle_timeout = IDLE_TIMEOUT
+        self.max_pending_per_ip = MAX_PENDING_PER_IP
+        self.timer_heap = []
+        self.timer_seq = 0
+        self.deadlines = {}
+        self.last_active = {} #when each paired socket last sent anything
+        self.pending_ips = {} #source IP of each half open or waiting socket
+        self.pending_counts = {} #number of those, indexed by IP
+        self.now = time()
         self.logfile = open("logfile.txt", "w+")
+        self.raise_fd_limit()
+
+    def raise_fd_limit(self):
+        # every game needs two file descriptors, so the default soft limit
+        # (often 1024) is far too low
         try:
-            self.listening_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except socket.error as err: 
-            print("socket creation failed with error %s" %(err), file=self.logfile)
-            exit()
-        self.__recv_buf = bytes()
+            import resource
+        except ImportError:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError):
+                pass
 
     def listen(self):
         print("listening on port", self.port)
+        try:
+            self.listening_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.num_workers > 1:
+                # every worker binds the same port; the kernel spreads
+                # incoming connections between them
+                self.listening_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except socket.error as err:
+            print("socket creation failed with error %s" %(err), file=self.logfile)
+            exit()
         while True:
             try:
                 self.listening_sock.bind(('', self.port))
@@ -30,39 +151,317 @@ class Network():
                 print(err, file=self.logfile)
                 print("waiting, will retry in 10 seconds")
                 sleep(10)
-  
-        # put the socket into listening mode 
-        self.listening_sock.listen(5)
+
+        # put the socket into listening mode
+        self.listening_sock.listen(socket.SOMAXCONN)
+        self.listening_sock.setblocking(False)
         print("listening for incoming connection...", file=self.logfile)
-        self.active_socks.append(self.listening_sock)
+        self.set_events(self.listening_sock, EVENT_READ)
+        self.start_stats()
+
+    def start_stats(self):
+        if self.stats_port is not None:
+            port = self.stats_port
+            if self.worker_num is not None:
+                port += self.worker_num
+            elif self.num_workers > 1:
+                # the parent, which is the only one that knows who's waiting
+                port += self.num_workers
+            # local only - there's nothing secret in here, but nor is there
+            # any need for the world to see it
+            self.stats_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.stats_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.stats_sock.bind(("127.0.0.1", port))
+            self.stats_sock.listen(socket.SOMAXCONN)
+            self.stats_sock.setblocking(False)
+            self.set_events(self.stats_sock, EVENT_READ)
+            print("stats on http://127.0.0.1:%d/" % port)
+        if self.stats_file is not None:
+            if self.worker_num is not None:
+                self.stats_file += ".%d" % self.worker_num
+            self.next_stats_dump = time() + self.stats_interval
+
+    def get_stats(self):
+        now = time()
+        pairs = []
+        for sock, partner_sock in self.sock_pairs.items():
+            if sock.fileno() > partner_sock.fileno():
+                continue
+            pairs.append({
+                "fds": [sock.fileno(), partner_sock.fileno()],
+                "age": round(now - self.pair_start[sock], 3),
+                "bytes": [self.pair_stats[sock][0], self.pair_stats[partner_sock][0]],
+                "messages": [self.pair_stats[sock][1], self.pair_stats[partner_sock][1]],
+                # bytes the relay is holding because the socket is slow
+                "backlog": [len(self.send_queues[sock]) + self.pipe_bytes.get(sock, 0),
+                            len(self.send_queues[partner_sock])
+                            + self.pipe_bytes.get(partner_sock, 0)],
+            })
+        return {
+            "pid": os.getpid(),
+            "worker": self.worker_num,
+            "uptime": round(now - self.start_time, 3),
+            "half_open": len(self.half_open_socks),
+            "waiting": len(self.waiting_socks),
+            "pairs": len(self.sock_pairs) // 2,
+            "paused": len(self.paused_socks),
+            "totals": self.stats,
+            "loop_latency": {"buckets": list(LATENCY_BUCKETS) + ["inf"],
+                             "counts": self.latency_counts},
+            "pair_stats": pairs,
+        }
+
+    # A tiny HTTP server: whatever the request was, it gets the stats.
+    # Stats connections are non-blocking and go through the same send
+    # queues as the games, so a slow client can't hold up the relaying.
+    def accept_stats(self):
+        try:
+            c_sock, addr = self.stats_sock.accept()
+        except OSError:
+            return
+        c_sock.setblocking(False)
+        self.stats_clients[c_sock] = bytearray()
+        self.send_queues[c_sock] = bytearray()
+        self.update_events(c_sock)
+        self.set_deadline(c_sock, self.half_open_timeout)
+
+    def serve_stats(self, sock):
+        request = self.stats_clients[sock]
+        try:
+            msg = sock.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            msg = bytes()
+        if len(msg) == 0 and len(request) == 0:
+            # gone without asking for anything
+            self.close_sock(sock)
+            return
+        request += msg
+        if len(msg) > 0 and b"\r\n\r\n" not in request \
+           and len(request) < STATS_REQUEST_MAX:
+            # the rest of the request is still to come
+            return
+        body = json.dumps(self.get_stats(), indent=1).encode()
+        header = ("HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                  "Content-Length: %d\r\n\r\n" % len(body)).encode()
+        # read no more; close once the response has gone
+        self.paused_socks.add(sock)
+        self.queue_send(sock, header + body)
+        if sock in self.stats_clients and not self.send_queues[sock]:
+            self.close_sock(sock)
+
+    def dump_stats(self):
+        tmpname = self.stats_file + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.get_stats(), f)
+        os.replace(tmpname, self.stats_file)
+        self.next_stats_dump = time() + self.stats_interval
 
     def parse_args(self, argv):
         try:
             if "pacman_server.py" in argv[0]:
-                opts, args = getopt(argv[1:], "p:", ["port="])
+                opts, args = getopt(argv[1:], "p:w:", ["port=", "workers=", "stats-port=",
+                                                       "stats-file=", "stats-interval=",
+                                                       "half-open-timeout=", "waiting-timeout=",
+                                                       "idle-timeout=", "max-pending-per-ip="])
             else:
-                opts, args = getopt(argv, "p:", ["port="])
+                opts, args = getopt(argv, "p:w:", ["port=", "workers=", "stats-port=",
+                                                   "stats-file=", "stats-interval=",
+                                                   "half-open-timeout=", "waiting-timeout=",
+                                                   "idle-timeout=", "max-pending-per-ip="])
         except GetoptError:
             self.usage()
         for opt, arg in opts:
             if opt in ("-p", "--port"):
                 self.port = int(arg)
+            elif opt in ("-w", "--workers"):
+                self.num_workers = int(arg)
+                if self.num_workers < 1:
+                    self.usage()
+                if self.num_workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+                    print("--workers needs SO_REUSEPORT, which this system lacks")
+                    exit(2)
+            elif opt == "--stats-port":
+                self.stats_port = int(arg)
+            elif opt == "--stats-file":
+                self.stats_file = arg
+            elif opt == "--stats-interval":
+                self.stats_interval = float(arg)
+            elif opt == "--half-open-timeout":
+                self.half_open_timeout = float(arg)
+            elif opt == "--waiting-timeout":
+                self.waiting_timeout = float(arg)
+            elif opt == "--idle-timeout":
+                self.idle_timeout = float(arg)
+            elif opt == "--max-pending-per-ip":
+                self.max_pending_per_ip = int(arg)
             else:
                 self.usage()
 
+    def usage(self):
+        print("pacman_server.py [-p <port> | --port=<port>] [-w <n> | --workers=<n>]")
+        print("                 [--stats-port=<port>] [--stats-file=<file>]"
+              " [--stats-interval=<seconds>]")
+        print("                 [--half-open-timeout=<seconds>] [--waiting-timeout=<seconds>]")
+        print("                 [--idle-timeout=<seconds>] [--max-pending-per-ip=<n>]")
+        print("With --workers, worker i serves stats on <port>+i and dumps them to <file>.i;")
+        print("the parent, which holds the waiting connections, uses <port>+<n> and <file>.")
+        print("--max-pending-per-ip is counted by each process, so with --workers=<n> one IP")
+        print("may have that many half open connections at each worker, and as many waiting")
+        print("at the parent")
+        exit(2)
+
+    def start_workers(self):
+        # fork the workers; returns in each worker, and in the parent,
+        # which stays behind to do the password matching
+        self.logfile.flush()
+        for i in range(self.num_workers):
+            parent_sock, worker_sock = socket.socketpair(socket.AF_UNIX,
+                                                         socket.SOCK_SEQPACKET)
+            pid = os.fork()
+            if pid == 0:
+                # the worker mustn't share the parent's epoll instance, or
+                # hold the parent's end of any other worker's socket
+                parent_sock.close()
+                for sock in self.worker_socks:
+                    sock.close()
+                self.worker_socks = []
+                self.handoff_queues = {}
+                self.events = {}
+                self.selector.close()
+                self.selector = selectors.DefaultSelector()
+                self.rendezvous_sock = worker_sock
+                self.worker_num = i
+                worker_sock.setblocking(False)
+                self.handoff_queues[worker_sock] = []
+                self.set_events(worker_sock, EVENT_READ)
+                print("worker", i, "started, pid", os.getpid(), file=self.logfile)
+                return
+            worker_sock.close()
+            parent_sock.setblocking(False)
+            self.worker_socks.append(parent_sock)
+            self.handoff_queues[parent_sock] = []
+            self.set_events(parent_sock, EVENT_READ)
+
+    def set_events(self, sock, events):
+        # register, modify or unregister sock, as needed
+        current = self.events.get(sock, 0)
+        if events == current:
+            return
+        if current == 0:
+            self.selector.register(sock, events)
+        elif events == 0:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, events)
+        if events == 0:
+            del self.events[sock]
+        else:
+            self.events[sock] = events
+
+    def update_events(self, sock):
+        events = 0
+        if sock not in self.paused_socks:
+            events |= EVENT_READ
+        if self.send_queues.get(sock) or self.pipe_bytes.get(sock):
+            events |= EVENT_WRITE
+        self.set_events(sock, events)
+
+    def set_deadline(self, sock, timeout):
+        if timeout <= 0:
+            self.deadlines.pop(sock, None)
+            return
+        deadline = self.now + timeout
+        self.deadlines[sock] = deadline
+        self.timer_seq += 1
+        heappush(self.timer_heap, (deadline, self.timer_seq, sock))
+
+    def next_deadline(self):
+        # the heap's top may be stale, but that only means waking early
+        if self.timer_heap:
+            return self.timer_heap[0][0]
+        return None
+
+    def reap_expired(self):
+        while self.timer_heap and self.timer_heap[0][0] <= self.now:
+            deadline, seq, sock = heappop(self.timer_heap)
+            if self.deadlines.get(sock) != deadline:
+                # closed, or given a new deadline since
+                continue
+            del self.deadlines[sock]
+            if sock in self.sock_pairs:
+                partner_sock = self.sock_pairs[sock]
+                last_active = max(self.last_active[sock], self.last_active[partner_sock])
+                if last_active + self.idle_timeout > self.now:
+                    # there's been traffic since; check again later
+                    self.set_deadline(sock, last_active + self.idle_timeout - self.now)
+                    continue
+                print("closing idle pair, fd=", sock.fileno(), file=self.logfile)
+                self.stats["reaped_idle"] += 1
+                self.close_pair(sock)
+            elif sock in self.half_open_socks:
+                print("closing half open connection, fd=", sock.fileno(), file=self.logfile)
+                self.stats["reaped_half_open"] += 1
+                del self.half_open_socks[sock]
+                self.close_sock(sock)
+            elif sock in self.waiting_passwords:
+                print("closing connection that waited too long, fd=", sock.fileno(),
+                      file=self.logfile)
+                self.stats["reaped_waiting"] += 1
+                del self.waiting_socks[self.waiting_passwords[sock]]
+                del self.waiting_passwords[sock]
+                self.close_sock(sock)
+            elif sock in self.stats_clients:
+                self.close_sock(sock)
+
+    def add_pending(self, sock, ip):
+        # returns False if ip already has too many half open or waiting
+        count = self.pending_counts.get(ip, 0)
+        if self.max_pending_per_ip > 0 and count >= self.max_pending_per_ip:
+            print("too many pending connections from", ip, file=self.logfile)
+            self.stats["rejected_pending"] += 1
+            return False
+        self.pending_counts[ip] = count + 1
+        self.pending_ips[sock] = ip
+        return True
+
+    def remove_pending(self, sock):
+        ip = self.pending_ips.pop(sock, None)
+        if ip is not None:
+            self.pending_counts[ip] -= 1
+            if self.pending_counts[ip] == 0:
+                del self.pending_counts[ip]
+
     def accept_connection(self):
-        # Establish connection from client. 
-        c_sock, addr = self.listening_sock.accept()
+        # Establish connection from client.
+        try:
+            c_sock, addr = self.listening_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            # most likely out of file descriptors; try again next time
+            print("accept failed:", err, file=self.logfile)
+            return
+        c_sock.setblocking(False)
         print('Got connection from', addr, file=self.logfile)
         self.logfile.flush()
+        self.stats["connections_accepted"] += 1
+        if not self.add_pending(c_sock, addr[0]):
+            c_sock.close()
+            return
         self.half_open_socks[c_sock] = addr
-        self.active_socks.append(c_sock)
+        self.send_queues[c_sock] = bytearray()
+        self.update_events(c_sock)
+        self.set_deadline(c_sock, self.half_open_timeout)
 
     def receive_passwd(self, c_sock):
         fd = c_sock.fileno()
         print("receive_passwd, fd=", fd, file=self.logfile)
         try:
             msg = c_sock.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
         except OSError:
             msg = bytes()
 
@@ -70,91 +469,368 @@ class Network():
             # the connection died - cleanup its state
             print("half open connection died, fd=", fd, file=self.logfile)
             del self.half_open_socks[c_sock]
-            if c_sock in self.active_socks:
-                self.active_socks.remove(c_sock)
+            self.close_sock(c_sock)
             return
-            
-        passwd = msg.decode()
 
-        if passwd in self.waiting_socks:
+        passwd = msg.decode(errors='replace')
+
+        if self.rendezvous_sock is not None:
+            # let the parent match it up; it may pair with a connection
+            # that arrived at some other worker
+            print("fd ", fd, "received passwd ", passwd, "handing off", file=self.logfile)
+            del self.half_open_socks[c_sock]
+            self.forget_sock(c_sock)
+            self.send_handoff(self.rendezvous_sock, msg, [c_sock])
+        elif passwd in self.waiting_socks:
             # password patches that of a waiting connection - join them up
             waiting_sock = self.waiting_socks[passwd]
             wfd = waiting_sock.fileno()
             print("fd ", fd, "passwd ", passwd, "matches fd", wfd, file=self.logfile)
-            c_sock.send("OK\n".encode())
-            waiting_sock.send("OK\n".encode())
-            self.sock_pairs[c_sock] = waiting_sock
-            self.sock_pairs[waiting_sock] = c_sock
             del self.waiting_passwords[waiting_sock]
             del self.waiting_socks[passwd]
+            del self.half_open_socks[c_sock]
+            self.pair_up(c_sock, waiting_sock)
         else:
             # move connection from half-open to one that has a password and is waiting
             print("fd ", fd, "received passwd ", passwd, file=self.logfile)
             self.waiting_socks[passwd] = c_sock
             self.waiting_passwords[c_sock] = passwd
             del self.half_open_socks[c_sock]
+            self.set_deadline(c_sock, self.waiting_timeout)
+
+    def receive_handoff(self, worker_sock):
+        # parent: a worker has passed us a connection and its password
+        try:
+            msg, fds, flags, addr = socket.recv_fds(worker_sock, HANDOFF_SIZE, 1)
+        except OSError:
+            msg, fds = bytes(), []
+        if len(msg) == 0:
+            print("worker died, fd=", worker_sock.fileno(), file=self.logfile)
+            self.worker_socks.remove(worker_sock)
+            self.drop_handoffs(worker_sock)
+            self.close_sock(worker_sock)
+            if not self.worker_socks:
+                exit(1)
+            return
+        c_sock = socket.socket(fileno=fds[0])
+        c_sock.setblocking(False)
+        passwd = msg.decode(errors='replace')
+        try:
+            ip = c_sock.getpeername()[0]
+        except OSError:
+            # it's gone already
+            c_sock.close()
+            return
+
+        if passwd in self.waiting_socks:
+            # send both back to the worker that has the newer connection
+            waiting_sock = self.waiting_socks[passwd]
+            print("fd ", c_sock.fileno(), "passwd ", passwd, "matches fd",
+                  waiting_sock.fileno(), file=self.logfile)
+            del self.waiting_passwords[waiting_sock]
+            del self.waiting_socks[passwd]
+            self.forget_sock(waiting_sock)
+            self.send_handoff(worker_sock, msg, [c_sock, waiting_sock])
+        else:
+            # watch it for dying, as receive_passwd's waiting sockets are
+            if not self.add_pending(c_sock, ip):
+                c_sock.close()
+                return
+            print("fd ", c_sock.fileno(), "waiting with passwd ", passwd, file=self.logfile)
+            self.waiting_socks[passwd] = c_sock
+            self.waiting_passwords[c_sock] = passwd
+            self.update_events(c_sock)
+            self.set_deadline(c_sock, self.waiting_timeout)
+
+    def receive_pair(self):
+        # worker: the parent has matched two connections for us to relay
+        try:
+            msg, fds, flags, addr = socket.recv_fds(self.rendezvous_sock, HANDOFF_SIZE, 2)
+        except OSError:
+            msg, fds = bytes(), []
+        if len(msg) == 0:
+            # the parent has gone, so nobody can pair new games
+            print("lost the rendezvous socket, exiting", file=self.logfile)
+            exit(1)
+        c_sock, waiting_sock = [socket.socket(fileno=fd) for fd in fds]
+        for sock in (c_sock, waiting_sock):
+            sock.setblocking(False)
+            self.send_queues[sock] = bytearray()
+            self.update_events(sock)
+        self.pair_up(c_sock, waiting_sock)
+
+    def send_handoff(self, rendezvous_sock, msg, socks):
+        # pass socks, which we've already forgotten about, over
+        # rendezvous_sock; they're closed here once they've gone
+        queue = self.handoff_queues[rendezvous_sock]
+        queue.append((msg, socks))
+        if len(queue) == 1:
+            self.send_handoffs(rendezvous_sock)
+
+    def send_handoffs(self, rendezvous_sock):
+        queue = self.handoff_queues[rendezvous_sock]
+        while queue:
+            msg, socks = queue[0]
+            try:
+                socket.send_fds(rendezvous_sock, [msg], [sock.fileno() for sock in socks])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # the other end has gone; reading will tell us so
+                self.drop_handoffs(rendezvous_sock)
+                break
+            queue.pop(0)
+            for sock in socks:
+                sock.close()
+        events = EVENT_READ
+        if queue:
+            events |= EVENT_WRITE
+        self.set_events(rendezvous_sock, events)
+
+    def drop_handoffs(self, rendezvous_sock):
+        for msg, socks in self.handoff_queues[rendezvous_sock]:
+            for sock in socks:
+                sock.close()
+        self.handoff_queues[rendezvous_sock] = []
+
+    def pair_up(self, c_sock, waiting_sock):
+        self.sock_pairs[c_sock] = waiting_sock
+        self.sock_pairs[waiting_sock] = c_sock
+        for sock in (c_sock, waiting_sock):
+            self.pair_stats[sock] = [0, 0]
+            self.pair_start[sock] = self.now
+            self.last_active[sock] = self.now
+            self.remove_pending(sock)
+            self.deadlines.pop(sock, None)
+        # one deadline does for the pair
+        self.set_deadline(c_sock, self.idle_timeout)
+        self.stats["pairs_made"] += 1
+        if USE_SPLICE:
+            for sock in (c_sock, waiting_sock):
+                self.pipes[sock] = os.pipe()
+                self.pipe_bytes[sock] = 0
+        self.queue_send(c_sock, "OK\n".encode())
+        if waiting_sock in self.sock_pairs:
+            # (unless that send found c_sock dead, and closed both)
+            self.queue_send(waiting_sock, "OK\n".encode())
+
+    def queue_send(self, sock, data):
+        queue = self.send_queues[sock]
+        if not queue:
+            # nothing queued ahead of it, so try to send it straight away
+            try:
+                sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close_pair(sock)
+                return
+            data = data[sent:]
+            if not data:
+                return
+        queue += data
+        self.update_events(sock)
+        if len(queue) > HIGH_WATER and sock in self.sock_pairs:
+            # stop reading from the partner until we've caught up
+            partner_sock = self.sock_pairs[sock]
+            self.paused_socks.add(partner_sock)
+            self.update_events(partner_sock)
+
+    def send_queued(self, sock):
+        queue = self.send_queues[sock]
+        try:
+            sent = sock.send(queue)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_pair(sock)
+            return
+        del queue[:sent]
+        if not queue and sock in self.stats_clients:
+            # that was the whole stats response
+            self.close_sock(sock)
+            return
+        if not queue and self.pipe_bytes.get(sock):
+            # the queue was ahead of the pipe, so the pipe can go now
+            self.send_piped(sock)
+            return
+        self.update_events(sock)
+        if len(queue) < LOW_WATER and sock in self.sock_pairs:
+            partner_sock = self.sock_pairs[sock]
+            if partner_sock in self.paused_socks:
+                self.paused_socks.discard(partner_sock)
+                self.update_events(partner_sock)
+
+    def send_piped(self, sock):
+        # splice as much of sock's pipe into it as it will take; while any
+        # is left over, its partner isn't read
+        read_fd, write_fd = self.pipes[sock]
+        partner_sock = self.sock_pairs[sock]
+        while self.pipe_bytes[sock]:
+            try:
+                sent = os.splice(read_fd, sock.fileno(), self.pipe_bytes[sock],
+                                 flags=SPLICE_FLAGS)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close_pair(sock)
+                return
+            self.pipe_bytes[sock] -= sent
+        if self.pipe_bytes[sock]:
+            self.paused_socks.add(partner_sock)
+        else:
+            self.paused_socks.discard(partner_sock)
+        self.update_events(sock)
+        self.update_events(partner_sock)
 
     def relay_message(self, sock):
         partner_sock = self.sock_pairs[sock]
-        cleanup = False
-        try:
-            recv_bytes = sock.recv(10000)
-            if len(recv_bytes) == 0:
-                cleanup = True
+        if USE_SPLICE and not self.send_queues[partner_sock]:
+            read_fd, write_fd = self.pipes[partner_sock]
+            try:
+                nbytes = os.splice(sock.fileno(), write_fd, RECV_SIZE,
+                                   flags=SPLICE_FLAGS)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                nbytes = 0
+            if nbytes == 0:
+                self.close_pair(sock)
             else:
-                partner_sock.send(recv_bytes)
-        except ConnectionResetError:
-            cleanup = True
-        except BrokenPipeError:
-            cleanup = True
-        if cleanup:
+                self.count_relayed(sock, nbytes)
+                self.pipe_bytes[partner_sock] += nbytes
+                self.send_piped(partner_sock)
+            return
+        try:
+            nbytes = sock.recv_into(self.recv_buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            nbytes = 0
+        if nbytes == 0:
+            self.close_pair(sock)
+        else:
+            self.count_relayed(sock, nbytes)
+            self.queue_send(partner_sock, self.recv_view[:nbytes])
+
+    def count_relayed(self, sock, nbytes):
+        pair_stats = self.pair_stats[sock]
+        pair_stats[0] += nbytes
+        pair_stats[1] += 1
+        self.last_active[sock] = self.now
+        self.stats["bytes_relayed"] += nbytes
+        self.stats["messages_relayed"] += 1
+
+    def close_sock(self, sock):
+        self.forget_sock(sock)
+        try:
             sock.close()
-            partner_sock.close()
-            del self.sock_pairs[sock]
+        except OSError:
+            pass
+
+    # stop watching sock and drop everything we know about it, but leave
+    # it open (it's being handed to another process)
+    def forget_sock(self, sock):
+        self.set_events(sock, 0)
+        self.send_queues.pop(sock, None)
+        self.stats_clients.pop(sock, None)
+        self.paused_socks.discard(sock)
+        self.pipe_bytes.pop(sock, None)
+        for fd in self.pipes.pop(sock, ()):
+            os.close(fd)
+        self.deadlines.pop(sock, None)
+        self.last_active.pop(sock, None)
+        self.remove_pending(sock)
+
+    def close_pair(self, sock):
+        partner_sock = self.sock_pairs.pop(sock, None)
+        self.close_sock(sock)
+        if partner_sock is not None:
             del self.sock_pairs[partner_sock]
-            self.active_socks.remove(sock)
-            self.active_socks.remove(partner_sock)
+            self.close_sock(partner_sock)
+            self.stats["pairs_closed"] += 1
+            for s in (sock, partner_sock):
+                del self.pair_stats[s]
+                del self.pair_start[s]
 
     def close_half_open_sock(self, sock):
         print("Error: ", sock.fileno(),
               "got a message from a waiting sock!", file=self.logfile)
         # no idea what to do, just close it.
-        self.active_socks.remove(sock)
-        sock.close()
         passwd = self.waiting_passwords[sock]
         del self.waiting_passwords[sock]
         del self.waiting_socks[passwd]
-        
+        self.close_sock(sock)
+
     def check_for_messages(self):
-        rd, wd, ed = select.select(self.active_socks, [],[])
-        if not rd:
-            pass
-        else:
-            for sock in rd:
-                if sock is self.listening_sock:
-                    # it's a new connection
-                    self.accept_connection()
-                elif sock in self.sock_pairs:
-                    # it's a message on an existing pair
-                    self.relay_message(sock)
-                elif sock in self.half_open_socks:
-                    # it's a message from a connection we've not yet heard a password
-                    self.receive_passwd(sock)
-                elif sock in self.waiting_passwords:
-                    # it's a second message from a unpaired connection
-                    self.close_half_open_sock(sock)
+        wakeups = [t for t in (self.next_stats_dump, self.next_deadline()) if t is not None]
+        timeout = None
+        if wakeups:
+            timeout = max(0, min(wakeups) - time())
+        ready = self.selector.select(timeout)
+        start = perf_counter()
+        self.now = time()
+        self.reap_expired()
+        for key, events in ready:
+            sock = key.fileobj
+            if sock not in self.events:
+                # closed by an earlier event in this batch
+                continue
+            if sock is self.listening_sock:
+                # it's a new connection
+                self.accept_connection()
+                continue
+            if sock is self.stats_sock:
+                self.accept_stats()
+                continue
+            if events & EVENT_WRITE:
+                if sock in self.handoff_queues:
+                    # a handoff the other end couldn't take before
+                    self.send_handoffs(sock)
                 else:
-                    # we've no idea what happened!
-                    print("Got a stray socket!", sock, file=self.logfile)
-                    try:
-                        sock.close()
-                    except:
-                        pass
-                    
+                    self.send_queued(sock)
+                if sock not in self.events:
+                    continue
+            if not events & EVENT_READ:
+                continue
+            if sock is self.rendezvous_sock:
+                # the parent has paired up two connections
+                self.receive_pair()
+            elif sock in self.worker_socks:
+                # a worker has handed over a connection with its password
+                self.receive_handoff(sock)
+            elif sock in self.sock_pairs:
+                # it's a message on an existing pair
+                self.relay_message(sock)
+            elif sock in self.half_open_socks:
+                # it's a message from a connection we've not yet heard a password
+                self.receive_passwd(sock)
+            elif sock in self.waiting_passwords:
+                # it's a second message from a unpaired connection
+                self.close_half_open_sock(sock)
+            elif sock in self.stats_clients:
+                # a stats request, or part of one
+                self.serve_stats(sock)
+            else:
+                # we've no idea what happened!
+                print("Got a stray socket!", sock, file=self.logfile)
+                self.close_sock(sock)
+        if ready:
+            self.latency_counts[bisect_left(LATENCY_BUCKETS, perf_counter() - start)] += 1
+        if self.next_stats_dump is not None and time() >= self.next_stats_dump:
+            self.dump_stats()
+
 
 net = Network()
 net.parse_args(argv)
-net.listen()
+if net.num_workers > 1:
+    net.start_workers()
+if net.rendezvous_sock is not None or net.num_workers == 1:
+    net.listen()
+else:
+    # the workers' stats never count anyone waiting, because the parent
+    # holds those connections, so it has stats of its own
+    net.start_stats()
 
 while True:
     net.check_for_messages()
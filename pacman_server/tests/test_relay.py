@@ -0,0 +1,384 @@
+# The relay, tested from outside: each test starts pacman_server.py in a
+# subprocess and talks to it over real sockets, as the game does.  The
+# server can't be imported, since it starts serving as soon as it's loaded.
+
+import os
+import ast
+import sys
+import json
+import time
+import socket
+import signal
+import threading
+import subprocess
+import urllib.request
+import pytest
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pacman_server.py")
+
+def server_constant(name):
+    # a module level constant, as the server defines it
+    with open(SERVER) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) == name:
+            return eval(compile(ast.Expression(node.value), SERVER, "eval"))
+    raise KeyError(name)
+
+HIGH_WATER = server_constant("HIGH_WATER")
+LOW_WATER = server_constant("LOW_WATER")
+
+# Run the server as a script, or with os.splice hidden so it relays with
+# recv_into and its own send queues wherever it runs.  On loopback the
+# kernel's send buffers grow to megabytes and one send() empties the whole
+# queue, so in that mode the accepted sockets also get small send buffers,
+# and the queue drains a little at a time, as it would to a real slow
+# client.
+NO_SPLICE = ("import os, sys, socket, runpy\n"
+             "del os.splice\n"
+             "accept = socket.socket.accept\n"
+             "def small_accept(self):\n"
+             "    sock, addr = accept(self)\n"
+             "    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)\n"
+             "    return sock, addr\n"
+             "socket.socket.accept = small_accept\n"
+             "sys.argv = sys.argv[1:]\n"
+             "runpy.run_path(sys.argv[0], run_name='__main__')\n")
+
+MODES = ["recv_into"]
+if hasattr(os, "splice"):
+    MODES.insert(0, "splice")
+
+def free_ports(count):
+    # count consecutive free ports on localhost
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            base = s.getsockname()[1]
+        if base + count > 65535:
+            continue
+        socks = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket()
+                socks.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            pass
+        finally:
+            for s in socks:
+                s.close()
+
+class Relay():
+    def __init__(self, cwd, options, mode="splice", workers=1):
+        self.port = free_ports(1)
+        self.workers = workers
+        self.stats_port = free_ports(workers + 1 if workers > 1 else 1)
+        args = [SERVER, "-p", str(self.port), "-w", str(workers),
+                "--stats-port=%d" % self.stats_port] + list(options)
+        if mode == "splice":
+            cmd = [sys.executable, *args]
+        else:
+            cmd = [sys.executable, "-c", NO_SPLICE, *args]
+        self.proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL,
+                                     start_new_session=True)
+        self.clients = []
+        # every process serves stats once it's listening
+        ports = [self.stats_port + i for i in range(0, workers + 1 if workers > 1 else 1)]
+        deadline = time.time() + 10
+        for port in ports:
+            while True:
+                assert self.proc.poll() is None, "the server exited"
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    assert time.time() < deadline, "the server never started"
+                    time.sleep(0.05)
+
+    def stop(self):
+        for client in self.clients:
+            client.close()
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.proc.wait(10)
+
+    def stats(self, worker=None):
+        # with workers, the parent's stats are after the workers'
+        port = self.stats_port
+        if self.workers > 1:
+            port += self.workers if worker is None else worker
+        with urllib.request.urlopen("http://127.0.0.1:%d/" % port, timeout=5) as response:
+            return json.loads(response.read())
+
+    def connect(self, rcvbuf=None):
+        sock = socket.socket()
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.settimeout(5)
+        sock.connect(("127.0.0.1", self.port))
+        self.clients.append(sock)
+        return sock
+
+    def pair(self, password=b"secret", rcvbuf=None):
+        # two clients with the same password, once the relay has said OK
+        first = self.connect()
+        first.sendall(password)
+        self.wait_for(lambda stats: stats["waiting"] == 1)
+        second = self.connect(rcvbuf)
+        second.sendall(password)
+        assert recv_exactly(first, 3) == b"OK\n"
+        assert recv_exactly(second, 3) == b"OK\n"
+        return first, second
+
+    def wait_for(self, test, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            stats = self.stats()
+            if test(stats):
+                return stats
+            assert time.time() < deadline, stats
+            time.sleep(0.02)
+
+@pytest.fixture
+def relay(tmp_path):
+    # start a relay with start(options...), stopped after the test
+    relays = []
+    def start(*options, mode="splice", workers=1):
+        relays.append(Relay(tmp_path, options, mode, workers))
+        return relays[-1]
+    yield start
+    for r in relays:
+        r.stop()
+
+def recv_exactly(sock, nbytes):
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes - len(data))
+        assert chunk, "connection closed after %d of %d bytes" % (len(data), nbytes)
+        data += chunk
+    return bytes(data)
+
+def is_closed(sock, timeout=5):
+    # True once the relay has closed sock, False if it's still open
+    sock.settimeout(timeout)
+    try:
+        return sock.recv(1) == b""
+    except socket.timeout:
+        return False
+    except ConnectionResetError:
+        return True
+
+def exchange(a, b, size):
+    # send size random bytes each way at once; each side gets the other's
+    data = {a: os.urandom(size), b: os.urandom(size)}
+    received = {}
+    def send(sock):
+        sock.sendall(data[sock])
+    def receive(sock, other):
+        received[sock] = recv_exactly(sock, size)
+    threads = [threading.Thread(target=send, args=(a,)),
+               threading.Thread(target=send, args=(b,)),
+               threading.Thread(target=receive, args=(a, b)),
+               threading.Thread(target=receive, args=(b, a))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    assert received[a] == data[b]
+    assert received[b] == data[a]
+
+@pytest.mark.parametrize("mode", MODES)
+def test_pair_relayed_both_ways(relay, mode):
+    r = relay(mode=mode)
+    a, b = r.pair()
+    exchange(a, b, 3 * 1024 * 1024)
+    # and small messages, one at a time
+    for i in range(0, 20):
+        msg = b"message %d" % i
+        a.sendall(msg)
+        assert recv_exactly(b, len(msg)) == msg
+        b.sendall(msg[::-1])
+        assert recv_exactly(a, len(msg)) == msg[::-1]
+
+def test_pairs_relayed_with_workers(relay):
+    # pairs whose two connections arrive at different workers are handed
+    # over by the parent
+    r = relay(workers=3)
+    pairs = []
+    for i in range(0, 12):
+        password = b"game %d" % i
+        a = r.connect()
+        a.sendall(password)
+        r.wait_for(lambda stats: stats["waiting"] == 1)
+        b = r.connect()
+        b.sendall(password)
+        assert recv_exactly(a, 3) == b"OK\n"
+        assert recv_exactly(b, 3) == b"OK\n"
+        pairs.append((a, b))
+    for a, b in pairs:
+        exchange(a, b, 64 * 1024)
+    assert sum(r.stats(i)["pairs"] for i in range(0, 3)) == 12
+
+def test_close_closes_partner(relay):
+    r = relay()
+    a, b = r.pair()
+    a.close()
+    assert is_closed(b)
+    stats = r.wait_for(lambda stats: stats["totals"]["pairs_closed"] == 1)
+    assert stats["pairs"] == 0
+
+@pytest.mark.parametrize("mode", MODES)
+def test_slow_reader_pauses_partner(relay, mode):
+    r = relay(mode=mode)
+    # b reads nothing to start with, and has a small receive buffer, so
+    # the relay soon has to hold a's bytes
+    a, b = r.pair(rcvbuf=4096)
+    size = 24 * 1024 * 1024
+    data = os.urandom(size)
+    sender = threading.Thread(target=a.sendall, args=(data,))
+    sender.start()
+    stats = r.wait_for(lambda stats: stats["paused"] == 1, timeout=20)
+    backlog = sum(stats["pair_stats"][0]["backlog"])
+    if mode == "recv_into":
+        assert backlog > HIGH_WATER
+    else:
+        assert backlog > 0
+    # now read it all, watching the relay catch up
+    received = bytearray()
+    resumed = False
+    drained_while_paused = False
+    last_paused = True
+    while len(received) < size:
+        chunk = b.recv(min(65536, size - len(received)))
+        assert chunk
+        received += chunk
+        if len(received) % 32768 < len(chunk):
+            stats = r.stats()
+            backlog = sum(stats["pair_stats"][0]["backlog"])
+            paused = stats["paused"] == 1
+            if paused and mode == "recv_into":
+                # a paused sender waits for the queue to drain below
+                # LOW_WATER, and no further
+                assert backlog >= LOW_WATER
+                if backlog < HIGH_WATER:
+                    drained_while_paused = True
+            elif paused:
+                assert backlog > 0
+            if last_paused and not paused:
+                resumed = True
+            last_paused = paused
+    sender.join(30)
+    assert bytes(received) == data
+    assert resumed
+    if mode == "recv_into":
+        # and not as soon as it's below HIGH_WATER again
+        assert drained_while_paused
+    stats = r.wait_for(lambda stats: stats["paused"] == 0)
+    assert stats["pair_stats"][0]["backlog"] == [0, 0]
+
+def test_half_open_reaped(relay):
+    r = relay("--half-open-timeout=0.5")
+    sock = r.connect()
+    assert not is_closed(sock, 0.2)
+    assert is_closed(sock, 5)
+    stats = r.stats()
+    assert stats["totals"]["reaped_half_open"] == 1
+    assert stats["half_open"] == 0
+
+def test_waiting_reaped(relay):
+    r = relay("--half-open-timeout=0.3", "--waiting-timeout=1.5")
+    sock = r.connect()
+    sock.sendall(b"nobody")
+    # a password moves it on to the waiting deadline
+    assert not is_closed(sock, 0.8)
+    assert r.stats()["waiting"] == 1
+    assert is_closed(sock, 5)
+    stats = r.stats()
+    assert stats["totals"]["reaped_waiting"] == 1
+    assert stats["totals"]["reaped_half_open"] == 0
+    assert stats["waiting"] == 0
+
+def test_idle_pair_reaped(relay):
+    r = relay("--idle-timeout=1")
+    a, b = r.pair()
+    # traffic puts it off
+    for i in range(0, 4):
+        time.sleep(0.4)
+        a.sendall(b"still here")
+        assert recv_exactly(b, 10) == b"still here"
+    assert r.stats()["pairs"] == 1
+    assert is_closed(a, 5)
+    assert is_closed(b, 1)
+    stats = r.stats()
+    assert stats["totals"]["reaped_idle"] == 1
+    assert stats["pairs"] == 0
+
+def test_pending_per_ip_cap(relay):
+    r = relay("--max-pending-per-ip=2")
+    socks = [r.connect() for i in range(0, 3)]
+    stats = r.wait_for(lambda stats: stats["totals"]["connections_accepted"] == 3)
+    assert stats["totals"]["rejected_pending"] == 1
+    assert stats["half_open"] == 2
+    closed = [sock for sock in socks if is_closed(sock, 0.5)]
+    assert len(closed) == 1
+    # once the other two have paired up, they're not pending any more
+    a, b = [sock for sock in socks if sock not in closed]
+    a.sendall(b"pair")
+    r.wait_for(lambda stats: stats["waiting"] == 1)
+    b.sendall(b"pair")
+    assert recv_exactly(a, 3) == b"OK\n"
+    assert recv_exactly(b, 3) == b"OK\n"
+    c = r.connect()
+    c.sendall(b"another")
+    stats = r.wait_for(lambda stats: stats["waiting"] == 1)
+    assert not is_closed(c, 0.3)
+    assert stats["totals"]["rejected_pending"] == 1
+
+def test_stats_report_counters(relay):
+    r = relay()
+    stats = r.stats()
+    assert stats["worker"] is None
+    assert stats["pid"] == r.proc.pid
+    assert stats["totals"]["connections_accepted"] == 0
+    a, b = r.pair()
+    a.sendall(b"x" * 1000)
+    recv_exactly(b, 1000)
+    b.sendall(b"y" * 300)
+    recv_exactly(a, 300)
+    stats = r.wait_for(lambda stats: stats["totals"]["bytes_relayed"] == 1300)
+    totals = stats["totals"]
+    assert totals["connections_accepted"] == 2
+    assert totals["pairs_made"] == 1
+    assert totals["pairs_closed"] == 0
+    assert totals["messages_relayed"] >= 2
+    assert (stats["half_open"], stats["waiting"], stats["pairs"]) == (0, 0, 1)
+    assert len(stats["pair_stats"]) == 1
+    assert sorted(stats["pair_stats"][0]["bytes"]) == [300, 1000]
+    assert stats["pair_stats"][0]["backlog"] == [0, 0]
+    assert len(stats["loop_latency"]["counts"]) == len(stats["loop_latency"]["buckets"])
+    assert sum(stats["loop_latency"]["counts"]) > 0
+    b.close()
+    stats = r.wait_for(lambda stats: stats["totals"]["pairs_closed"] == 1)
+    assert stats["pairs"] == 0
+    assert stats["pair_stats"] == []
+
+def test_stats_request_in_pieces(relay):
+    r = relay()
+    sock = socket.create_connection(("127.0.0.1", r.stats_port), timeout=5)
+    sock.sendall(b"GET / HTTP/1.0\r\n")
+    time.sleep(0.2)
+    sock.sendall(b"Host: localhost\r\n\r\n")
+    response = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        response += chunk
+    sock.close()
+    header, body = bytes(response).split(b"\r\n\r\n", 1)
+    assert header.startswith(b"HTTP/1.0 200 OK")
+    assert json.loads(body)["pairs"] == 0